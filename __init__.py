@@ -7,7 +7,20 @@ model -- contains the classes that represent data model
 server -- implements the logic of PySAA
 settings -- contains configuration settings
 utils -- common utilities
+writebehind -- buffers non-critical updates and writes them in background
+sessions -- session stores (database, SQLite file, memory)
+invalidation -- cache invalidation events, sent to all the nodes
+provisioning -- bulk registration of users from CSV or JSON lines files
+replay -- capture of the requests handled and offline replay of the traffic
+admission -- admission control and load shedding under overload
+migrate -- migration of databases created by previous versions
+httpserver -- HTTP/JSON front end (asyncio server and WSGI application)
+binproto -- binary protocol server and client, for internal callers
+profiling -- on-demand profiling of requests (cProfile, tracemalloc)
+bench -- benchmarks, run on the in-memory storage engine
 """
 SETTINGS_MODULE = "pysaa.settings"
 
-__all__ = ["server", "model", "dbapi", "utils", "settings"]
\ No newline at end of file
+__all__ = ["server", "model", "dbapi", "utils", "settings", "writebehind", "httpserver",
+           "binproto", "profiling", "sessions", "invalidation",
+           "provisioning", "replay", "admission", "migrate"]
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""
+admission.py
+
+This module implements the admission control of PySAAServer, which keeps
+the latency of authorize requests bounded when the database slows down,
+instead of letting requests of every type pile up:
+
+- concurrency limits by request type: requests beyond the limit of their
+type are refused at once. By default only the types that can wait
+(register, activate, login, logout) are limited, so authorize requests
+always get the workers
+- queue deadline: requests that have waited in the queue of the worker
+pool longer than the deadline are refused without being processed, their
+clients have probably given up
+- adaptive limits: the time requests hold a database connection is
+averaged over intervals. While it's above the target, the limits are
+halved (down to 1), and when it goes back below they are raised one by
+one, up to the values configured
+
+The admission control is off unless it's configured (settings
+ADMISSION_LIMITS and T_QUEUE_DEADLINE). Requests refused are answered as
+busy: PySAAServer returns a response with result False, the reason in
+error and busy set to True (HTTP 503, binary protocol ERROR_BUSY)
+"""
+
+import logging
+import threading
+import time
+
+
+class AdmissionController(object):
+	"""
+	Decides if a request is processed. Shared by the worker threads
+	"""
+
+	def __init__(self, limits=None, target=None, deadline=None, interval=1.0):
+		"""
+		Arguments:
+		limits(dict) -- request type -> maximum number of requests of that
+		type processed at the same time. Types not listed are not limited
+		target(float) -- database time (seconds) above which the limits are
+		reduced, None to keep them fixed
+		deadline(float) -- maximum time (seconds) a request may wait in the
+		queue, None for no deadline
+		interval(float) -- seconds between two adjustments of the limits
+		"""
+		self.limits = dict(limits or {})
+		self.current = dict(self.limits)  # limits in force, adjusted
+		self.target = target
+		self.deadline = deadline
+		self.interval = interval
+		self.shed = {}  # request type -> requests refused by its limit
+		self.expired = 0  # requests refused by the queue deadline
+		self._running = dict.fromkeys(self.limits, 0)
+		self._total = 0.0  # database time of the current interval
+		self._count = 0
+		self._adjusted = time.monotonic()
+		self._lock = threading.Lock()
+
+	def admit(self, type, enqueued=None):
+		"""
+		Checks the deadline and the limit of the request type. Each request
+		admitted must be released after being processed
+
+		Arguments:
+		type(str) -- request type
+		enqueued(float) -- time.monotonic() when the request was queued,
+		None if it wasn't
+
+		Returns:
+		str -- reason of the refusal, None if the request is admitted
+		"""
+		if (enqueued is not None and self.deadline is not None and
+				time.monotonic() - enqueued > self.deadline):
+			with self._lock:
+				self.expired += 1
+			return "request expired in the queue"
+		if not type in self.current:
+			return None
+		with self._lock:
+			if self._running[type] >= self.current[type]:
+				self.shed[type] = self.shed.get(type, 0) + 1
+				return "too many %s requests" % type
+			self._running[type] += 1
+		return None
+
+	def release(self, type, db_time=None):
+		"""
+		Called when a request admitted has been processed
+
+		Arguments:
+		type(str) -- request type
+		db_time(float) -- seconds the request held a database connection,
+		None if it didn't use the database
+		"""
+		if type in self._running:
+			with self._lock:
+				self._running[type] -= 1
+		if db_time is None or self.target is None:
+			return
+		with self._lock:
+			self._total += db_time
+			self._count += 1
+			now = time.monotonic()
+			if now - self._adjusted >= self.interval:
+				self.adjust(self._total / self._count)
+				self._total, self._count = 0.0, 0
+				self._adjusted = now
+
+	def adjust(self, latency):
+		"""
+		Halves the limits if the database time is above the target, or
+		raises them by one if it's below. Must be called holding the lock
+
+		Arguments:
+		latency(float) -- average database time of the last interval
+		"""
+		changed = False
+		for type, limit in self.limits.items():
+			current = self.current[type]
+			if latency > self.target:
+				self.current[type] = max(1, current // 2)
+			elif current < limit:
+				self.current[type] = current + 1
+			changed = changed or self.current[type] != current
+		if changed:
+			logging.warning("database time %.1f ms, admission limits: %s" %
+							(latency * 1000, self.current))
+
+	def stats(self):
+		"""
+		Returns:
+		dict -- limits in force, requests refused by type and by deadline
+		"""
+		with self._lock:
+			return dict(limits=dict(self.current), shed=dict(self.shed), expired=self.expired)
@@ -0,0 +1,942 @@
+"""
+bench.py
+
+Benchmarks of PySAA. They run on the in-memory storage engine (MemoryDb)
+seeded with a small data set, so the results measure PySAA itself and not
+the database. If the environment variable PYSAA_BENCH_DB is set to a file
+path, they run on a SQLite database created in that file instead.
+Settings are changed when this module is imported, so it must be run on
+its own:
+
+usage: python -m pysaa.bench <benchmark> [options]
+
+benchmarks:
+http [n] [connections] [pipeline] -- authorize requests/sec through HttpServer
+binary [n] [pipeline] -- authorize round trip latency through BinaryServer
+stress [users] [n] [workers] -- concurrent requests in the worker pool, checks
+that each response belongs to its request
+startup [runs] -- import time and first request latency, with and without warmup
+refresh [n] [workers] -- concurrent requests on a session about to expire, in
+each refresh mode: requests failed and session store writes
+invalidation [transport] [n] -- delivery latency of invalidation events between
+two nodes (UnixSocketTransport or UdpMulticastTransport)
+provision [n] [batch] -- users registered/sec by the bulk provisioning, from a
+CSV file, without sending mails
+decisions [n] [objects] -- authorize latency with and without the decision cache
+eviction [n] [threads] [size] -- concurrent lookups and stores on a decision cache
+smaller than the keys used, checks that each decision found belongs to its key
+anonymous [n] [workers] -- authorize requests without session, answered from
+memory and from the database
+rows [n] [runs] -- time to build the entities of a list() of n rows, read as
+tuples and as dictionaries
+overload [n] [workers] [delay] -- authorize latency during a burst of registrations
+on a slow database (writes take delay ms), with and without admission control
+sqlite [n] [threads] -- SQLiteDb and SQLiteWalDb: authorize requests/sec with 1 to
+threads workers, and login/logout transactions/sec (needs PYSAA_BENCH_DB)
+tenants [tenants] [size] [n] -- authorize requests/sec of a multi-tenant server
+with tenants SQLite databases and at most size tenants open
+tokens [n] [lookups] -- size of a SQLite table of n activations and lookup
+latency, with the ids stored as they are and as SHA-256 digests
+capture [n] -- authorize latency with and without the traffic capture, checks
+that failed requests are captured
+hierarchy [depth] [n] -- authorize latency for role hierarchies of 1 to depth
+levels, with a recursive query and with one query per level (needs PYSAA_BENCH_DB)
+"""
+
+import ast
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pysaa.settings
+
+# must be set before the settings are loaded
+BENCH_DB = os.environ.get('PYSAA_BENCH_DB')
+if BENCH_DB:
+	pysaa.settings.DATABASE = {'class': 'SQLiteDb', 'config': {'database': BENCH_DB}}
+else:
+	pysaa.settings.DATABASE = {'class': 'MemoryDb', 'config': {'store': 'bench'}}
+# the benchmarks fill the queue on purpose, no request is refused (except
+# by the overload benchmark, which uses the admission control configured,
+# or the limits suggested in the settings if it's off)
+ADMISSION = (pysaa.settings.ADMISSION_LIMITS or {'register': 2, 'activate': 2, 'login': 4,
+												 'logout': 4},
+			 pysaa.settings.ADMISSION_TARGET, pysaa.settings.T_QUEUE_DEADLINE or 0.5)
+pysaa.settings.ADMISSION_LIMITS = {}
+pysaa.settings.T_QUEUE_DEADLINE = 0
+
+from pysaa import dbapi, utils
+from pysaa.model import User, Role, Permission
+from pysaa.server import DEFAULT_TENANT
+
+
+def seed(depth=3, objects=10):
+	"""
+	Creates a role hierarchy with its permissions, and an active user with
+	a valid session
+
+	Arguments:
+	depth(int) -- number of roles, each one is the parent of the next one
+	objects(int) -- objects granted to each role
+
+	Returns:
+	str -- session identifier of the user
+	"""
+	if BENCH_DB:
+		create_sqlite_db(BENCH_DB)
+	db = dbapi.DbFactory().get_db()
+	pid = 1
+	for rid in range(1, depth + 1):
+		role = Role(db)
+		role.set(role_id=rid, parent_id=rid - 1 or None)
+		role.save()
+		for i in range(objects):
+			pe = Permission(db)
+			pe.set(permission_id=pid, role_id=rid, object_id="object-%d-%d" % (rid, i))
+			pe.save()
+			pid += 1
+	pe = Permission(db)
+	pe.set(permission_id=pid, role_id=Role.ROLE_ANONYMOUS, object_id="home")
+	pe.save()
+
+	user = User(db)
+	user.set(email="bench@pysaa", password="x", status=User.STATUS_ACTIVE, role_id=depth)
+	user.save()
+	sid = DEFAULT_TENANT.sessions.create(user.id, utils.Settings().T_SESSION, db)
+	db.commit()
+	return sid
+
+
+def create_sqlite_db(path):
+	"""
+	Creates an empty SQLite database, using the schema in pysaa_sqlite.sql.
+	Tables are dropped instead of removing the file, pooled connections
+	may be open
+	"""
+	import sqlite3
+
+	schema = os.path.join(os.path.dirname(__file__), 'pysaa_sqlite.sql')
+	conn = sqlite3.connect(path)
+	tables = conn.execute("select name from sqlite_master where type='table' "
+						  "and name not like 'sqlite_%'").fetchall()
+	for (table,) in tables:
+		conn.execute("drop table %s" % table)
+	with open(schema) as f:
+		conn.executescript(f.read())
+	conn.close()
+
+
+def report(name, n, elapsed, cpu=None):
+	line = "%s: %d requests in %.3f s, %.0f req/s" % (name, n, elapsed, n / elapsed)
+	if cpu:
+		line += ", %.0f req/s per core (%.2f cpu s)" % (n / cpu, cpu)
+	print(line)
+
+
+def serve(front_end):
+	"""
+	Runs a front end server on a free port, writes "port sid" to stdout and
+	stops when stdin is closed, writing the cpu time used
+	"""
+	sid = seed()
+
+	async def main():
+		await front_end.start()
+		port = getattr(front_end, 'port', None) or front_end.address[1]
+		print(port, sid, flush=True)
+		await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+		front_end.close()
+
+	asyncio.run(main())
+	t = os.times()
+	print(t.user + t.system, flush=True)
+
+
+def serve_http():
+	from pysaa.httpserver import HttpServer
+
+	serve(HttpServer(host='127.0.0.1', port=0))
+
+
+def serve_binary():
+	from pysaa.binproto import BinaryServer
+
+	serve(BinaryServer(address=('127.0.0.1', 0)))
+
+
+def start_server(name):
+	"""
+	Starts one of the serve_* functions in a child process
+
+	Returns:
+	tuple -- child process, port and session identifier
+	"""
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+	child = subprocess.Popen([sys.executable, '-m', 'pysaa.bench', name],
+							 stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+	port, sid = child.stdout.readline().split()
+	return child, int(port), sid.decode()
+
+
+def stop_server(child):
+	"""
+	Returns:
+	float -- cpu time used by the child process
+	"""
+	child.stdin.close()
+	cpu = float(child.stdout.readline())
+	child.wait()
+	return cpu
+
+
+async def http_client(port, path, n, pipeline):
+	"""
+	Sends n requests on one connection, in batches of pipelined requests
+	"""
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	request = ("GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path).encode('latin-1')
+	sent = 0
+	while sent < n:
+		batch = min(pipeline, n - sent)
+		writer.write(request * batch)
+		for _ in range(batch):
+			length = 0
+			while True:
+				line = await reader.readline()
+				if line == b'\r\n':
+					break
+				if line.lower().startswith(b'content-length:'):
+					length = int(line.split(b':')[1])
+			await reader.readexactly(length)
+		sent += batch
+	writer.close()
+
+
+def bench_http(n=20000, connections=4, pipeline=16):
+	"""
+	Measures authorize requests/sec through the asyncio HTTP front end.
+	The server runs in a child process, in order to measure its cpu time
+	"""
+	n, connections, pipeline = int(n), int(connections), int(pipeline)
+	child, port, sid = start_server('serve_http')
+	path = "/authorize?oid=object-1-1&sid=%s" % sid
+
+	async def main():
+		per_conn = n // connections
+		await asyncio.gather(*[http_client(port, path, per_conn, pipeline)
+							   for _ in range(connections)])
+
+	start = time.time()
+	asyncio.run(main())
+	elapsed = time.time() - start
+	report("http authorize", n // connections * connections, elapsed, stop_server(child))
+
+
+def bench_binary(n=20000, pipeline=16):
+	"""
+	Measures authorize round trips through the binary protocol: latency of
+	sequential requests, then throughput with pipelined requests
+	"""
+	from pysaa.binproto import BinaryClient, TYPE_AUTHORIZE
+
+	n, pipeline = int(n), int(pipeline)
+	child, port, sid = start_server('serve_binary')
+	client = BinaryClient(('127.0.0.1', port), pool_size=1)
+
+	latencies = []
+	for _ in range(n):
+		start = time.perf_counter()
+		client.authorize(sid, "object-1-1")
+		latencies.append(time.perf_counter() - start)
+	latencies.sort()
+	print("binary authorize latency: p50 %.0f us, p99 %.0f us" %
+		  (latencies[n // 2] * 1e6, latencies[int(n * 0.99)] * 1e6))
+
+	start = time.time()
+	for _ in range(n // pipeline):
+		futures = [client.submit(TYPE_AUTHORIZE, sid, "object-1-1") for _ in range(pipeline)]
+		[f.result() for f in futures]
+	elapsed = time.time() - start
+	client.close()
+	report("binary authorize (pipelined)", n // pipeline * pipeline, elapsed)
+	stop_server(child)
+
+
+def bench_stress(users=50, n=20000, workers=16):
+	"""
+	Submits n mixed requests (authorize, anonymous authorize, refused login)
+	of many users to the worker pool at the same time. Each user has its own
+	role, granted to access only its own object, so a response computed with
+	data of another request is detected. Exits with status 1 if any response
+	is wrong
+	"""
+	from pysaa.server import PySAAServer
+
+	users, n, workers = int(users), int(n), int(workers)
+	seed(depth=1)
+	db = dbapi.DbFactory().get_db()
+	sids = []
+	for i in range(users):
+		role = Role(db)
+		role.set(role_id=100 + i, parent_id=Role.ROLE_ANONYMOUS)
+		role.save()
+		pe = Permission(db)
+		pe.set(permission_id=1000 + i, role_id=100 + i, object_id="user-%d" % i)
+		pe.save()
+		user = User(db)
+		user.set(email="user-%d@pysaa" % i, password="pwd-%d" % i,
+				 status=User.STATUS_ACTIVE, role_id=100 + i)
+		user.save()
+		sids.append(DEFAULT_TENANT.sessions.create(user.id, utils.Settings().T_SESSION, db))
+	db.commit()
+
+	server = PySAAServer(workers=workers, max_queue=n)
+	requests = []
+	for k in range(n):
+		i, j = k % users, (k * 7) % users
+		if k % 10 == 9:  # wrong password (the user may get blocked), refused
+			requests.append(({'type': 'login', 'email': "bench@pysaa", 'pwd': "pwd-%d" % j},
+							 False))
+		elif k % 10 == 8:  # anonymous user
+			requests.append(({'type': 'authorize', 'sid': '', 'oid': "user-%d" % j}, False))
+		else:
+			requests.append(({'type': 'authorize', 'sid': sids[i], 'oid': "user-%d" % j},
+							 i == j))
+
+	start = time.time()
+	futures = [server.submit(dict(request)) for request, _ in requests]
+	errors = 0
+	for (request, expected), future in zip(requests, futures):
+		response = future.result()
+		echoed = [response.get(k) == v for k, v in request.items() if k != 'pwd']
+		failed = 'error' in response and request['type'] != 'login'
+		if response.get('result') != expected or not all(echoed) or failed:
+			errors += 1
+			print("wrong response %s to request %s" % (response, request))
+	elapsed = time.time() - start
+	server.shutdown()
+	report("stress (%d workers)" % workers, n, elapsed)
+	if errors:
+		print("%d wrong responses" % errors)
+		sys.exit(1)
+	print("all responses ok")
+
+
+STARTUP = """
+import ast, sys, time
+start = time.perf_counter()
+import pysaa.settings
+pysaa.settings.DATABASE = ast.literal_eval(sys.argv[2])
+from pysaa.server import PySAAServer
+imported = time.perf_counter()
+server = PySAAServer()
+if sys.argv[1] == 'warm':
+	server.warmup()
+ready = time.perf_counter()
+server.handle_request(type='authorize', sid='', oid='home')
+first = time.perf_counter()
+server.handle_request(type='authorize', sid='', oid='home')
+second = time.perf_counter()
+print(imported - start, ready - imported, first - ready, second - first)
+"""
+
+
+def bench_startup(runs=5):
+	"""
+	Measures, in new processes, the time to import the server, to warm it
+	up and to process the first two requests, with and without warmup
+	"""
+	seed()
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+	for mode in ('cold', 'warm'):
+		times = []
+		for _ in range(int(runs)):
+			out = subprocess.check_output([sys.executable, '-c', STARTUP, mode,
+										   repr(pysaa.settings.DATABASE)], env=env)
+			times.append([float(t) * 1000 for t in out.split()])
+		avg = [sum(t) / len(times) for t in zip(*times)]
+		print("startup %s: import %.1f ms, warmup %.1f ms, first request %.2f ms, "
+			  "second request %.2f ms" % tuple([mode] + avg))
+
+
+def bench_hierarchy(depth=20, n=1000):
+	"""
+	Measures the latency of authorize requests of a user whose role is at
+	the bottom of a hierarchy, for depths 1 to depth. The object requested
+	is granted to the root role, so the whole hierarchy is read. Each
+	request reads the hierarchy from database (cold)
+	"""
+	from pysaa import server as srv
+
+	if not BENCH_DB:
+		print("the in-memory engine walks the hierarchy, set PYSAA_BENCH_DB to a file path")
+		sys.exit(1)
+	depth, n = int(depth), int(n)
+	srv.DEFAULT_TENANT.decisions = utils.DecisionCache(0)  # disabled, decisions are not cached
+	server = srv.PySAAServer()
+	db_class = dbapi.DbFactory().get_db().__class__
+	print("depth  recursive query (us)  query per level (us)")
+	for d in range(1, depth + 1):
+		sid = seed(depth=d)
+		line = "%5d" % d
+		for recursive in (True, False):
+			db_class.recursive_queries = recursive
+			start = time.perf_counter()
+			for _ in range(n):
+				response = server.handle_request(type='authorize', sid=sid, oid='object-1-0')
+			assert response['result'], response
+			line += "  %20.0f" % ((time.perf_counter() - start) / n * 1e6)
+		print(line)
+	db_class.recursive_queries = True
+
+
+def bench_decisions(n=20000, objects=50):
+	"""
+	Measures the latency of authorize requests with and without the
+	decision cache. Requests cycle over objects object ids, some of them
+	granted to the role of the user
+	"""
+	from pysaa import server as srv
+
+	n, objects = int(n), int(objects)
+	sid = seed()
+	oids = ["object-%d-%d" % (i % 4 + 1, i) for i in range(objects)]
+	cache = srv.DEFAULT_TENANT.decisions
+	server = srv.PySAAServer()
+	for name, decisions in (("cache", cache), ("no cache", utils.DecisionCache(0))):
+		srv.DEFAULT_TENANT.decisions = decisions
+		start = time.perf_counter()
+		for i in range(n):
+			server.handle_request(type='authorize', sid=sid, oid=oids[i % objects])
+		elapsed = time.perf_counter() - start
+		print("%-8s: %.1f us/request" % (name, elapsed / n * 1e6))
+	srv.DEFAULT_TENANT.decisions = cache
+	print("cache stats: %s" % cache.stats())
+
+
+def bench_eviction(n=200000, threads=8, size=64):
+	"""
+	Threads look up and store decisions for 4 * size keys on a cache of
+	size slots, so slots are evicted and reused all the time. The decision
+	of each key is known, so a decision returned for the wrong key is
+	detected. Exits with status 1 if any decision is wrong
+	"""
+	import random
+	import threading
+
+	n, threads, size = int(n), int(threads), int(size)
+	cache = utils.DecisionCache(size)
+	keys = [(role_id, "object-%d" % i) for role_id in range(4) for i in range(size)]
+	errors = []
+
+	def run(seed):
+		rnd = random.Random(seed)
+		try:
+			for _ in range(n // threads):
+				i = rnd.randrange(len(keys))
+				role_id, oid = keys[i]
+				decision = cache.get(role_id, oid)
+				expected = i % 2 == 0
+				if decision is None:
+					cache.put(role_id, oid, expected, (role_id,), cache.generation)
+				elif decision != expected:
+					errors.append((role_id, oid, decision))
+		except Exception as e:  # the cache is corrupted
+			errors.append(e)
+
+	interval = sys.getswitchinterval()
+	sys.setswitchinterval(1e-6)  # switch threads as often as possible
+	workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+	start = time.perf_counter()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	elapsed = time.perf_counter() - start
+	sys.setswitchinterval(interval)
+	report("eviction (%d threads, %d slots)" % (threads, size), n, elapsed)
+	print("cache stats: %s" % cache.stats())
+	if errors:
+		print("%d wrong decisions, e.g. %s" % (len(errors), errors[0]))
+		sys.exit(1)
+	print("all decisions ok")
+
+
+def bench_anonymous(n=20000, workers=16):
+	"""
+	Measures authorize requests without session, answered from the public
+	objects in memory and from the database, sequentially and in the worker
+	pool
+	"""
+	from pysaa import server as srv
+
+	n, workers = int(n), int(workers)
+	seed()
+	public = srv.DEFAULT_TENANT.public
+	server = srv.PySAAServer(workers=workers)
+	server.warmup()
+	for name, objects in (("memory", public), ("database", srv.PublicObjects(0))):
+		srv.DEFAULT_TENANT.public = objects
+		start = time.perf_counter()
+		for i in range(n):
+			response = server.handle_request(type='authorize', sid='', oid='home')
+		assert response['result'], response
+		sequential = (time.perf_counter() - start) / n * 1e6
+		start = time.perf_counter()
+		futures = [server.submit(dict(type='authorize', sid='', oid='home'), timeout=60)
+				   for i in range(n)]
+		assert all([f.result()['result'] for f in futures])
+		pooled = n / (time.perf_counter() - start)
+		print("%-8s: %.1f us/request, %.0f requests/s with %d workers" %
+			  (name, sequential, pooled, workers))
+	srv.DEFAULT_TENANT.public = public
+	server.shutdown()
+
+
+def bench_rows(n=10000, runs=20):
+	"""
+	Measures the time to build the entities of a large list() result, with
+	rows read as tuples and as dictionaries
+	"""
+	n, runs = int(n), int(runs)
+	seed(depth=1)
+	db = dbapi.DbFactory().get_db()
+	db.insert_many(Permission.table, Permission.table_id,
+				   [dict(permission_id=1000 + i, role_id=Role.ROLE_ANONYMOUS,
+						 object_id="bulk-%d" % i) for i in range(n)])
+	db.commit()
+	db_class = db.__class__
+	for name, tuples in (("tuples", True), ("dicts", False)):
+		db_class.tuple_results = tuples
+		best = None
+		for _ in range(runs):
+			start = time.perf_counter()
+			entities = Permission(db).list(role_id=Role.ROLE_ANONYMOUS)
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+			db.rollback()  # forget the entities loaded
+		assert len(entities) > n, len(entities)
+		print("%-6s: %d entities in %.2f ms, %.2f us/entity" %
+			  (name, len(entities), best * 1000, best / len(entities) * 1e6))
+	db_class.tuple_results = True
+
+
+def bench_refresh(n=2000, workers=16):
+	"""
+	Submits n concurrent authorize requests with the same sid, which is
+	about to expire, and counts the requests failed and the writes on the
+	session store. Then, sends a second burst with the sids returned by the
+	first one. Runs in rotate mode without grace period (the sid is rotated
+	and the old one is invalid at once), rotate mode with grace period and
+	sliding mode
+	"""
+	from pysaa import server
+
+	n, workers = int(n), int(workers)
+	seed()
+	db = dbapi.DbFactory().get_db()
+	user_id = User(db).list(email="bench@pysaa")[0].id
+	settings = server.settings
+	store = server.DEFAULT_TENANT.sessions
+	writes = []
+	for method in ('insert', 'update', 'delete'):
+		def counted(*args, _method=getattr(store, method)):
+			writes.append(1)
+			return _method(*args)
+		setattr(store, method, counted)
+
+	for mode, grace in (('rotate', 0), ('rotate', settings.T_SESSION_GRACE), ('sliding', 0)):
+		settings.SESSION_REFRESH = mode
+		settings.T_SESSION_GRACE = grace
+		sid = store.create(user_id, settings.T_REFRESH - 1, db)
+		db.commit()
+		del writes[:]
+		pool = server.PySAAServer(workers=workers, max_queue=n)
+		failed = 0
+		sids = [sid] * n
+		for burst in range(2):
+			futures = [pool.submit({'type': 'authorize', 'sid': s, 'oid': "object-1-1"})
+					   for s in sids]
+			responses = [f.result() for f in futures]
+			failed += len([r for r in responses if not r['result']])
+			sids = [r['sid'] for r in responses]
+		pool.shutdown()
+		print("%s (grace %d s): %d requests, %d failed, %d session writes, %d sids" %
+			  (mode, grace, 2 * n, failed, len(writes), len(set(sids))))
+
+
+def bench_invalidation(transport='UnixSocketTransport', n=2000):
+	"""
+	Measures the time from the publication of an event in a node until it's
+	delivered in another node. Both nodes run in this process, each one
+	with its own bus and sockets
+	"""
+	import threading
+	from pysaa import invalidation
+
+	n = int(n)
+	cls = getattr(invalidation, transport)
+	sender = invalidation.InvalidationBus(cls())
+	receiver = invalidation.InvalidationBus(cls())
+	received = threading.Event()
+	latencies = []
+
+	def delivered(event):
+		latencies.append(time.perf_counter() - event.values['sent'])
+		received.set()
+
+	receiver.subscribe('User', delivered)
+	lost = 0
+	for i in range(n):
+		received.clear()
+		sender.publish([invalidation.Event('User', i, 'update', {'sent': time.perf_counter()})])
+		if not received.wait(1):
+			lost += 1
+	sender.close()
+	receiver.close()
+	latencies.sort()
+	print("%s: %d events, %d lost, latency p50 %.0f us, p99 %.0f us" %
+		  (transport, n, lost, latencies[len(latencies) // 2] * 1e6,
+		   latencies[int(len(latencies) * 0.99)] * 1e6))
+
+
+def bench_provision(n=20000, batch=1000):
+	"""
+	Registers n new users from a CSV file with the bulk provisioning
+	"""
+	import tempfile
+	from pysaa.provisioning import Provisioner
+
+	n, batch = int(n), int(batch)
+	seed()
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, "users.csv")
+		prefix = utils.random_string(8)
+		with open(path, 'w') as f:
+			f.write("email,pwd\n")
+			f.writelines("%s%d@bench.tt,%032x\n" % (prefix, i, i) for i in range(n))
+		start = time.perf_counter()
+		stats = Provisioner(batch, mail=False).run(path)
+		elapsed = time.perf_counter() - start
+	print("provision: %d users registered in %.2f s, %.0f users/s (batch %d)" %
+		  (stats['registered'], elapsed, stats['registered'] / elapsed, batch))
+
+
+def bench_overload(n=2000, workers=8, delay=20):
+	"""
+	Submits a burst of n requests at once, 4 registrations for each authorize,
+	while each database write takes delay ms. Reports the authorize latency
+	and the requests refused with the admission control of the settings (the
+	suggested limits if it's off) and without admission control
+	"""
+	from pysaa.admission import AdmissionController
+	from pysaa.server import PySAAServer
+
+	n, workers, delay = int(n), int(workers), float(delay) / 1000
+	sid = seed()
+	utils.send_mail = lambda user, aid: None  # activation mails are not sent
+	db_class = dbapi.DbFactory().get_db().__class__
+	insert = db_class.insert
+
+	def slow_insert(self, table, key, values):
+		time.sleep(delay)
+		return insert(self, table, key, values)
+
+	db_class.insert = slow_insert
+	controllers = (("admission", AdmissionController(*ADMISSION)),
+				   ("no limits", AdmissionController()))
+	prefix = utils.random_string(8)
+	try:
+		for name, admission in controllers:
+			server = PySAAServer(workers=workers, max_queue=n)
+			server.admission = admission
+			server.warmup()
+			futures = []
+			for k in range(n):
+				if k % 5 == 4:
+					request = dict(type='authorize', sid=sid, oid="object-3-0")
+				else:
+					request = dict(type='register', email="%s-%s-%d@bench.tt" % (prefix, name[0], k),
+								   pwd="x")
+				futures.append((request['type'], time.perf_counter(), server.submit(request)))
+			latencies, refused = [], 0
+			for type, submitted, future in futures:
+				response = future.result()
+				if response.get('busy'):
+					refused += 1
+					continue
+				if type == 'authorize':
+					assert response['result'], response
+					latencies.append(time.perf_counter() - submitted)
+			server.shutdown()
+			latencies.sort()
+			stats = admission.stats()
+			print("%-9s: authorize p50 %.1f ms, p99 %.1f ms, %d of %d authorize answered; "
+				  "refused %d (by type %s, expired in the queue %d)" %
+				  (name, latencies[len(latencies) // 2] * 1000,
+				   latencies[int(len(latencies) * 0.99)] * 1000, len(latencies), n // 5,
+				   refused, stats['shed'], stats['expired']))
+	finally:
+		db_class.insert = insert
+
+
+def use_engine(class_name):
+	"""
+	Switches the Db class of the benchmark, closing the pooled connections
+	"""
+	factory = dbapi.DbFactory._instance
+	if factory is not None:
+		for conn in factory._pool:
+			conn.close()
+	dbapi.DbFactory._instance = None
+	utils.Settings().DATABASE = dict(pysaa.settings.DATABASE, **{'class': class_name})
+
+
+def bench_sqlite(n=5000, threads=8):
+	"""
+	Compares SQLiteDb (rollback journal, transactions in the threads of the
+	requests) with SQLiteWalDb (WAL, single writer thread): authorize
+	requests read from the database (decision cache disabled) with 1, 2,
+	4... threads workers, then n logins and n logouts with threads workers,
+	and n logins along with registrations whose mails take 50 ms
+	"""
+	from pysaa import server as srv
+
+	if not BENCH_DB:
+		print("set PYSAA_BENCH_DB to a file path")
+		sys.exit(1)
+	n, threads = int(n), int(threads)
+	srv.DEFAULT_TENANT.decisions = utils.DecisionCache(0)  # disabled, read from database
+	for class_name in ('SQLiteDb', 'SQLiteWalDb'):
+		use_engine(class_name)
+		if os.path.exists(BENCH_DB + "-wal"):  # WAL mode is kept in the file
+			for suffix in ("", "-wal", "-shm"):
+				if os.path.exists(BENCH_DB + suffix):
+					os.remove(BENCH_DB + suffix)
+		sid = seed()
+		line = "%-11s authorize req/s:" % class_name
+		workers = 1
+		while workers <= threads:
+			server = srv.PySAAServer(workers=workers, max_queue=n)
+			server.warmup()
+			start = time.perf_counter()
+			futures = [server.submit(dict(type='authorize', sid=sid, oid='object-1-0'))
+					   for _ in range(n)]
+			assert all([f.result()['result'] for f in futures])
+			line += " %d workers %.0f," % (workers, n / (time.perf_counter() - start))
+			server.shutdown()
+			workers *= 2
+		print(line.rstrip(','))
+
+		server = srv.PySAAServer(workers=threads, max_queue=n)
+		server.warmup()
+		start = time.perf_counter()
+		futures = [server.submit(dict(type='login', email='bench@pysaa', pwd='x'))
+				   for _ in range(n)]
+		sids = [f.result()['sid'] for f in futures]
+		futures = [server.submit(dict(type='logout', sid=sid)) for sid in sids]
+		assert all([f.result()['result'] for f in futures])
+		elapsed = time.perf_counter() - start
+		server.shutdown()
+		line = "%-11s login/logout: %d transactions in %.2f s, %.0f/s" % \
+			   (class_name, 2 * n, elapsed, 2 * n / elapsed)
+		writer = dbapi.DbFactory().get_writer()
+		if writer is not None:
+			line += ", %.1f transactions per commit" % (writer.transactions / writer.batches)
+		print(line)
+
+		# the activation mails are sent after the commit: a slow mail server
+		# must not hold the writer thread (nor a connection) of the logins
+		registrations = max(1, n // 50)
+		send_mail = utils.send_mail
+		utils.send_mail = lambda user, aid: time.sleep(0.05)
+		server = srv.PySAAServer(workers=threads, max_queue=n + registrations)
+		server.warmup()
+		start = time.perf_counter()
+		futures = []
+		for k in range(n):
+			if k % 50 == 0:
+				futures.append(server.submit(dict(type='register', email="mail-%d@bench.tt" % k,
+												  pwd='x')))
+			futures.append(server.submit(dict(type='login', email='bench@pysaa', pwd='x')))
+		assert all([f.result()['result'] for f in futures])
+		elapsed = time.perf_counter() - start
+		server.shutdown()
+		utils.send_mail = send_mail
+		print("%-11s login: %d logins and %d registrations (mail 50 ms) in %.2f s, %.0f logins/s" %
+			  (class_name, n, registrations, elapsed, n / elapsed))
+
+
+def bench_tenants(tenants=1000, size=100, n=20000, workers=8):
+	"""
+	Sends n anonymous authorize requests to a multi-tenant server, each
+	tenant with its own SQLite database. 80% of the requests go to size / 2
+	hot tenants, the rest to any tenant, so tenants are opened and closed
+	all the time. Reports the throughput, the tenants opened and closed and
+	the file descriptors open at the end
+	"""
+	import random
+	import sqlite3
+	import tempfile
+	from pysaa.server import PySAAServer
+
+	tenants, size, n, workers = int(tenants), int(size), int(n), int(workers)
+	settings = utils.Settings()
+	with tempfile.TemporaryDirectory() as directory:
+		for i in range(tenants):
+			path = os.path.join(directory, "t%d.db" % i)
+			create_sqlite_db(path)
+			conn = sqlite3.connect(path)
+			conn.execute("insert into roles (role_id) values (%d)" % Role.ROLE_ANONYMOUS)
+			conn.execute("insert into permissions (permission_id, role_id, object_id) "
+						 "values (1, %d, 'home')" % Role.ROLE_ANONYMOUS)
+			conn.commit()
+			conn.close()
+		settings.TENANT_DATABASE = {'class': 'SQLiteWalDb',
+									'config': {'database': os.path.join(directory, "{tenant}.db")}}
+		settings.MAX_TENANTS = size
+		server = PySAAServer(workers=workers, max_queue=n)
+		server.warmup()
+		rnd = random.Random(0)
+		keys = ["t%d" % (rnd.randrange(size // 2) if rnd.random() < 0.8 else rnd.randrange(tenants))
+				for _ in range(n)]
+		start = time.perf_counter()
+		futures = [server.submit(dict(type='authorize', sid='', oid='home', tenant=key))
+				   for key in keys]
+		assert all([f.result()['result'] for f in futures])
+		elapsed = time.perf_counter() - start
+		server.shutdown()
+		stats = server.tenants.stats()
+		report("tenants (%d tenants, %d open at most)" % (tenants, size), n, elapsed)
+		print("tenants open %(open)d, opened %(opened)d, closed %(closed)d" % stats +
+			  ", %d file descriptors open" % len(os.listdir('/proc/self/fd')))
+		settings.TENANT_DATABASE = None
+
+
+def bench_tokens(n=100000, lookups=20000):
+	"""
+	Compares the activation ids stored as they are sent (64 characters)
+	with their SHA-256 digests (32 bytes): size of a SQLite file with n
+	activations and their unique index, and latency of the lookups by id,
+	including the digest of the id
+	"""
+	import random
+	import sqlite3
+	import tempfile
+
+	n, lookups = int(n), int(lookups)
+	aids = utils.random_strings(n, 64)
+	sample = random.Random(0).sample(aids, min(lookups, n))
+	with tempfile.TemporaryDirectory() as directory:
+		for name, column, key in (("ids", "char(64)", lambda aid: aid),
+								  ("digests", "blob", utils.token_digest)):
+			path = os.path.join(directory, name + ".db")
+			conn = sqlite3.connect(path)
+			conn.execute("create table activations (user_id integer primary key, "
+						 "activation_id %s not null, created int not null)" % column)
+			conn.execute("create unique index activations_activation_id "
+						 "on activations (activation_id)")
+			conn.executemany("insert into activations values (?, ?, 0)",
+							 [(i, key(aid)) for i, aid in enumerate(aids)])
+			conn.commit()
+			start = time.perf_counter()
+			for aid in sample:
+				row = conn.execute("select user_id from activations where activation_id=?",
+								   (key(aid),)).fetchone()
+				assert row is not None
+			elapsed = time.perf_counter() - start
+			conn.close()
+			print("%-7s: %d activations, %.1f MB, lookup %.2f us" %
+				  (name, n, os.path.getsize(path) / 1e6, elapsed / len(sample) * 1e6))
+
+
+def bench_capture(n=20000):
+	"""
+	Measures the latency of authorize requests with and without the traffic
+	capture, then captures registrations that fail with a database error
+	(the request returns False instead of a response). Exits with status 1
+	if a request isn't captured, or is captured with the wrong result, or
+	if the capture reopened hashes the values differently
+	"""
+	import json
+	import logging
+	import tempfile
+	from pysaa import server as srv
+	from pysaa.replay import Capture, read_capture
+
+	n = int(n)
+	sid = seed()
+	utils.send_mail = lambda user, aid: None  # activation mails are not sent
+	server = srv.PySAAServer()
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, "capture.jsonl")
+		for name, capture in (("no capture", None), ("capture", Capture(path))):
+			server.capture = capture
+			start = time.perf_counter()
+			for i in range(n):
+				server.handle_request(type='authorize', sid=sid, oid="object-3-0")
+			elapsed = time.perf_counter() - start
+			print("%-10s: %.1f us/request" % (name, elapsed / n * 1e6))
+
+		db_class = dbapi.DbFactory().get_db().__class__
+		insert = db_class.insert
+
+		def failed_insert(self, table, key, values):
+			raise dbapi.DbError("insert failed")
+
+		db_class.insert = failed_insert
+		logging.disable(logging.ERROR)  # the database errors are expected
+		try:
+			failed = 100
+			for i in range(failed):
+				server.handle_request(type='register', email="capture-%d@bench.tt" % i, pwd="x")
+		finally:
+			db_class.insert = insert
+			logging.disable(logging.NOTSET)
+		server.capture.close()
+		records = read_capture(path)
+		reopened = Capture(path)  # e.g. after a restart, the values get the same hashes
+		reopened.close()
+		if reopened.hash(sid) != server.capture.hash(sid):
+			print("the hashes of a capture reopened differ")
+			sys.exit(1)
+
+	errors = [record for record in records[:n] if not record['result']]
+	errors += [record for record in records[n:]
+			   if record['result'] or record['error'] != "internal error"]
+	if len(records) != n + failed or errors:
+		print("%d requests captured of %d, %d wrong, e.g. %s" %
+			  (len(records), n + failed, len(errors), json.dumps(errors[:1])))
+		sys.exit(1)
+	print("all requests captured")
+
+
+BENCHMARKS = {
+	'http': bench_http,
+	'binary': bench_binary,
+	'stress': bench_stress,
+	'startup': bench_startup,
+	'hierarchy': bench_hierarchy,
+	'refresh': bench_refresh,
+	'invalidation': bench_invalidation,
+	'provision': bench_provision,
+	'decisions': bench_decisions,
+	'eviction': bench_eviction,
+	'anonymous': bench_anonymous,
+	'rows': bench_rows,
+	'overload': bench_overload,
+	'sqlite': bench_sqlite,
+	'tenants': bench_tenants,
+	'tokens': bench_tokens,
+	'capture': bench_capture,
+	'serve_http': serve_http,
+	'serve_binary': serve_binary,
+}
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2 or not sys.argv[1] in BENCHMARKS:
+		print(__doc__)
+		sys.exit(1)
+	BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,409 @@
+"""
+binproto.py
+
+This module implements a compact binary protocol for internal callers of
+PySAA, over TCP or Unix sockets. Frames are length-prefixed and use fixed
+layout structs:
+
+request:  length(u32) request_id(u32) type(u8) sid(64 bytes) oid_length(u16) oid
+response: length(u32) request_id(u32) result(u8) error(u8) sid_length(u8)
+msg_length(u16) sid msg
+
+The sid of a response is sent only if the session has been renewed (rotate
+mode, see settings.SESSION_REFRESH): the client must use it from then on
+
+Connections are persistent and requests are multiplexed: a client can send
+many requests without waiting, and responses are matched by request_id, in
+whatever order they are completed.
+
+BinaryServer -- asyncio server, in front of a PySAAServer. Frames don't
+contain a tenant: with multi-tenant servers, each listener serves one tenant
+BinaryClient -- thread-safe client, with a pool of persistent connections
+"""
+
+import asyncio
+import functools
+import itertools
+import logging
+import socket
+import struct
+import sys
+import threading
+
+from concurrent.futures import Future
+
+from pysaa.profiling import toggle_on_signal
+from pysaa.server import PySAAServer, PySAAError, ServerBusyError, settings
+
+LENGTH = struct.Struct('!I')
+REQUEST = struct.Struct('!IB64sH')  # request id, type, sid, oid length
+RESPONSE = struct.Struct('!IBBBH')  # request id, result, error, sid length, message length
+
+# maximum length of a frame, as the body of the HTTP requests (see
+# httpserver.MAX_BODY). Longer frames are refused and the connection is
+# closed, its stream can't be followed anymore
+MAX_FRAME = 65536
+
+# request types
+TYPE_AUTHORIZE = 1
+TYPE_LOGOUT = 2
+
+TYPES = {
+	TYPE_AUTHORIZE: 'authorize',
+	TYPE_LOGOUT: 'logout',
+}
+
+# error codes
+ERROR_NONE = 0
+ERROR_REQUEST = 1  # PySAAError raised by the request, message is sent
+ERROR_INTERNAL = 2  # database error or unexpected exception
+ERROR_PROTOCOL = 3  # malformed frame or unknown request type
+ERROR_BUSY = 4  # server can't accept more requests, try later
+
+
+def encode_request(request_id, type, sid, oid):
+	"""
+	Returns:
+	bytes -- request frame
+	"""
+	oid = oid.encode('utf-8')
+	body = REQUEST.pack(request_id, type, sid.encode('ascii'), len(oid)) + oid
+	return LENGTH.pack(len(body)) + body
+
+
+def decode_request(body):
+	"""
+	Returns:
+	tuple -- request id, type, sid and oid
+	"""
+	request_id, type, sid, n = REQUEST.unpack_from(body)
+	oid = body[REQUEST.size:REQUEST.size + n].decode('utf-8')
+	return request_id, type, sid.rstrip(b'\0').decode('ascii'), oid
+
+
+def encode_response(request_id, result, error=ERROR_NONE, message='', sid=''):
+	"""
+	Arguments:
+	sid(str) -- new session identifier, empty if the session was not renewed
+
+	Returns:
+	bytes -- response frame
+	"""
+	message = message.encode('utf-8')
+	sid = sid.encode('ascii')
+	body = (RESPONSE.pack(request_id, 1 if result else 0, error, len(sid), len(message)) +
+			sid + message)
+	return LENGTH.pack(len(body)) + body
+
+
+def decode_response(body):
+	"""
+	Returns:
+	tuple -- request id, result, error code, error message and new session
+	identifier (empty if the session was not renewed)
+	"""
+	request_id, result, error, n_sid, n = RESPONSE.unpack_from(body)
+	start = RESPONSE.size + n_sid
+	sid = body[RESPONSE.size:start].decode('ascii')
+	message = body[start:start + n].decode('utf-8')
+	return request_id, bool(result), error, message, sid
+
+
+def process(server, body, tenant=None):
+	"""
+	Decodes a request frame, processes it and returns the response frame.
+	tenant is the tenant key of the request, for multi-tenant servers
+	"""
+	try:
+		request_id, type, sid, oid = decode_request(body)
+	except (struct.error, UnicodeError):
+		return encode_response(0, False, ERROR_PROTOCOL, "malformed request")
+	if not type in TYPES:
+		return encode_response(request_id, False, ERROR_PROTOCOL, "unknown type %d" % type)
+
+	try:
+		if tenant is None:
+			response = server.handle_request(type=TYPES[type], sid=sid, oid=oid)
+		else:
+			response = server.handle_request(type=TYPES[type], sid=sid, oid=oid, tenant=tenant)
+	except Exception as e:
+		logging.exception("error processing the request: %s" % e)
+		response = None
+
+	if not isinstance(response, dict):  # database error
+		return encode_response(request_id, False, ERROR_INTERNAL, "internal error")
+	if response.get('busy'):  # refused by the admission control
+		return encode_response(request_id, False, ERROR_BUSY, response['error'])
+	if 'error' in response:
+		return encode_response(request_id, False, ERROR_REQUEST, response['error'])
+	renewed = response.get('sid') or ''  # rotate mode: new sid
+	return encode_response(request_id, response['result'],
+						   sid=renewed if renewed != sid else '')
+
+
+class BinaryServer(object):
+	"""
+	asyncio server of the binary protocol. Requests received on a connection
+	are processed concurrently and responses are sent as soon as they are ready
+	"""
+
+	def __init__(self, server=None, address=None, tenant=None):
+		"""
+		Arguments:
+		server(PySAAServer) -- server that handles the requests, in its
+		worker pool since they block on database
+		address -- (host, port) tuple for TCP or path for a Unix socket,
+		settings.BINARY_ADDRESS by default
+		tenant(str) -- tenant key of the requests, for multi-tenant servers
+		"""
+		self.server = server or PySAAServer()
+		self.address = address or settings.BINARY_ADDRESS
+		self.tenant = tenant
+		self._listener = None
+
+	async def start(self):
+		"""
+		Starts listening for connections
+		"""
+		if isinstance(self.address, str):
+			self._listener = await asyncio.start_unix_server(
+				self._handle_connection, self.address)
+		else:
+			host, port = self.address
+			self._listener = await asyncio.start_server(
+				self._handle_connection, host, port)
+			# port may have been chosen by the system
+			self.address = self._listener.sockets[0].getsockname()[:2]
+		return self._listener
+
+	async def serve_forever(self):
+		await self.start()
+		async with self._listener:
+			await self._listener.serve_forever()
+
+	def close(self):
+		if self._listener is not None:
+			self._listener.close()
+
+	async def _handle_connection(self, reader, writer):
+		sock = writer.get_extra_info('socket')
+		if sock is not None and sock.family != socket.AF_UNIX:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		loop = asyncio.get_running_loop()
+		tasks = set()
+		try:
+			while True:
+				head = await reader.readexactly(LENGTH.size)
+				length = LENGTH.unpack(head)[0]
+				if length > MAX_FRAME:
+					writer.write(encode_response(0, False, ERROR_PROTOCOL, "frame too large"))
+					break
+				body = await reader.readexactly(length)
+				task = loop.create_task(self._process(body, writer))
+				tasks.add(task)
+				task.add_done_callback(tasks.discard)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass  # connection closed by the client
+		except asyncio.CancelledError:  # server is shutting down
+			for task in tasks:
+				task.cancel()
+			writer.close()
+			return
+		if tasks:
+			await asyncio.wait(tasks)
+		writer.close()
+
+	async def _process(self, body, writer):
+		try:
+			frame = await asyncio.wrap_future(self.server.execute(
+				functools.partial(process, self.server, body, self.tenant), timeout=0))
+		except ServerBusyError as e:  # don't wait, fail fast
+			request_id = LENGTH.unpack_from(body)[0] if len(body) >= LENGTH.size else 0
+			frame = encode_response(request_id, False, ERROR_BUSY, str(e))
+		if not writer.is_closing():
+			writer.write(frame)
+
+
+class Connection(object):
+	"""
+	Persistent client connection. Requests can be sent from any thread, a
+	receiver thread resolves the futures when the responses arrive
+	"""
+
+	def __init__(self, address):
+		if isinstance(address, str):
+			self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		else:
+			self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self._sock.connect(address)
+		self._lock = threading.Lock()
+		self._ids = itertools.count(1)
+		self._waiting = {}  # request id -> Future
+		self.closed = False
+		self._receiver = threading.Thread(target=self._receive, daemon=True,
+										  name="pysaa-binproto-client")
+		self._receiver.start()
+
+	def send(self, type, sid, oid):
+		"""
+		Sends a request without waiting for the response
+
+		Returns:
+		Future -- resolved with the result of the request
+		"""
+		future = Future()
+		future.sid = None  # new session identifier, set with the response
+		with self._lock:
+			if self.closed:
+				raise ConnectionError("connection closed")
+			request_id = next(self._ids) & 0xffffffff
+			self._waiting[request_id] = future
+			try:
+				self._sock.sendall(encode_request(request_id, type, sid, oid))
+			except OSError:
+				del self._waiting[request_id]
+				self.closed = True
+				raise
+		return future
+
+	def close(self):
+		self.closed = True
+		try:
+			self._sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self._sock.close()
+
+	def _receive(self):
+		stream = self._sock.makefile('rb')
+		try:
+			while True:
+				head = stream.read(LENGTH.size)
+				if len(head) < LENGTH.size or LENGTH.unpack(head)[0] > MAX_FRAME:
+					break
+				request_id, result, error, message, sid = decode_response(
+					stream.read(LENGTH.unpack(head)[0]))
+				with self._lock:
+					future = self._waiting.pop(request_id, None)
+				if future is None:
+					continue
+				future.sid = sid or None
+				if error == ERROR_REQUEST:
+					future.set_exception(PySAAError(message))
+				elif error == ERROR_BUSY:
+					future.set_exception(ServerBusyError(message))
+				elif error != ERROR_NONE:
+					future.set_exception(ProtocolError(message))
+				else:
+					future.set_result(result)
+		except (OSError, ValueError):
+			pass
+		finally:
+			# connection lost, fail the requests still waiting
+			with self._lock:
+				self.closed = True
+				waiting, self._waiting = self._waiting, {}
+			for future in waiting.values():
+				future.set_exception(ConnectionError("connection closed"))
+
+
+class BinaryClient(object):
+	"""
+	Client of the binary protocol, with a pool of persistent connections
+	that are used in turn. It can be shared by several threads
+	"""
+
+	def __init__(self, address=None, pool_size=None):
+		"""
+		Arguments:
+		address -- (host, port) tuple or Unix socket path,
+		settings.BINARY_ADDRESS by default
+		pool_size(int) -- number of connections, settings.BINARY_POOL_SIZE by default
+		"""
+		self.address = address or settings.BINARY_ADDRESS
+		self._pool = [None] * (pool_size or settings.BINARY_POOL_SIZE)
+		self._next = itertools.count()
+		self._lock = threading.Lock()
+
+	def connection(self):
+		"""
+		Returns:
+		Connection -- next connection of the pool, reconnecting if needed
+		"""
+		i = next(self._next) % len(self._pool)
+		conn = self._pool[i]
+		if conn is None or conn.closed:
+			with self._lock:
+				conn = self._pool[i]
+				if conn is None or conn.closed:
+					conn = self._pool[i] = Connection(self.address)
+		return conn
+
+	def submit(self, type, sid, oid=''):
+		"""
+		Sends a request, the response can be waited later (pipelining)
+
+		Returns:
+		Future -- resolved with the result (bool), or with the exception
+		(PySAAError) if the request failed. Its sid attribute is the new
+		session identifier if the session was renewed, None if not
+		"""
+		return self.connection().send(type, sid, oid)
+
+	def authorize(self, sid, oid, timeout=None):
+		"""
+		Returns:
+		bool -- True if the session (anonymous if sid is empty) can access oid
+
+		Raises:
+		PySAAError -- if the session is not valid
+		"""
+		return self.submit(TYPE_AUTHORIZE, sid, oid).result(timeout)
+
+	def authorize_session(self, sid, oid, timeout=None):
+		"""
+		As authorize, following the renewals of the session (rotate mode)
+
+		Returns:
+		tuple -- result (bool) and session identifier to be used from now
+		on: the new one if the session was renewed, sid if not
+
+		Raises:
+		PySAAError -- if the session is not valid
+		"""
+		future = self.submit(TYPE_AUTHORIZE, sid, oid)
+		result = future.result(timeout)
+		return result, future.sid or sid
+
+	def logout(self, sid, timeout=None):
+		"""
+		Raises:
+		PySAAError -- if the user is not authenticated
+		"""
+		return self.submit(TYPE_LOGOUT, sid).result(timeout)
+
+	def close(self):
+		for conn in self._pool:
+			if conn is not None:
+				conn.close()
+
+
+class ProtocolError(PySAAError):
+	"""
+	Exception raised when the server can't process a request
+	"""
+
+
+if __name__ == "__main__":
+	logging.basicConfig(filename='pysaa.log', level=logging.DEBUG)
+	address = sys.argv[1] if len(sys.argv) > 1 else None
+	if address and ':' in address:  # host:port
+		host, port = address.rsplit(':', 1)
+		address = (host, int(port))
+	binary_server = BinaryServer(address=address)
+	toggle_on_signal(binary_server.server.profiler)  # kill -USR2 <pid>
+	try:
+		asyncio.run(binary_server.serve_forever())
+	except KeyboardInterrupt:
+		pass
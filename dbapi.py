@@ -3,12 +3,37 @@ dbapi.py
 
 This module provides a database access API, hiding database
 specific implementation details
+
+Db classes are storage engines: model entities are read and written through
+the methods select, insert, update and delete. Db implements them with SQL
+statements, MemoryDb keeps the tables in memory
 """
 
 import importlib
 import logging
+import queue
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
 
 from pysaa.utils import Settings
+from pysaa.invalidation import get_bus
+
+# statements slower than settings.SLOW_QUERY are logged here
+slow_log = logging.getLogger("pysaa.slow_queries")
+
+# maximum number of values of the "in" lists of select_in, and of the
+# parameters of the multi-row inserts of insert_many
+IN_CHUNK = 500
+
+# values of these columns are not written to the logs
+REDACTED_COLUMNS = ('password', 'session_id', 'activation_id', 'email')
+
+# column of a statement parameter: _email, _email_3 -> email
+PARAM_COLUMN = re.compile(r"_*(.*?)(?:_\d+)?$")
 
 
 def dbconn(in_trx=False):
@@ -23,23 +48,42 @@ def dbconn(in_trx=False):
 
 	def _dbconn(func):
 		def _dbconn_(self, *args, **kw):
-			db = DbFactory().get_db()
+			# objects with a factory attribute use it, e.g. the requests of a tenant
+			factory = getattr(self, 'factory', None) or DbFactory()
+			writer = factory.get_writer() if in_trx else None
+			if writer is not None:  # the transaction is run by the writer thread
+				start = time.perf_counter()
+				try:
+					return writer.execute(self, func, args, kw)
+				finally:
+					self.db_time = time.perf_counter() - start
+
+			db = factory.get_db()
+			db.context = type(self).__name__  # reported in the slow query log
 			self.db = db
+			start = time.perf_counter()
 			if in_trx:  # Don't allow nested transactions
 				db.rollback()  # rollback previous transactions
 
+			failed = False
 			try:
 				ret = func(self, db, *args, **kw)
 				db.commit()
 			except DbError as e:
-				print(e)
-				logging.exception("database error: ", e)
-				if in_trx:
-					db.rollback()
+				logging.exception("database error: %s", e)
+				# rollback also outside transactions, the connection is reused
+				db.rollback()
+				failed = True
 				ret = False
+			except Exception:
+				db.rollback()  # discard changes, error is handled by the caller
+				raise
 			finally:
 				db.close_cursor()
-				db.close_connection()
+				# don't reuse the connection if there was a database error
+				db.close_connection(discard=failed)
+				# time holding the connection, used by the admission control
+				self.db_time = time.perf_counter() - start
 			return ret
 
 		return _dbconn_
@@ -65,26 +109,63 @@ def get_class(class_name):
 class DbFactory(object):
 	"""
 	Factory object, creates instances of Db objects on demand
+	Keeps a pool of idle connections, which are reused by the Db objects
+
+	DbFactory() returns the factory of settings.DATABASE, shared by the
+	whole process. Multi-tenant servers create a factory for the database
+	of each tenant with DbFactory.create
 	"""
 
 	_instance = None
+	_lock = threading.Lock()  # the instance is created only once
 
 	def __new__(cls):
-		if DbFactory._instance is None:
+		if DbFactory._instance is not None:
+			return DbFactory._instance
+
+		with DbFactory._lock:
+			if DbFactory._instance is not None:  # created by another thread
+				return DbFactory._instance
 			settings = Settings()
 			if len(settings.DATABASE) == 0:
 				raise DbError("database settings not found")
-			# create DbFactory instance
-			DbFactory._instance = object.__new__(cls)
-			#get database settings
-			DbFactory._instance._config = settings.DATABASE['config']
-			#get concrete Db class to be created
-			DbFactory._instance._db_class = get_class(settings.DATABASE['class'])
-			#import db module
-			DbFactory._instance.get_db_module
+			instance = cls.create(settings.DATABASE, settings.DB_POOL_SIZE)
+			# publish the instance only when it's completely initialized
+			DbFactory._instance = instance
 
 		return DbFactory._instance
 
+	@classmethod
+	def create(cls, database, pool_size, tenant=None):
+		"""
+		Creates a factory of its own, not shared
+
+		Arguments:
+		database(dict) -- database settings, as settings.DATABASE
+		pool_size(int) -- maximum number of idle connections kept
+		tenant(str) -- tenant key, sent with the invalidation events of
+		the transactions committed (see Db.publish_events)
+
+		Returns:
+		DbFactory -- the new factory
+		"""
+		instance = object.__new__(cls)
+		#get database settings
+		instance._config = database['config']
+		#get concrete Db class to be created
+		instance._db_class = get_class(database['class'])
+		if instance._db_class is None:
+			raise DbError("unknown database class '%s'" % database['class'])
+		#import db module
+		instance.get_db_module
+		#pool of idle connections
+		instance._pool = []
+		instance._pool_size = pool_size
+		instance._pool_lock = threading.Lock()
+		instance._writer = None  # see get_writer
+		instance.tenant = tenant
+		return instance
+
 	def get_db(self):
 		"""
 		Create new instance of DB adapter class
@@ -97,6 +178,8 @@ class DbFactory(object):
 			db = self._db_class(**self._config)
 			#set reference to db module
 			db._db = self._db_module
+			db._factory = self
+			db.tenant = self.tenant
 		except Exception as e:
 			raise DbError("Could not create class '%s': %s" %
 			              (self._db_class, e))
@@ -104,6 +187,72 @@ class DbFactory(object):
 
 		return db
 
+	def acquire(self):
+		"""
+		Returns:
+		Connection -- an idle connection taken from the pool
+		None -- if the pool is empty
+		"""
+		with self._pool_lock:
+			if self._pool:
+				return self._pool.pop()
+		return None
+
+	def release(self, conn):
+		"""
+		Puts a connection back in the pool, if the pool is not full
+		
+		Returns:
+		bool -- True if the connection has been kept, False if the caller 
+		must close it
+		"""
+		with self._pool_lock:
+			if len(self._pool) < self._pool_size:
+				self._pool.append(conn)
+				return True
+		return False
+
+	def get_writer(self):
+		"""
+		Returns:
+		SQLiteWriter -- thread that runs the transactions, started the first
+		time, if the Db class has a single writer (see SQLiteWalDb)
+		None -- if transactions are run by the threads of the requests
+		"""
+		if not self._db_class.single_writer:
+			return None
+		if self._writer is None:
+			with self._pool_lock:
+				if self._writer is None:
+					self._writer = SQLiteWriter(self)
+		return self._writer
+
+	def fill_pool(self):
+		"""
+		Opens connections until the pool is full, so that the first requests
+		don't pay the cost of connecting. Starts the writer thread, if any
+		"""
+		dbs = [self.get_db() for _ in range(self._pool_size - len(self._pool))]
+		for db in dbs:
+			db.get_connection()
+		for db in dbs:
+			db.close_connection()  # back to the pool
+		self.get_writer()
+
+	def close(self):
+		"""
+		Closes the pooled connections and stops the writer thread, if any.
+		Connections in use are closed when they are released
+		"""
+		with self._pool_lock:
+			pool, self._pool = self._pool, []
+			self._pool_size = 0  # connections released are not kept
+			writer, self._writer = self._writer, None
+		for conn in pool:
+			conn.close()
+		if writer is not None:
+			writer.stop()
+
 	@property
 	def get_db_module(self):
 		"""
@@ -115,6 +264,10 @@ class DbFactory(object):
 		None -- if the module could not be imported
 		"""
 
+		if self._db_class._module is None:  # engine without db module
+			self._db_module = None
+			return self._db_module
+
 		try:
 			self._db_module = importlib.import_module(self._db_class._module)
 		except ImportError as e:
@@ -131,14 +284,30 @@ class Db(object):
 	using Python DB API 2.0
 	"""
 
+	recursive_queries = True  # set to False if the engine rejects WITH RECURSIVE
+	tuple_results = True  # the model reads rows as tuples, see select_tuples
+	single_writer = False  # transactions are run by a writer thread, see SQLiteWriter
+
 	def __init__(self, **kw):
 		"""
 		init db class and create connection
 		"""
 		self._conn = None  # connection object
 		self._cursor = None  # cursor object
+		self._tuple_cursor = None  # cursor returning rows as tuples
 		self._config = kw  # database connection settings
 		self._cursor_class = None  # cursor class
+		self._factory = None  # DbFactory, provides pooled connections
+		self.identity_map = {}  # (entity class, id) -> entity loaded
+		self._pending = OrderedDict()  # entity writes waiting for commit
+		self._events = []  # invalidation events, published after commit
+		self.context = None  # name of the caller, e.g. the request class
+		self.tenant = None  # tenant key of the invalidation events, set by DbFactory
+		settings = Settings()
+		self.slow_query = settings.SLOW_QUERY  # seconds, None: not logged
+		self.explain_slow = settings.SLOW_QUERY_EXPLAIN
+		self.scan_tables = settings.SLOW_QUERY_TABLES
+		self.use_cte = settings.RECURSIVE_QUERIES  # see select_hierarchy
 
 	def get_connection(self):
 		"""
@@ -149,17 +318,35 @@ class Db(object):
 		Connection -- the connection to database. 
 		"""
 		if self._conn is None:
-			self._conn = self._db.connect(**self._config)
+			if self._factory is not None:
+				self._conn = self._factory.acquire()
+			if self._conn is None:
+				self._conn = self.connect()
 			# alias to access database specific errors (DB API 2.0)
 			self.exceptions = self._conn
 		return self._conn
 
-	def close_connection(self):
+	def connect(self):
+		"""
+		Opens a new connection, with the settings of the database
+		
+		Returns:
+		Connection -- the connection opened
+		"""
+		return self._db.connect(**self._config)
+
+	def close_connection(self, discard=False):
 		"""
-		Closes current database connection if it exists
+		Releases current database connection if it exists. The connection
+		goes back to the pool, or it's closed if the pool is full
+		
+		Arguments:
+		discard(bool) -- if True, the connection is closed anyway
 		"""
-		self._conn.close()
-		self._conn = None
+		if self._conn is not None:
+			if discard or self._factory is None or not self._factory.release(self._conn):
+				self._conn.close()
+			self._conn = None
 
 	def get_cursor(self):
 		"""
@@ -172,14 +359,30 @@ class Db(object):
 			self._cursor = self.get_connection().cursor(self._cursor_class)
 		return self._cursor
 
+	def get_tuple_cursor(self):
+		"""
+		Returns a cursor that returns the rows as tuples, the default
+		cursor class of the db module. Kept as the other cursor
+		
+		Returns:
+		Cursor -- a database cursor
+		"""
+		if self._tuple_cursor is None:
+			self._tuple_cursor = self.get_connection().cursor()
+		return self._tuple_cursor
+
 	def close_cursor(self):
 		"""
-		Closes cursor, if it exists and it's still open
+		Closes cursors, if they exist and they're still open
 		"""
-		self._cursor.close()
-		self._cursor = None
+		if self._cursor is not None:
+			self._cursor.close()
+			self._cursor = None
+		if self._tuple_cursor is not None:
+			self._tuple_cursor.close()
+			self._tuple_cursor = None
 
-	def execute_sql(self, sql, *args):
+	def execute_sql(self, sql, *args, cursor=None):
 		"""
 		Executes sql statement
 		
@@ -187,13 +390,364 @@ class Db(object):
 		sql(string) -- the sql statement to be executed
 		args (dict or list) -- args contains the replacement values, 
 		if sql statement is a prepared statement
+		cursor(Cursor) -- cursor used, the one of get_cursor by default
 		"""
 		try:
-			self.get_cursor()
-			self._cursor.execute(sql, *args)
+			cursor = cursor or self.get_cursor()
+			if self.slow_query is None:
+				cursor.execute(sql, *args)
+				return
+			start = time.perf_counter()
+			cursor.execute(sql, *args)
+			elapsed = time.perf_counter() - start
 		except self.exceptions.Error as e:
-			logging.debug("sql: ", sql)
-			raise DbError("Error executing sql statement: %s" % sql)(e)
+			logging.error("error executing sql: %s, args: %s, caller: %s",
+						  sql, redact(*args), self.context)
+			raise DbError("Error executing sql statement: %s: %s" % (sql, e)) from e
+		if elapsed >= self.slow_query:
+			self.log_slow_query(sql, args[0] if args else None, elapsed)
+
+	def log_slow_query(self, sql, args, elapsed):
+		"""
+		Writes a slow statement to the slow query log, with its query plan
+		if settings.SLOW_QUERY_EXPLAIN is set. Full scans of the tables in
+		settings.SLOW_QUERY_TABLES are reported as warnings
+		
+		Arguments:
+		sql(string) -- the sql statement executed
+		args(dict) -- replacement values, written redacted
+		elapsed(float) -- seconds taken by the statement
+		"""
+		slow_log.info("%.1f ms, caller: %s, sql: %s, args: %s",
+					  elapsed * 1000, self.context, sql, redact(args))
+		if not self.explain_slow or sql.lstrip()[:6].lower() == "insert":
+			return
+		try:
+			plan = self.explain(sql, args)
+		except Exception as e:  # the plan is not essential, don't fail
+			slow_log.info("could not explain the statement: %s", e)
+			return
+		slow_log.info("plan: %s", plan)
+		for table in self.find_full_scans(plan):
+			if table in self.scan_tables:
+				slow_log.warning("full scan of table %s, missing index? sql: %s", table, sql)
+
+	def explain(self, sql, args=None):
+		"""
+		Returns:
+		list -- query plan of the statement, as returned by EXPLAIN
+		"""
+		cursor = self.get_connection().cursor(self._cursor_class)
+		try:
+			cursor.execute("explain " + sql, args)
+			return [dict(row) for row in cursor.fetchall()]
+		finally:
+			cursor.close()
+
+	def find_full_scans(self, plan):
+		"""
+		Arguments:
+		plan(list) -- query plan, as returned by explain
+		
+		Returns:
+		list -- tables read with a full scan
+		"""
+		return [row.get('table') for row in plan if row.get('type') == 'ALL']
+
+	def param(self, name):
+		"""
+		Returns:
+		str -- placeholder for the named parameter, in the db module paramstyle
+		"""
+		return "%%(%s)s" % name
+
+	def select(self, table, criteria, columns=None, order=None, sort=None):
+		"""
+		Reads rows from a table
+		
+		Arguments:
+		table(str) -- table name
+		criteria(dict) -- column:value pairs, rows must match all of them
+		columns(list) -- columns being read, all columns if not specified
+		order(str) -- sort the result by this column
+		sort(str) -- 'asc' ascending or 'desc' descending order (default)
+		
+		Returns:
+		list -- rows found, as dictionaries
+		"""
+		self.execute_sql(self.select_sql(table, criteria, columns, order, sort), criteria)
+		return self.get_result()
+
+	def select_tuples(self, table, criteria, columns=None, order=None, sort=None):
+		"""
+		Reads rows from a table as tuples, same arguments as select. Saves
+		the creation of a dictionary (or a row object) per row, the column
+		names are read once from the cursor description
+		
+		Returns:
+		tuple -- column names (tuple), rows found (list of tuples)
+		"""
+		cursor = self.get_tuple_cursor()
+		self.execute_sql(self.select_sql(table, criteria, columns, order, sort), criteria,
+						 cursor=cursor)
+		names = tuple([d[0] for d in cursor.description])
+		return names, cursor.fetchall()
+
+	def select_sql(self, table, criteria, columns=None, order=None, sort=None):
+		"""
+		Returns:
+		str -- select statement, see select
+		"""
+		fields = ", ".join(columns) if columns else "*"
+		sql = "select %s from %s" % (fields, table)
+		if criteria:
+			# column_1=%(column_1)s and column_2=%(column_2)s...
+			sql += " where " + " and ".join(
+				["%s=%s" % (k, self.param(k)) for k in criteria])
+		if not order is None:
+			if sort is None or sort.lower() != "asc":
+				sort = "desc"
+			sql += " order by %s %s" % (order, sort)
+		return sql
+
+	def select_in(self, table, column, values, columns=None):
+		"""
+		Reads the rows whose column value is any of the values given
+		
+		Arguments:
+		table(str) -- table name
+		column(str) -- column compared
+		values(list) -- values searched
+		columns(list) -- columns being read, all columns if not specified
+		
+		Returns:
+		list -- rows found, as dictionaries
+		"""
+		fields = ", ".join(columns) if columns else "*"
+		rows = []
+		# databases limit the number of parameters of a statement
+		for i in range(0, len(values), IN_CHUNK):
+			# parameters named after the column, see redact
+			args = dict([("_%s_%d" % (column, j), v) for j, v in enumerate(values[i:i + IN_CHUNK])])
+			sql = "select %s from %s where %s in (%s)" % (
+				fields, table, column, ", ".join([self.param(k) for k in args]))
+			self.execute_sql(sql, args)
+			rows.extend([dict(row) for row in self.get_result()])
+		return rows
+
+	def select_hierarchy(self, table, key, parent, id, child_table, columns):
+		"""
+		Reads the rows of child_table that reference a row of a hierarchy
+		or any of its ancestors, e.g. the permissions of a role and of its
+		parent roles. If the engine supports recursive queries (WITH 
+		RECURSIVE, SQLite >= 3.8.3, MySQL >= 8.0) the whole chain is read
+		in a single query. If not, the chain is walked with one query per level
+		
+		Arguments:
+		table(str) -- table containing the hierarchy
+		key(str) -- primary key column of table, child_table references
+		the hierarchy through a column with the same name
+		parent(str) -- column of table referencing the parent row
+		id -- primary key value of the first row of the chain
+		child_table(str) -- table being read
+		columns(list) -- columns of child_table being read
+		
+		Returns:
+		list -- rows found, as dictionaries
+		"""
+		if self.use_cte and type(self).recursive_queries:
+			try:
+				return self.select_hierarchy_cte(table, key, parent, id, child_table, columns)
+			except DbError as e:
+				# other errors (lock timeout, connection lost) are not
+				# related to the query, the walk would fail as well
+				if not self.is_unsupported(e):
+					raise
+				# remember it, don't try again in this process
+				logging.warning("recursive queries not supported, walking the hierarchy: %s", e)
+				type(self).recursive_queries = False
+
+		rows = []
+		visited = set()  # don't loop if the hierarchy has a cycle
+		while id is not None and id not in visited:
+			visited.add(id)
+			rows.extend(self.select(child_table, {key: id}, columns))
+			parents = self.select(table, {key: id}, (parent,))
+			id = parents[0][parent] if parents else None
+		return rows
+
+	def is_unsupported(self, error):
+		"""
+		Arguments:
+		error(DbError) -- error raised by execute_sql
+		
+		Returns:
+		bool -- True if the statement is not supported by the engine: the
+		database module raised NotSupportedError, or reported a syntax error
+		(SQLite and MySQL report unknown syntax this way)
+		"""
+		cause = error.__cause__
+		if cause is None:
+			return False
+		if isinstance(cause, getattr(self.exceptions, 'NotSupportedError', ())):
+			return True
+		return 'syntax' in str(cause).lower()
+
+	def select_hierarchy_cte(self, table, key, parent, id, child_table, columns):
+		"""
+		Implements select_hierarchy with a recursive query. UNION (not UNION
+		ALL) discards the rows already found, so a cycle ends the recursion
+		"""
+		sql = ("with recursive ancestors(id) as ("
+			   "select %(id)s union "
+			   "select t.%(parent)s from %(table)s t join ancestors a on t.%(key)s = a.id "
+			   "where t.%(parent)s is not null) "
+			   "select %(columns)s from %(child)s c join ancestors a on c.%(key)s = a.id" %
+			   {'id': self.param('_id'), 'parent': parent, 'table': table, 'key': key,
+				'child': child_table, 'columns': ", ".join(["c." + k for k in columns])})
+		self.execute_sql(sql, {'_id': id})
+		return [dict(row) for row in self.get_result()]
+
+	def insert(self, table, key, values):
+		"""
+		Inserts a row in a table
+		
+		Arguments:
+		table(str) -- table name
+		key(str) -- primary key column. If its value is not given, it's
+		generated by the database
+		values(dict) -- column:value pairs being inserted
+		
+		Returns:
+		id of the row inserted
+		"""
+		cols = ", ".join(values)  # column_1, column_2,...column_n
+		nvals = ", ".join([self.param(k) for k in values])
+		sql = "insert into %s (%s) values(%s)" % (table, cols, nvals)
+		self.execute_sql(sql, values)
+		if values.get(key) is not None:
+			return values[key]
+		return self.get_lastrowid()
+
+	def insert_many(self, table, key, rows, unique=None):
+		"""
+		Inserts many rows in a table. If all the rows have the primary key
+		value, a single statement is executed for all of them (executemany).
+		If the ids are generated by the database, the rows are inserted by
+		multi-row statements when a column with unique values is given (see
+		insert_values), or one by one otherwise
+		
+		Arguments:
+		table(str) -- table name
+		key(str) -- primary key column
+		rows(list) -- dictionaries of column:value pairs, all of them with
+		the same columns
+		unique(str) -- column with a unique index, used to read the ids
+		generated by the database
+		
+		Returns:
+		list -- ids of the rows inserted
+		"""
+		if not rows:
+			return []
+		if any([row.get(key) is None for row in rows]):
+			if unique is not None:
+				return self.insert_values(table, key, rows, unique)
+			# ids generated by the database, they are read one by one
+			return [self.insert(table, key, row) for row in rows]
+
+		cols = ", ".join(rows[0])
+		nvals = ", ".join([self.param(k) for k in rows[0]])
+		sql = "insert into %s (%s) values(%s)" % (table, cols, nvals)
+		try:
+			self.get_cursor().executemany(sql, rows)
+		except self.exceptions.Error as e:
+			logging.error("error executing sql: %s, %d rows, caller: %s",
+						  sql, len(rows), self.context)
+			raise DbError("Error executing sql statement: %s: %s" % (sql, e)) from e
+		return [row[key] for row in rows]
+
+	def insert_values(self, table, key, rows, unique):
+		"""
+		Inserts rows whose ids are generated by the database, many of them
+		in each statement (insert ... values (...), (...)), and then reads
+		their ids by the unique column. The ids don't have to be consecutive,
+		so it doesn't depend on the way they are allocated (e.g. the InnoDB
+		auto-increment lock mode)
+		
+		Arguments:
+		table(str) -- table name
+		key(str) -- primary key column
+		rows(list) -- dictionaries of column:value pairs, all of them with
+		the same columns, without the primary key
+		unique(str) -- column with a unique index
+		
+		Returns:
+		list -- ids of the rows inserted
+		"""
+		cols = list(rows[0])
+		size = max(1, IN_CHUNK // len(cols))  # databases limit the number of parameters
+		for i in range(0, len(rows), size):
+			args, values = {}, []
+			for j, row in enumerate(rows[i:i + size], i):
+				# parameters named after the column, see redact
+				names = ["_%s_%d" % (k, j) for k in cols]
+				args.update(zip(names, [row[k] for k in cols]))
+				values.append("(%s)" % ", ".join([self.param(name) for name in names]))
+			self.execute_sql("insert into %s (%s) values %s" %
+							 (table, ", ".join(cols), ", ".join(values)), args)
+		found = self.select_in(table, unique, [row[unique] for row in rows], (key, unique))
+		ids = dict([(row[unique], row[key]) for row in found])
+		return [ids[row[unique]] for row in rows]
+
+	def update(self, table, key, id, values):
+		"""
+		Updates a row in a table
+		
+		Arguments:
+		table(str) -- table name
+		key(str) -- primary key column
+		id -- primary key value of the row being updated
+		values(dict) -- column:value pairs being updated
+		
+		Returns:
+		int -- number of rows updated
+		"""
+		# column_1=%(column_1)s, column_2=%(column_2)s,...
+		cols = ", ".join(["%s=%s" % (k, self.param(k)) for k in values])
+		args = dict(values)
+		args['_' + key] = id  # named after the column, see redact
+		sql = "update %s set %s where %s=%s" % (table, cols, key, self.param('_' + key))
+		self.execute_sql(sql, args)
+		return self.get_row_count()
+
+	def delete(self, table, key, id):
+		"""
+		Deletes a row from a table
+		
+		Arguments:
+		table(str) -- table name
+		key(str) -- primary key column
+		id -- primary key value of the row being deleted
+		
+		Returns:
+		int -- number of rows deleted
+		"""
+		sql = "delete from %s where %s=%s" % (table, key, self.param('_' + key))
+		self.execute_sql(sql, {'_' + key: id})
+		return self.get_row_count()
+
+	def delete_older(self, table, column, value):
+		"""
+		Deletes the rows whose column value is lower than or equal to value,
+		e.g. the rows expired
+		
+		Returns:
+		int -- number of rows deleted
+		"""
+		sql = "delete from %s where %s<=%s" % (table, column, self.param('_value'))
+		self.execute_sql(sql, {'_value': value})
+		return self.get_row_count()
 
 	def get_result(self):
 		"""
@@ -216,17 +770,75 @@ class Db(object):
 		"""
 		return self._cursor.lastrowid
 
+	def defer(self, entity, op):
+		"""
+		Registers a write operation, which will be executed when the 
+		transaction is committed (unit of work). Several writes on the same
+		entity are merged into a single statement
+		
+		Arguments:
+		entity(model.EntityBase) -- entity being written
+		op(str) -- 'insert', 'update', 'upsert' or 'delete'
+		"""
+		key = id(entity)
+		prev = self._pending.get(key)
+		if prev is not None and prev[0] in ('insert', 'upsert'):
+			if op == 'update':
+				return  # the insert will write the latest values
+			if op == 'delete' and prev[0] == 'insert':
+				del self._pending[key]  # entity never reaches database
+				return
+		self._pending[key] = (op, entity)
+
+	def flush(self):
+		"""
+		Executes the pending writes, in the same order they were registered
+		
+		Raises:
+		DbError -- if any error happens while writing in database
+		"""
+		while self._pending:
+			op, entity = self._pending.popitem(last=False)[1]
+			getattr(entity, "do_" + op)()
+
+	def add_event(self, event):
+		"""
+		Registers an invalidation event, published when the transaction
+		is committed
+		
+		Arguments:
+		event(invalidation.Event) -- entity written
+		"""
+		self._events.append(event)
+
+	def publish_events(self):
+		"""
+		Publishes the events of the transaction committed, so the caches
+		of all the nodes drop the entities written
+		"""
+		if self._events:
+			events, self._events = self._events, []
+			get_bus().publish(events, self.tenant)
+
 	def commit(self):
 		"""
-		Commits current database transaction
+		Writes pending entities and commits current database transaction
 		"""
-		self._conn.commit()
+		self.flush()
+		if self._conn is not None:
+			self._conn.commit()
+		self.publish_events()
 
 	def rollback(self):
 		"""
-		Rolls back current database transaction
+		Rolls back current database transaction, discarding pending writes
+		and entities loaded
 		"""
-		self._conn.rollback()
+		self._pending.clear()
+		self._events = []
+		self.identity_map.clear()
+		if self._conn is not None:
+			self._conn.rollback()
 
 
 class MySqlDb(Db):
@@ -250,11 +862,18 @@ class MySqlDb(Db):
 
 class SQLiteDb(Db):
 	"""
-	MySQL specific database adapter. Uses module sqlite3
+	SQLite specific database adapter. Uses module sqlite3
 	"""
 
 	_module = 'sqlite3'
 
+	def __init__(self, **kw):
+		"""
+		Pooled connections are used by several threads, one at a time
+		"""
+		super().__init__(**kw)
+		self._config.setdefault('check_same_thread', False)
+
 	def get_connection(self):
 		"""
 		Specific implementation for sqlite3
@@ -262,6 +881,448 @@ class SQLiteDb(Db):
 		"""
 		Db.get_connection(self)
 		self._conn.row_factory = self._db.Row
+		return self._conn
+
+	def get_cursor(self):
+		"""
+		sqlite3 connections don't accept a cursor class
+		"""
+		if self._cursor is None:
+			self._cursor = self.get_connection().cursor()
+		return self._cursor
+
+	def get_tuple_cursor(self):
+		"""
+		The row factory of the connection is disabled in this cursor
+		"""
+		if self._tuple_cursor is None:
+			self._tuple_cursor = self.get_connection().cursor()
+			self._tuple_cursor.row_factory = None
+		return self._tuple_cursor
+
+	def param(self, name):
+		return ":%s" % name
+
+	def explain(self, sql, args=None):
+		"""
+		Uses EXPLAIN QUERY PLAN, EXPLAIN returns the bytecode in SQLite
+		"""
+		cursor = self.get_connection().cursor()
+		try:
+			cursor.execute("explain query plan " + sql, args or {})
+			return [dict(row) for row in cursor.fetchall()]
+		finally:
+			cursor.close()
+
+	def find_full_scans(self, plan):
+		"""
+		Plans describe full scans as "SCAN users" or "SCAN TABLE users"
+		(SQLite < 3.36), index reads as "SEARCH users USING INDEX..."
+		"""
+		tables = []
+		for row in plan:
+			words = row['detail'].split()
+			if len(words) > 1 and words[0] == 'SCAN' and 'USING' not in words:
+				tables.append(words[2] if words[1] == 'TABLE' else words[1])
+		return tables
+
+
+class SQLiteWalDb(SQLiteDb):
+	"""
+	SQLite adapter for production (small deployments, edge nodes). The
+	database is used in WAL mode: readers don't block the writer, nor the
+	writer the readers, so the pooled connections read concurrently.
+	Connections are opened with the pragmas of PRAGMAS, which can be
+	changed with the config key 'pragmas'. With synchronous=normal, the
+	last transactions committed may be lost on a power failure, but the
+	database is never corrupted
+
+	SQLite allows a single writer at a time: the transactions (dbconn with
+	in_trx=True: register, activate, login, logout) are run by a writer
+	thread with its own connection, see SQLiteWriter. Writes outside
+	transactions (e.g. session touches) use the pooled connections, and
+	wait for the lock if the writer holds it (config key 'timeout')
+	"""
+
+	single_writer = True
+	# journal_mode is stored in the database file, the others are set on
+	# each connection. cache_size in KiB if negative
+	PRAGMAS = OrderedDict([('journal_mode', 'wal'), ('synchronous', 'normal'),
+						   ('cache_size', -8192), ('mmap_size', 256 * 1024 * 1024),
+						   ('temp_store', 'memory')])
+
+	def __init__(self, pragmas=None, **kw):
+		"""
+		Arguments:
+		pragmas(dict) -- pragma name -> value, override PRAGMAS
+		kw -- arguments of sqlite3.connect
+		"""
+		super().__init__(**kw)
+		self.pragmas = OrderedDict(self.PRAGMAS)
+		self.pragmas.update(pragmas or {})
+
+	def connect(self):
+		conn = Db.connect(self)
+		for name, value in self.pragmas.items():
+			conn.execute("pragma %s=%s" % (name, value))
+		return conn
+
+
+class SQLiteWriter(object):
+	"""
+	Runs the transactions of a single writer Db class (SQLiteWalDb) in a
+	thread with its own connection, so transactions never wait for the
+	database lock, nor fail when it's busy. The transactions queued while
+	the thread is busy are run together and committed at once (group
+	commit): each one in a savepoint, so that a transaction that fails is
+	rolled back alone. The invalidation events are published and the
+	callers answered after the commit, so their writes are visible when
+	they get the response. The transactions of all the requests wait for
+	each other, so slow work that doesn't use the database (e.g. sending
+	a mail) must be done by the caller after execute returns, not inside
+	the transaction
+	"""
+
+	def __init__(self, factory, batch_size=64):
+		"""
+		Arguments:
+		factory(DbFactory) -- factory of the Db objects
+		batch_size(int) -- maximum number of transactions committed at once
+		"""
+		self.batch_size = batch_size
+		self.batches = 0  # commits
+		self.transactions = 0  # transactions run
+		self._factory = factory
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self.run, daemon=True, name="pysaa-sqlite-writer")
+		self._thread.start()
+
+	def execute(self, caller, func, args, kw):
+		"""
+		Runs a transaction in the writer thread and waits for its commit.
+		The Db object of the writer is passed to func, and set as caller.db
+		
+		Arguments:
+		caller(object) -- object of the method decorated by dbconn
+		func(function) -- method decorated
+		args(tuple), kw(dict) -- arguments of the method
+		
+		Returns:
+		value returned by func, False if a DbError is raised while running
+		or committing the transaction
+		"""
+		future = Future()
+		self._queue.put((caller, func, args, kw, future))
+		return future.result()
+
+	def stop(self):
+		"""
+		Stops the thread after running the transactions queued
+		"""
+		self._queue.put(None)
+
+	def run(self):
+		db = self._factory.get_db()
+		db._factory = None  # own connection, not pooled
+		db._config['isolation_level'] = None  # transactions are begun here
+		stopped = False
+		while not stopped:
+			batch = [self._queue.get()]
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			if None in batch:
+				batch.remove(None)
+				stopped = True
+			if batch:
+				self.commit_batch(db, batch)
+		db.close_connection()
+
+	def commit_batch(self, db, batch):
+		"""
+		Runs the transactions of a batch and commits them, then sets the
+		results of the callers
+		"""
+		results = []  # (future, value returned, exception raised)
+		events = []  # events of the transactions that succeeded
+		try:
+			db.execute_sql("begin immediate")
+			for caller, func, args, kw, future in batch:
+				db.context = type(caller).__name__
+				caller.db = db
+				db.execute_sql("savepoint trx")
+				try:
+					ret = func(caller, db, *args, **kw)
+					db.flush()
+					events.extend(db._events)
+					results.append((future, ret, None))
+				except Exception as e:
+					if isinstance(e, DbError):
+						logging.exception("database error: %s", e)
+						e = None
+					db.execute_sql("rollback to trx")
+					results.append((future, False, e))
+				finally:
+					db.execute_sql("release trx")
+					db._pending.clear()
+					db._events = []
+					db.identity_map.clear()  # entities are not shared between transactions
+			db._events = events
+			db.commit()
+		except Exception as e:
+			logging.exception("group commit failed: %s", e)
+			db.rollback()
+			db.close_cursor()
+			db.close_connection()  # reconnect in the next batch
+			results = [(future, False, error) for future, ret, error in results]
+			results.extend([(item[-1], False, None) for item in batch[len(results):]])
+		else:
+			db.close_cursor()
+			self.batches += 1
+			self.transactions += len(batch)
+		for future, ret, error in results:
+			if error is None:
+				future.set_result(ret)
+			else:
+				future.set_exception(error)
+
+
+class MemoryStore(object):
+	"""
+	Tables kept in memory. Each table is a dictionary of rows by primary key,
+	with hash indexes on the lookup columns
+	"""
+
+	def __init__(self, indexes):
+		"""
+		Arguments:
+		indexes(dict) -- table name -> columns indexed
+		"""
+		self.lock = threading.RLock()
+		self.tables = {}  # table -> {id: row}
+		self.indexes = {}  # table -> {column: {value: set of ids}}
+		self.sequences = {}  # table -> last id generated
+		for table, columns in indexes.items():
+			self.indexes[table] = dict([(c, {}) for c in columns])
+
+	def get_table(self, table):
+		if not table in self.tables:
+			self.tables[table] = {}
+			self.indexes.setdefault(table, {})
+			self.sequences[table] = 0
+		return self.tables[table]
+
+	def add(self, table, id, row):
+		self.get_table(table)[id] = row
+		for col, index in self.indexes[table].items():
+			index.setdefault(row.get(col), set()).add(id)
+
+	def remove(self, table, id):
+		row = self.get_table(table).pop(id)
+		for col, index in self.indexes[table].items():
+			ids = index.get(row.get(col))
+			ids.discard(id)
+			if not ids:
+				del index[row.get(col)]
+		return row
+
+	def find(self, table, criteria):
+		"""
+		Returns:
+		list -- ids of the rows that match the criteria
+		"""
+		rows = self.get_table(table)
+		indexes = self.indexes[table]
+		ids = None
+		# use the indexes first, then check the remaining columns row by row
+		for col, value in criteria.items():
+			if col in indexes:
+				found = indexes[col].get(value, ())
+				ids = set(found) if ids is None else ids.intersection(found)
+		if ids is None:
+			ids = rows.keys()
+		return [id for id in ids if all(
+			[rows[id].get(k) == v for k, v in criteria.items()])]
+
+
+class MemoryDb(Db):
+	"""
+	In-memory storage engine. Tables are shared by all the MemoryDb objects
+	created with the same store name, so they live as long as the process.
+	Writes are undone if the transaction is rolled back, but there's no
+	isolation between concurrent transactions
+	"""
+
+	_module = None  # no db module needed
+	recursive_queries = False  # hierarchies are walked in memory
+
+	# columns used to look up entities
+	INDEXES = {
+		'users': ('user_id', 'email'),
+		'activations': ('user_id', 'activation_id'),
+		'logins': ('user_id', 'session_id'),
+		'permissions': ('permission_id', 'role_id'),
+		'roles': ('role_id',),
+		'sessions': ('session_id', 'user_id'),
+	}
+
+	_stores = {}  # store name -> MemoryStore
+	_stores_lock = threading.Lock()
+
+	def __init__(self, store='default', indexes=None, **kw):
+		"""
+		Arguments:
+		store(str) -- name of the store holding the tables
+		indexes(dict) -- table name -> columns indexed, INDEXES by default
+		"""
+		super().__init__(**kw)
+		with MemoryDb._stores_lock:
+			if not store in MemoryDb._stores:
+				MemoryDb._stores[store] = MemoryStore(indexes or self.INDEXES)
+			self._store = MemoryDb._stores[store]
+		self._undo = []  # functions that revert the writes of the transaction
+
+	def execute_sql(self, sql, *args):
+		raise DbError("sql statements are not supported by MemoryDb")
+
+	def select(self, table, criteria, columns=None, order=None, sort=None):
+		with self._store.lock:
+			result = self.find_rows(table, criteria, order, sort)
+			if columns:
+				return [dict([(k, row.get(k)) for k in columns]) for row in result]
+			return [dict(row) for row in result]
+
+	def select_tuples(self, table, criteria, columns=None, order=None, sort=None):
+		with self._store.lock:
+			result = self.find_rows(table, criteria, order, sort)
+			# without columns, the names are the columns of the first row
+			names = tuple(columns or (result[0] if result else ()))
+			return names, [tuple([row.get(k) for k in names]) for row in result]
+
+	def find_rows(self, table, criteria, order=None, sort=None):
+		"""
+		Returns:
+		list -- rows stored that match the criteria, must not be modified.
+		Must be called holding the lock of the store
+		"""
+		rows = self._store.get_table(table)
+		result = [rows[id] for id in self._store.find(table, criteria)]
+		if not order is None:
+			reverse = sort is None or sort.lower() != "asc"
+			result.sort(key=lambda row: row.get(order), reverse=reverse)
+		return result
+
+	def insert(self, table, key, values):
+		store = self._store
+		with store.lock:
+			rows = store.get_table(table)
+			row = dict(values)
+			id = row.get(key)
+			if id is None:  # autonumeric
+				store.sequences[table] += 1
+				id = row[key] = store.sequences[table]
+			elif id in rows:
+				raise DbError("duplicate entry '%s' for key '%s'" % (id, key))
+			elif isinstance(id, int):
+				store.sequences[table] = max(store.sequences[table], id)
+			store.add(table, id, row)
+		self._undo.append(lambda: store.remove(table, id))
+		return id
+
+	def update(self, table, key, id, values):
+		store = self._store
+		with store.lock:
+			if not id in store.get_table(table):
+				return 0
+			old = store.remove(table, id)
+			row = dict(old)
+			row.update(values)
+			store.add(table, row[key], row)
+
+		def undo():
+			store.remove(table, row[key])
+			store.add(table, id, old)
+
+		self._undo.append(undo)
+		return 1
+
+	def delete(self, table, key, id):
+		store = self._store
+		with store.lock:
+			if not id in store.get_table(table):
+				return 0
+			old = store.remove(table, id)
+		self._undo.append(lambda: store.add(table, id, old))
+		return 1
+
+	def select_in(self, table, column, values, columns=None):
+		rows = []
+		for value in set(values):
+			rows.extend(self.select(table, {column: value}, columns))
+		return rows
+
+	def insert_many(self, table, key, rows, unique=None):
+		return [self.insert(table, key, row) for row in rows]
+
+	def delete_older(self, table, column, value):
+		store = self._store
+		with store.lock:
+			rows = store.get_table(table)
+			ids = [id for id, row in rows.items() if row.get(column) <= value]
+			for id in ids:
+				old = store.remove(table, id)
+				self._undo.append(lambda id=id, old=old: store.add(table, id, old))
+		return len(ids)
+
+	def sync(self, source, tables):
+		"""
+		Replaces the content of the tables with the rows read from another
+		Db, for example to use this store as a local cache of the main database
+		
+		Arguments:
+		source(Db) -- Db object the rows are read from
+		tables(dict) -- table name -> primary key column
+		"""
+		data = dict([(table, source.select(table, {})) for table in tables])
+		store = self._store
+		with store.lock:
+			for table, key in tables.items():
+				for id in list(store.get_table(table)):
+					store.remove(table, id)
+				for row in data[table]:
+					store.add(table, row[key], dict(row))
+					if isinstance(row[key], int):
+						store.sequences[table] = max(store.sequences[table], row[key])
+
+	def get_connection(self):
+		return None
+
+	def commit(self):
+		self.flush()
+		self._undo = []
+		self.publish_events()
+
+	def rollback(self):
+		Db.rollback(self)
+		with self._store.lock:
+			while self._undo:
+				self._undo.pop()()
+
+
+def redact(args=None):
+	"""
+	Returns:
+	dict -- copy of the statement arguments, without the values of 
+	sensitive columns (REDACTED_COLUMNS). Parameters are named after their
+	column, with a '_' prefix (key of update and delete) and a _<n> suffix
+	(values of select_in)
+	"""
+	if not isinstance(args, dict):
+		return args
+	return dict([(k, '***' if PARAM_COLUMN.match(k).group(1) in REDACTED_COLUMNS else v)
+				 for k, v in args.items()])
 
 
 class DbError(Exception):
@@ -0,0 +1,319 @@
+"""
+httpserver.py
+
+This module exposes PySAA over HTTP/JSON. Each request type is mapped to a
+route (/register, /activate, /login, /authorize, /logout), request
+parameters are taken from the query string and/or a JSON object in the body,
+and the response of PySAAServer is returned as a JSON object. Multi-tenant
+servers take the tenant key from the parameter 'tenant'.
+
+Two front ends are provided:
+HttpServer -- asyncio HTTP/1.1 server, with keep-alive and pipelining
+make_wsgi_app -- WSGI application, to be run by any WSGI server
+
+usage: python -m pysaa.httpserver [host] [port]
+"""
+
+import asyncio
+import functools
+import logging
+import sys
+
+from urllib.parse import parse_qsl
+
+from pysaa.profiling import toggle_on_signal
+from pysaa.server import PySAAServer, ServerBusyError, REQUEST_CLASSES, settings
+
+try:  # orjson is much faster, use it if it's installed
+	import orjson
+
+	dumps = orjson.dumps
+	loads = orjson.loads
+except ImportError:
+	import json
+
+	def dumps(obj):
+		return json.dumps(obj).encode('utf-8')
+
+	loads = json.loads
+
+
+# map from url path to request type
+ROUTES = dict([('/' + t, t) for t in REQUEST_CLASSES if t != 'default'])
+
+STATUS = {
+	200: 'OK',
+	400: 'Bad Request',
+	404: 'Not Found',
+	405: 'Method Not Allowed',
+	413: 'Payload Too Large',
+	500: 'Internal Server Error',
+	503: 'Service Unavailable',
+}
+
+# maximum number of pipelined requests being processed per connection
+PIPELINE_DEPTH = 32
+
+# limits of the requests, so that a client can't make the server allocate
+# unbounded memory: bytes of the request line and of each header line,
+# number of headers and bytes of the body
+MAX_LINE = 8192
+MAX_HEADERS = 100
+MAX_BODY = 65536
+
+
+class RequestError(ValueError):
+	"""
+	Request refused before being processed, answered with the status code
+	and the connection is closed
+	"""
+
+	def __init__(self, status, message):
+		ValueError.__init__(self, message)
+		self.status = status
+
+
+def dispatch(server, method, path, query, body):
+	"""
+	Processes one HTTP request
+
+	Arguments:
+	server(PySAAServer) -- server that handles the request
+	method(str) -- HTTP method
+	path(str) -- url path, selects the request type
+	query(str) -- query string
+	body(bytes) -- request body, a JSON object or empty
+
+	Returns:
+	tuple -- HTTP status code and response body (JSON)
+	"""
+	type = ROUTES.get(path)
+	if type is None:
+		return 404, dumps({'error': 'unknown route %s' % path, 'result': False})
+	if method not in ('GET', 'POST'):
+		return 405, dumps({'error': 'method not allowed', 'result': False})
+
+	try:
+		data = dict(parse_qsl(query))
+		if body:
+			data.update(loads(body))
+	except (ValueError, TypeError):
+		return 400, dumps({'error': 'request is not a valid JSON object', 'result': False})
+	data['type'] = type
+
+	try:
+		response = server.handle_request(**data)
+	except KeyError as e:
+		return 400, dumps({'error': 'missing parameter %s' % e, 'result': False})
+	except Exception as e:
+		logging.exception("error processing the request: %s" % e)
+		response = None
+
+	if not isinstance(response, dict):  # database error
+		return 500, dumps({'error': 'internal error', 'result': False})
+	if response.get('busy'):  # refused by the admission control
+		return 503, dumps(response)
+	return 200, dumps(response)
+
+
+def make_wsgi_app(server=None):
+	"""
+	Creates a WSGI application serving PySAA
+
+	Arguments:
+	server(PySAAServer) -- server that handles the requests, a new one if None
+
+	Returns:
+	function -- WSGI application
+	"""
+	server = server or PySAAServer()
+
+	def app(environ, start_response):
+		try:
+			length = int(environ.get('CONTENT_LENGTH') or 0)
+		except ValueError:
+			length = 0
+		if length > MAX_BODY:
+			status, payload = 413, dumps({'error': 'request body too large', 'result': False})
+		else:
+			body = environ['wsgi.input'].read(length) if length > 0 else b''
+			status, payload = dispatch(server, environ['REQUEST_METHOD'],
+									   environ.get('PATH_INFO', ''),
+									   environ.get('QUERY_STRING', ''), body)
+		start_response("%d %s" % (status, STATUS[status]),
+					   [('Content-Type', 'application/json'),
+						('Content-Length', str(len(payload)))])
+		return [payload]
+
+	return app
+
+
+async def read_line(reader):
+	"""
+	Returns:
+	bytes -- next line of the stream, empty if the connection is closed
+
+	Raises:
+	RequestError -- if the line is longer than the limit of the stream
+	"""
+	try:
+		return await reader.readline()
+	except ValueError:  # limit of the stream (MAX_LINE) overrun
+		raise RequestError(400, "request line or header too long")
+
+
+async def read_request(reader):
+	"""
+	Reads one HTTP/1.x request from the stream
+
+	Returns:
+	tuple -- method, path, query string, body and keep-alive flag
+	None -- if the connection has been closed by the client
+
+	Raises:
+	RequestError -- if the request is malformed or exceeds the limits
+	"""
+	line = await read_line(reader)
+	if not line:
+		return None
+	try:
+		method, target, version = line.decode('latin-1').split()
+	except ValueError:
+		raise RequestError(400, "malformed request line")
+
+	headers = {}
+	for _ in range(MAX_HEADERS + 1):
+		line = await read_line(reader)
+		if line in (b'\r\n', b'\n', b''):
+			break
+		name, _, value = line.decode('latin-1').partition(':')
+		headers[name.strip().lower()] = value.strip().lower()
+	else:
+		raise RequestError(400, "too many headers")
+
+	try:
+		length = int(headers.get('content-length', 0))
+	except ValueError:
+		raise RequestError(400, "invalid content-length")
+	if length < 0:
+		raise RequestError(400, "invalid content-length")
+	if length > MAX_BODY:
+		raise RequestError(413, "request body too large")
+	body = await reader.readexactly(length) if length else b''
+
+	path, _, query = target.partition('?')
+	connection = headers.get('connection', '')
+	if version == 'HTTP/1.0':
+		keep_alive = connection == 'keep-alive'
+	else:
+		keep_alive = connection != 'close'
+	return method, path, query, body, keep_alive
+
+
+class HttpServer(object):
+	"""
+	asyncio HTTP/1.1 front end of PySAAServer. Connections are kept alive,
+	and pipelined requests are processed while the previous responses are
+	being sent, keeping the order of the responses
+	"""
+
+	def __init__(self, server=None, host=None, port=None):
+		"""
+		Arguments:
+		server(PySAAServer) -- server that handles the requests, in its
+		worker pool since they block on database
+		host(str) -- address to listen on, settings.HTTP_HOST by default
+		port(int) -- port to listen on, settings.HTTP_PORT by default
+		"""
+		self.server = server or PySAAServer()
+		self.host = settings.HTTP_HOST if host is None else host
+		self.port = settings.HTTP_PORT if port is None else port
+		self._listener = None
+
+	async def start(self):
+		"""
+		Starts listening for connections
+		"""
+		self._listener = await asyncio.start_server(
+			self._handle_connection, self.host, self.port, limit=MAX_LINE)
+		if not self.port:  # port chosen by the system
+			self.port = self._listener.sockets[0].getsockname()[1]
+		return self._listener
+
+	async def serve_forever(self):
+		await self.start()
+		async with self._listener:
+			await self._listener.serve_forever()
+
+	def close(self):
+		if self._listener is not None:
+			self._listener.close()
+
+	async def _handle_connection(self, reader, writer):
+		loop = asyncio.get_running_loop()
+		responses = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+		sender = loop.create_task(self._send_responses(responses, writer))
+		try:
+			while True:
+				request = await read_request(reader)
+				if request is None:
+					break
+				method, path, query, body, keep_alive = request
+				try:
+					future = asyncio.wrap_future(self.server.execute(functools.partial(
+						dispatch, self.server, method, path, query, body), timeout=0))
+				except ServerBusyError as e:  # don't wait, fail fast
+					future = loop.create_future()
+					future.set_result((503, dumps({'error': str(e), 'result': False})))
+				await responses.put((future, keep_alive))
+				if not keep_alive:
+					break
+		except RequestError as e:  # answered, after the previous requests
+			future = loop.create_future()
+			future.set_result((e.status, dumps({'error': str(e), 'result': False})))
+			await responses.put((future, False))
+		except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+			# malformed request or connection lost, close the connection
+			pass
+		except asyncio.CancelledError:  # server is shutting down
+			sender.cancel()
+			writer.close()
+			return
+		await responses.put(None)
+		await sender
+		writer.close()
+
+	async def _send_responses(self, responses, writer):
+		"""
+		Writes the responses in the same order the requests were received
+		"""
+		broken = False  # connection lost, keep consuming the queue
+		while True:
+			item = await responses.get()
+			if item is None:
+				return
+			future, keep_alive = item
+			status, payload = await future
+			if broken:
+				continue
+			head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n" \
+				   "Content-Length: %d\r\n" % (status, STATUS[status], len(payload))
+			if not keep_alive:
+				head += "Connection: close\r\n"
+			try:
+				writer.write(head.encode('latin-1') + b"\r\n" + payload)
+				await writer.drain()
+			except ConnectionError:
+				broken = True
+
+
+if __name__ == "__main__":
+	logging.basicConfig(filename='pysaa.log', level=logging.DEBUG)
+	host = sys.argv[1] if len(sys.argv) > 1 else None
+	port = int(sys.argv[2]) if len(sys.argv) > 2 else None
+	http_server = HttpServer(host=host, port=port)
+	toggle_on_signal(http_server.server.profiler)  # kill -USR2 <pid>
+	try:
+		asyncio.run(http_server.serve_forever())
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,310 @@
+"""
+invalidation.py
+
+This module implements the cache invalidation bus. Entities written in a
+transaction are published as events when the transaction is committed,
+and the caches subscribed to the entity class drop the affected entries.
+Events are sent to the other nodes (processes) by a transport, so their
+caches don't keep stale entries until they expire
+
+Each event contains the entity class name, the entity id, the operation
+('insert', 'update' or 'delete') and the values of the columns listed in
+the event_columns attribute of the entity class (e.g. the email of a User)
+
+In multi-tenant servers, events are published and subscribed with the key
+of the tenant whose database was written, so the caches of the other
+tenants are not affected. The default tenant (settings.DATABASE) is None
+
+Transports:
+LocalTransport -- events are only delivered in this process
+UnixSocketTransport -- Unix datagram sockets in a shared directory, one per
+node, for the nodes running in the same host
+UdpMulticastTransport -- UDP multicast, on localhost or on a network
+
+Other transports (e.g. a message broker) can be plugged by extending
+Transport, and configured in settings.INVALIDATION
+"""
+
+import atexit
+import collections
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from pysaa.utils import Settings
+
+# entity class name, id, operation and column values
+Event = collections.namedtuple('Event', ('entity', 'id', 'op', 'values'))
+
+# maximum number of events sent in a single datagram
+EVENTS_PER_MESSAGE = 100
+
+
+class InvalidationBus(object):
+	"""
+	Delivers the events published to the subscribers of this process and,
+	through the transport, to the subscribers of the other nodes
+	"""
+
+	def __init__(self, transport=None):
+		"""
+		Arguments:
+		transport(Transport) -- sends the events to the other nodes,
+		LocalTransport (no other nodes) by default
+		"""
+		self.node = uuid.uuid4().hex  # identifies the messages of this node
+		self.transport = transport or LocalTransport()
+		self._subscribers = {}  # (tenant, entity class name) -> list of callbacks
+		self._lock = threading.Lock()
+		self.transport.start(self)
+
+	def subscribe(self, entity, callback, tenant=None):
+		"""
+		Arguments:
+		entity(str) -- entity class name, e.g. 'User'
+		callback(function) -- called with each Event of this entity class,
+		must be fast and must not raise exceptions
+		tenant(str) -- tenant key of the events, None for the default tenant
+		"""
+		with self._lock:
+			# copied, dispatch iterates over the list without the lock
+			callbacks = self._subscribers.get((tenant, entity), [])
+			self._subscribers[(tenant, entity)] = callbacks + [callback]
+
+	def unsubscribe(self, entity, callback, tenant=None):
+		"""
+		Removes a callback, e.g. when a tenant is closed
+		"""
+		with self._lock:
+			callbacks = [c for c in self._subscribers.get((tenant, entity), []) if c != callback]
+			if callbacks:
+				self._subscribers[(tenant, entity)] = callbacks
+			else:
+				self._subscribers.pop((tenant, entity), None)
+
+	def publish(self, events, tenant=None):
+		"""
+		Delivers the events to the local subscribers and sends them to the
+		other nodes
+
+		Arguments:
+		events(list) -- Event tuples
+		tenant(str) -- tenant key of the database written, None for the
+		default tenant
+		"""
+		if not events:
+			return
+		self.dispatch(events, tenant)
+		for i in range(0, len(events), EVENTS_PER_MESSAGE):
+			message = {'node': self.node, 'events': events[i:i + EVENTS_PER_MESSAGE]}
+			if tenant is not None:
+				message['tenant'] = tenant
+			try:
+				self.transport.send(json.dumps(message).encode('utf-8'))
+			except (OSError, TypeError, ValueError) as e:
+				# the other nodes will drop the entries when they expire
+				logging.error("could not send invalidation events: %s" % e)
+
+	def receive(self, data):
+		"""
+		Called by the transport with each message received
+		"""
+		try:
+			message = json.loads(data.decode('utf-8'))
+		except ValueError:
+			logging.error("malformed invalidation message")
+			return
+		if message.get('node') == self.node:  # already delivered
+			return
+		self.dispatch([Event(*e) for e in message['events']], message.get('tenant'))
+
+	def dispatch(self, events, tenant=None):
+		"""
+		Calls the subscribers of each event
+		"""
+		subscribers = self._subscribers
+		for event in events:
+			for callback in subscribers.get((tenant, event.entity), ()):
+				try:
+					callback(event)
+				except Exception as e:
+					logging.exception("invalidation callback failed: %s" % e)
+
+	def close(self):
+		self.transport.close()
+
+
+class Transport(object):
+	"""
+	Base class of the transports. Messages are bytes, delivered at most
+	once and in any order
+	"""
+
+	def start(self, bus):
+		"""
+		Starts receiving messages, which are passed to bus.receive
+		"""
+		self.bus = bus
+
+	def send(self, data):
+		"""
+		Sends a message to all the other nodes
+		"""
+
+	def close(self):
+		pass
+
+	def listen(self, sock, name):
+		"""
+		Starts a thread that receives datagrams from a socket
+		"""
+		def run():
+			while True:
+				try:
+					data = sock.recv(65536)
+				except OSError:  # socket closed
+					return
+				self.bus.receive(data)
+
+		thread = threading.Thread(target=run, daemon=True, name=name)
+		thread.start()
+
+
+class LocalTransport(Transport):
+	"""
+	Single node, events are only delivered to the subscribers of this process
+	"""
+
+
+class UnixSocketTransport(Transport):
+	"""
+	Each node binds a Unix datagram socket in a directory shared by the
+	nodes of the host, and sends the messages to the sockets of the others
+	"""
+
+	# seconds between two listings of the directory
+	REFRESH = 1
+
+	def __init__(self, directory='/tmp/pysaa-invalidation'):
+		"""
+		Arguments:
+		directory(str) -- directory of the sockets, created if needed
+		"""
+		self.directory = directory
+		self._peers = []
+		self._listed = 0
+
+	def start(self, bus):
+		super().start(bus)
+		os.makedirs(self.directory, exist_ok=True)
+		self.path = os.path.join(self.directory, "%s.sock" % bus.node)
+		self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self._sock.bind(self.path)
+		self._out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self._out.setblocking(False)  # don't wait for slow nodes
+		self.listen(self._sock, "pysaa-invalidation")
+
+	def peers(self):
+		"""
+		Returns:
+		list -- socket paths of the other nodes
+		"""
+		now = time.time()
+		if now - self._listed >= self.REFRESH:
+			self._listed = now
+			self._peers = [os.path.join(self.directory, name)
+						   for name in os.listdir(self.directory)
+						   if name.endswith(".sock") and name != os.path.basename(self.path)]
+		return self._peers
+
+	def send(self, data):
+		for path in self.peers():
+			try:
+				self._out.sendto(data, path)
+			except (ConnectionRefusedError, FileNotFoundError):
+				# node stopped without removing its socket
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+				self._listed = 0
+			except BlockingIOError:
+				logging.warning("invalidation queue of %s is full, message lost" % path)
+
+	def close(self):
+		self._sock.close()
+		self._out.close()
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
+
+
+class UdpMulticastTransport(Transport):
+	"""
+	Messages are sent to a multicast group. By default the group is only
+	reachable in this host (loopback interface, TTL 0)
+	"""
+
+	def __init__(self, group='239.255.80.80', port=8082, interface='127.0.0.1', ttl=0):
+		"""
+		Arguments:
+		group(str) -- multicast group address
+		port(int) -- UDP port
+		interface(str) -- address of the interface used to send and receive
+		ttl(int) -- 0 for this host only, 1 for the local network
+		"""
+		self.group = group
+		self.port = port
+		self.interface = interface
+		self.ttl = ttl
+
+	def start(self, bus):
+		super().start(bus)
+		self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._sock.bind(('', self.port))
+		self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+							  socket.inet_aton(self.group) + socket.inet_aton(self.interface))
+		self._out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self._out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+							 socket.inet_aton(self.interface))
+		self._out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+		self._out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+		self.listen(self._sock, "pysaa-invalidation")
+
+	def send(self, data):
+		self._out.sendto(data, (self.group, self.port))
+
+	def close(self):
+		self._sock.close()
+		self._out.close()
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+	"""
+	Returns:
+	InvalidationBus -- the bus of this process, created on first use with
+	the transport configured in settings.INVALIDATION
+	"""
+	global _bus
+	if _bus is None:
+		with _bus_lock:
+			if _bus is None:
+				config = Settings().INVALIDATION
+				cls = getattr(sys.modules[__name__], config['class'], None)
+				if cls is None:
+					raise ValueError("unknown invalidation transport %s" % config['class'])
+				bus = InvalidationBus(cls(**config.get('config', {})))
+				atexit.register(bus.close)
+				_bus = bus
+	return _bus
@@ -0,0 +1,290 @@
+"""
+migrate.py
+
+This module migrates the databases created by previous versions of PySAA
+to the current schema. It must be run with the servers stopped, before
+starting the new version
+
+hash_tokens: activation and session identifiers were stored as they are
+sent to the users (CHAR(64)). They are stored now as their SHA-256 digests
+(32 bytes, see utils.token_digest), and the identifier of the session that
+replaces a renewed one is stored encrypted with the old identifier (see
+utils.seal_token). The rows of the activations and sessions tables are
+converted in batches, a transaction each. Rows already converted are
+skipped, so a migration interrupted can be run again. Rows are read in
+pages of the batch size, in key order, whole tables are never loaded. On
+MySQL the columns are changed to VARBINARY before the conversion and to
+their final types after it, SQLite columns accept the digests as they
+are. Databases created
+before the sessions table existed get it (as in pysaa.sql and
+pysaa_sqlite.sql), their sessions were kept in the logins.session_id
+column, which is cleared: their users have to log in again. Sessions kept
+by SQLiteSessionStore files are not converted: delete the files, their
+users have to log in again too
+
+Indexes of the current schema missing in older databases are created at
+the end (see INDEXES), so the lookups by activation id use an index. The
+unique index of users.email can't be created if two users have the same
+email: remove the duplicates and run the migration again
+
+The database converted is the one configured (settings.DATABASE), or the
+databases of the tenants given (settings.TENANT_DATABASE)
+
+usage: python -m pysaa.migrate [--batch n] [--tenant key ...]
+"""
+
+import argparse
+import logging
+import sys
+
+from pysaa import dbapi, utils
+from pysaa.model import Activation, Login
+from pysaa.sessions import DbSessionStore
+
+# size of the digests stored, in bytes
+DIGEST_SIZE = 32
+
+# statements run before the conversion, by storage engine: the columns
+# must accept the binary values
+WIDEN = {
+	'MySqlDb': ["alter table activations modify activation_id varbinary(64) not null",
+				"alter table sessions modify session_id varbinary(64) not null",
+				"alter table sessions modify next_id varbinary(64) null"],
+}
+
+# lookup of a table, by storage engine: the parameter is the table name
+TABLES = {
+	'MySqlDb': "select table_name from information_schema.tables "
+			   "where table_schema=database() and table_name=%(_table)s",
+	'SQLiteDb': "select name from sqlite_master where type='table' and name=:_table",
+}
+
+# statements creating the sessions table, by storage engine
+SESSIONS = {
+	'MySqlDb': ["create table sessions (session_id binary(32) not null, "
+				"user_id int(10) not null, created int(11) not null, expires int(11) not null, "
+				"next_id varbinary(64) null, primary key (session_id), "
+				"index sessions_user_id (user_id), index sessions_expires (expires)) "
+				"default character set = utf8"],
+	'SQLiteDb': ["create table if not exists sessions (session_id blob not null primary key, "
+				 "user_id integer not null references users (user_id), created int not null, "
+				 "expires int not null, next_id blob null)",
+				 "create index if not exists sessions_user_id on sessions (user_id)",
+				 "create index if not exists sessions_expires on sessions (expires)"],
+}
+
+# indexes created if they are missing: name, table, column, unique
+INDEXES = [('users_email', 'users', 'email', True),
+		   ('activations_activation_id', 'activations', 'activation_id', True),
+		   ('permissions_role_id', 'permissions', 'role_id', False)]
+
+# lookup of an index on MySQL, which has no "create index if not exists"
+MYSQL_INDEX = ("select index_name from information_schema.statistics where "
+			   "table_schema=database() and table_name=%(_table)s and index_name=%(_index)s")
+
+# statements run after the conversion: final types of the columns
+NARROW = {
+	'MySqlDb': ["alter table activations modify activation_id binary(32) not null",
+				"alter table sessions modify session_id binary(32) not null"],
+}
+
+
+def engine_name(db):
+	"""
+	Returns:
+	str -- name of the storage engine of the Db object, SQLiteDb for all
+	the SQLite engines
+	"""
+	if isinstance(db, dbapi.SQLiteDb):
+		return 'SQLiteDb'
+	return type(db).__name__
+
+
+def table_exists(db, table):
+	"""
+	Returns:
+	bool -- True if the table exists, or if the storage engine can't tell
+	"""
+	sql = TABLES.get(engine_name(db))
+	if sql is None:
+		return True
+	db.execute_sql(sql, {'_table': table})
+	return len(db.get_result()) > 0
+
+
+def stored_token(value):
+	"""
+	Arguments:
+	value(str or bytes) -- identifier read from the database
+
+	Returns:
+	str -- the identifier, if it was stored by a previous version
+	None -- if the value is already a digest
+	"""
+	if isinstance(value, bytes):
+		if len(value) == DIGEST_SIZE:
+			return None
+		return value.decode('ascii')
+	return value
+
+
+def pages(db, table, key, columns, batch_size):
+	"""
+	Reads the rows of a table in pages, in key order. Rows whose key is
+	changed while reading may be read again
+
+	Arguments:
+	db(dbapi.Db) -- Db object of the database
+	table(str) -- table name
+	key(str) -- primary key column
+	columns(list) -- columns read besides the key
+	batch_size(int) -- rows per page
+
+	Returns:
+	generator -- pages (lists of rows, as dictionaries)
+	"""
+	fields = ", ".join((key,) + tuple(columns))
+	last = None
+	while True:
+		sql, args = "select %s from %s" % (fields, table), {}
+		if last is not None:
+			sql += " where %s>%s" % (key, db.param('_' + key))
+			args['_' + key] = last
+		db.execute_sql(sql + " order by %s asc limit %d" % (key, batch_size), args)
+		rows = [dict(row) for row in db.get_result()]
+		if not rows:
+			return
+		yield rows
+		last = rows[-1][key]
+
+
+def create_indexes(db):
+	"""
+	Creates the indexes of INDEXES that don't exist
+	"""
+	engine = engine_name(db)
+	if not engine in TABLES:  # not a SQL database
+		return
+	for name, table, column, unique in INDEXES:
+		if engine == 'MySqlDb':
+			db.execute_sql(MYSQL_INDEX, {'_table': table, '_index': name})
+			if db.get_result():
+				continue
+			sql = "create %sindex %s on %s (%s)"
+		else:
+			sql = "create %sindex if not exists %s on %s (%s)"
+		db.execute_sql(sql % ("unique " if unique else "", name, table, column))
+	db.commit()
+
+
+def hash_tokens(db, batch_size=1000):
+	"""
+	Replaces the activation and session identifiers stored by their
+	digests, see the module documentation
+
+	Arguments:
+	db(dbapi.Db) -- Db object of the database converted
+	batch_size(int) -- rows converted in each transaction
+
+	Returns:
+	dict -- number of rows converted by table
+
+	Raises:
+	dbapi.DbError -- if the database can't be converted. The batches
+	committed are kept, run the migration again
+	"""
+	engine = engine_name(db)
+	if not table_exists(db, DbSessionStore.table):  # created before the sessions table
+		for sql in SESSIONS.get(engine, []):
+			db.execute_sql(sql)
+		db.commit()
+	for sql in WIDEN.get(engine, []):
+		db.execute_sql(sql)
+
+	stats = dict(activations=0, sessions=0)
+	try:
+		for rows in pages(db, Activation.table, Activation.table_id, ('activation_id',),
+						  batch_size):
+			for row in rows:
+				aid = stored_token(row['activation_id'])
+				if aid is not None:
+					db.update(Activation.table, Activation.table_id, row['user_id'],
+							  {'activation_id': utils.token_digest(aid)})
+					stats['activations'] += 1
+			db.commit()
+
+		# the rows converted get new keys, they are skipped if read again
+		for rows in pages(db, DbSessionStore.table, DbSessionStore.table_id, ('next_id',),
+						  batch_size):
+			for row in rows:
+				sid = stored_token(row['session_id'])
+				if sid is None:
+					continue
+				# next_id of a row not converted is an identifier too
+				next_id = stored_token(row['next_id']) if row['next_id'] else None
+				db.update(DbSessionStore.table, DbSessionStore.table_id, row['session_id'],
+						  {'session_id': utils.token_digest(sid),
+						   'next_id': utils.seal_token(next_id, sid) if next_id else None})
+				stats['sessions'] += 1
+			db.commit()
+		# sessions are not kept in the logins table anymore
+		db.execute_sql("update %s set session_id='' where session_id<>''" % Login.table)
+		db.commit()
+	except Exception:
+		db.rollback()
+		raise
+
+	for sql in NARROW.get(engine, []):
+		db.execute_sql(sql)
+	create_indexes(db)
+	return stats
+
+
+def migrate(factory, batch_size=1000):
+	"""
+	Runs the migrations on a database
+
+	Arguments:
+	factory(dbapi.DbFactory) -- factory of the database
+	batch_size(int) -- rows converted in each transaction
+
+	Returns:
+	dict -- number of rows converted by table
+	"""
+	db = factory.get_db()
+	db.context = 'migrate'
+	try:
+		return hash_tokens(db, batch_size)
+	finally:
+		db.close_cursor()
+		db.close_connection()
+
+
+if __name__ == "__main__":
+	logging.basicConfig(filename='pysaa.log', level=logging.INFO)
+	parser = argparse.ArgumentParser(description="Migrates a PySAA database")
+	parser.add_argument('--batch', type=int, default=1000, help="rows per transaction")
+	parser.add_argument('--tenant', action='append', default=[],
+						help="tenant key, can be repeated (multi-tenant mode)")
+	args = parser.parse_args()
+
+	settings = utils.Settings()
+	if args.tenant:
+		from pysaa.server import Tenants, template
+		for key in args.tenant:
+			if not Tenants.KEY.match(key):
+				print("invalid tenant key %s" % key)
+				sys.exit(1)
+		factories = [(key, dbapi.DbFactory.create(template(settings.TENANT_DATABASE, key), 1, key))
+					 for key in args.tenant]
+	else:
+		factories = [(None, dbapi.DbFactory())]
+	for key, factory in factories:
+		try:
+			stats = migrate(factory, args.batch)
+		except Exception as e:
+			print("migration %sstopped: %s, run again to resume" %
+				  ("of tenant %s " % key if key else "", e))
+			sys.exit(1)
+		print(("tenant %s: " % key if key else "") +
+			  "%(activations)d activations and %(sessions)d sessions converted" % stats)
@@ -3,26 +3,47 @@ model.py
 
 This module implements a ORM layer for mapping data from app domain to database
 All the entities descend from EntityBase, which has the common logic
-necessary to implement CRUD functionality
+necessary to implement CRUD functionality. Rows are read and written through
+the storage engine methods of dbapi.Db (select, insert, update, delete), so
+the entities don't depend on the engine being used (SQL or in-memory)
+
+Entities are cached by the Db object that loads them (identity map), so
+creating the same entity twice with the same Db returns the same instance.
+Writes are deferred until the transaction is committed (unit of work).
+Each write registers an invalidation event, published after the commit
+(see invalidation module), so that caches drop the entities written.
 
 Each entity must specify the next class properties:
  table: name of the table where the Entity data is persisted
  id: name of the primary key of the table
  columns: tuple containing the names of the columns except the id column
+ event_columns: columns whose values are sent in the invalidation events
 
 """
 
 from pysaa import dbapi
+from pysaa.invalidation import Event
 
 
 class EntityBase(object):
 	"""
 	This is the generic class for model entities
-	Contains common logic that generates the SQL statements to get / persist
-	the entities from / to database
+	Contains common logic to get / persist the entities from / to database
 	"""
 
-	def __init__(self, db, id=None):
+	event_columns = ()  # sent in the invalidation events, see event()
+
+	def __new__(cls, db=None, id=None, columns=None):
+		"""
+		Returns the instance already loaded by db for this id, if any
+		"""
+		if id:
+			entity = db.identity_map.get((cls, id))
+			if entity is not None:
+				return entity
+		return object.__new__(cls)
+
+	def __init__(self, db, id=None, columns=None):
 		"""
 		Initializes all columns to None values, and then tries to
 		get values from database, if id is specified in the arguments
@@ -30,17 +51,45 @@ class EntityBase(object):
 		Arguments:
 		db (dbapi.Db)-- Database adapter object
 		id -- object unique id (primary key)
+		columns(tuple) -- if specified, only these columns are read from
+		database. The rest of columns are loaded when they are first accessed
 		"""
+		if '_db' in self.__dict__:
+			return  # instance taken from the identity map, already loaded
+
+		self._dirty = set()  # columns modified since the entity was loaded
 		self._db = db
 
 		# if id is passed, try to get the entity
 		if id:
-			self.get(id)
+			self.get(id, columns)
 		else:
 			# set values to None
 			self.id = None
 			for k in self.columns:
-				setattr(self, k, None)
+				self.__dict__[k] = None
+
+	def __setattr__(self, name, value):
+		"""
+		Keeps track of the columns whose value is changed, so that only
+		these columns are written when the entity is updated
+		"""
+		if name in self.columns:
+			d = self.__dict__
+			if name not in d or d[name] != value:
+				self._dirty.add(name)
+		object.__setattr__(self, name, value)
+
+	def __getattr__(self, name):
+		"""
+		Called only when the attribute is not set: loads the columns that
+		were not read from database when the entity was created
+		"""
+		if name in self.columns and self.__dict__.get('id') is not None:
+			self.load_deferred()
+			return self.__dict__[name]
+		raise AttributeError("'%s' object has no attribute '%s'" %
+							 (self.__class__.__name__, name))
 
 	def __str__(self):
 		"""
@@ -65,30 +114,25 @@ class EntityBase(object):
 				return True
 		return False
 
-	def get(self, id):
+	def get(self, id, columns=None):
 		"""
 		Retrieve object from database and save values in this instance
 		
 		Arguments:
 		id -- entity identifier (primary key)
+		columns(tuple) -- columns being read, all columns if not specified
 		
 		Raises:
 		dbapi.DbError -- if any error happens while reading from database or 
 		if there's more than one entity for the given id
 		"""
-		sql = "select * from %s where %s = {0}" % (
-		self.table, self.table_id)
-		try:
-			self._db.execute_sql(sql, id)
-		except dbapi.DbError as e:
-			raise e
-
-		# if no errors, get result
-		result = self._db.get_result()
+		self._db.flush()  # pending writes must be visible
+		names, result = self.read({self.table_id: id}, columns)
 
-		# if len(result) == 0:
-		# entity is not stored in database, do nothing,
-		# an empty object will be returned 
+		if len(result) == 0:
+			# entity is not stored in database, an empty object will be returned
+			self.id = None
+			self.__dict__.update(dict.fromkeys(self.columns))
 
 		if len(result) > 1:
 			# there must be only one entity for a unique id
@@ -97,7 +141,83 @@ class EntityBase(object):
 
 		if len(result) == 1:
 			self.id = id  # set id
-			self.set(**result[0])  # set values from result
+			if self.table_id in self.columns:
+				self.__dict__[self.table_id] = id
+			self.load_row(names, result[0])  # set values from result
+
+		# remember this entity (even if not found) for the rest of the transaction
+		self._db.identity_map[(self.__class__, id)] = self
+
+	def load_deferred(self):
+		"""
+		Reads from database the columns that have not been loaded yet.
+		If the entity is not found anymore, these columns are set to None
+		"""
+		missing = [k for k in self.columns if not k in self.__dict__]
+		if len(missing) == 0:
+			return
+
+		names, result = self.read({self.table_id: self.id}, missing)
+		if len(result) == 1:
+			self.load_row(names, result[0])
+		else:
+			self.load(**dict.fromkeys(missing))
+
+	def load(self, **kw):
+		"""
+		Set values read from database in this object. Unlike set(), these
+		columns are not marked as modified
+		
+		Arguments:
+		kw -- dictionary containing values to be set
+		
+		Raises:
+		dbapi.DbError -- if a wrong column name is specified in the dictionary
+		"""
+		for k in kw:
+			if not (k in self.columns):
+				raise dbapi.DbError("unknown column: %s" % k)
+		self.__dict__.update(kw)
+		self._dirty.difference_update(kw)
+
+	def read(self, criteria, columns=None, order=None, sort=None):
+		"""
+		Reads rows of the table of this entity, as tuples if the storage
+		engine supports it (Db.tuple_results), as dictionaries otherwise.
+		The column names are checked once per statement
+		
+		Returns:
+		tuple -- column names (tuple), rows (list of tuples or dictionaries)
+		
+		Raises:
+		dbapi.DbError -- if any error happens while reading from database or
+		if a column read is not a column of this entity
+		"""
+		db = self._db
+		if db.tuple_results:
+			names, rows = db.select_tuples(self.table, criteria, columns, order, sort)
+		else:
+			rows = db.select(self.table, criteria, columns, order, sort)
+			names = tuple(columns or (rows[0].keys() if rows else ()))
+		for k in names:
+			if not (k in self.columns):
+				raise dbapi.DbError("unknown column: %s" % k)
+		return names, rows
+
+	def load_row(self, names, row):
+		"""
+		Sets the values of a row returned by read, as load does. Columns
+		have already been checked
+		
+		Arguments:
+		names(tuple) -- column names
+		row(tuple or dict) -- column values
+		"""
+		if isinstance(row, tuple):
+			self.__dict__.update(zip(names, row))
+		else:
+			self.__dict__.update(row)
+		self._dirty.difference_update(names)
 
 	def set(self, **kw):
 		"""
@@ -131,8 +251,9 @@ class EntityBase(object):
 
 	def insert(self):
 		"""
-		Insert this object in database. If no errors, get the the id returned 
-		and set its value
+		Insert this object in database. If the id is given by a column 
+		(not autonumeric) the insert is deferred until commit. If not, it's
+		executed now, in order to get the id generated
 		
 		Returns:
 		bool -- True if the object has been inserted
@@ -140,41 +261,102 @@ class EntityBase(object):
 		Raises:
 		dbapi.DbError -- if any error happens while writing in database
 		"""
-		cols = []  # column names
-		nvals = []
-		vals = {}  # value for each column
+		id = getattr(self, self.table_id, None)
+		if id is None:
+			return self.do_insert()
 
-		# id = getattr(self, self.table_id, None)
-		# if id:
-		# cols.append(self.table_id)
-		# vals.append(id)
+		self.id = id
+		self._db.identity_map[(self.__class__, id)] = self
+		self._db.defer(self, 'insert')
+		return True
 
+	def do_insert(self):
+		"""
+		Executes the insert statement. If no errors, get the the id returned 
+		and set its value
+		
+		Returns:
+		bool -- True if the object has been inserted
+		
+		Raises:
+		dbapi.DbError -- if any error happens while writing in database
+		"""
+		vals = {}  # value for each column
 		for k in self.columns:
 			# id column should be set when id is not autonumeric
 			v = getattr(self, k, None)
 			if not v is None:  #don't insert null values
-				cols.append(k)
-				nvals.append("{%s}" % k)  #{column}
 				vals[k] = v
 
-		cols = ", ".join(cols)  #colum_1, column_2,...column_n
-		nvals = ", ".join(nvals)  #{column_1}, {column_2},...{column_n}
-		sql = "insert into %s (%s) values(%s)" % (
-		self.table, cols, nvals)
-
 		try:
-			self._db.execute_sql(sql, vals)
+			id = self._db.insert(self.table, self.table_id, vals)
 		except dbapi.DbError as e:
 			raise e
 
-		#if no errors, get the id of this object
-		#if it's autonumeric get lastrowid, or get table_id value 
-		self.id = self._db.get_lastrowid() or getattr(self, self.table_id)
+		#if no errors, set the id of this object
+		#if it's autonumeric, it's generated by the database
+		self.id = id
+		self._dirty.clear()
+		self._db.identity_map[(self.__class__, self.id)] = self
+		self._db.add_event(self.event('insert'))
+		return True
+
+	def upsert(self):
+		"""
+		Writes all the values of an entity whose id is given by a column:
+		updates the row, or inserts it if it doesn't exist. Used when the
+		row may have been written by someone else since the entity was
+		loaded (e.g. the write-behind buffer). Executed when the transaction
+		is committed
+		
+		Returns:
+		bool -- True
+		"""
+		self.id = getattr(self, self.table_id)
+		self._db.identity_map[(self.__class__, self.id)] = self
+		self._db.defer(self, 'upsert')
+		return True
+
+	def do_upsert(self):
+		"""
+		Executes the update statement with all the values, and the insert
+		statement if no row was updated
+		
+		Returns:
+		bool -- True if the object has been written
+		
+		Raises:
+		dbapi.DbError -- if any error happens while writing in database
+		"""
+		vals = {}
+		for k in self.columns:
+			v = getattr(self, k, None)
+			if not v is None:  # don't write null values
+				vals[k] = v
+
+		op = 'update'
+		if self._db.update(self.table, self.table_id, self.id, vals) == 0:
+			self._db.insert(self.table, self.table_id, vals)
+			op = 'insert'
+		self._dirty.clear()
+		self._db.add_event(self.event(op))
 		return True
 
 	def update(self):
 		"""
-		Updates entity values in database. 
+		Updates entity values in database. The update is executed when the
+		transaction is committed
+		
+		Returns:
+		bool -- True
+		"""
+		self._db.defer(self, 'update')
+		return True
+
+	def do_update(self):
+		"""
+		Executes the update statement. Only the columns modified since
+		the entity was loaded are written
 		
 		Returns:
 		bool -- True if the object has been updated
@@ -183,39 +365,49 @@ class EntityBase(object):
 		DbError -- if the entity is not in database or there's more than
 		one entity with the same id or any other error happens while updating
 		"""
-		cols = []  # column being updated
 		vals = {}  # values being updated
 		for k in self.columns:
+			if not k in self._dirty:  # column not modified
+				continue
 			v = getattr(self, k, None)
 			if not v is None:  # don't update null values
-				# generate replacement fields: column_name = {column_name}
-				cols.append("%s={%s}" % (k, k))
 				vals[k] = v
-		cols = ", ".join(cols)  # column_1={column_1}, column_2={column_2},...
-		# generate sql with the replacement fields 
-		sql = "update %s set %s where %s = %s" % (
-		self.table,
-		cols,
-		self.table_id,
-		self.id)
+
+		if len(vals) == 0:  # nothing to write
+			return True
+
 		try:
-			self._db.execute_sql(sql, vals)
+			count = self._db.update(self.table, self.table_id, self.id, vals)
 		except dbapi.DbError as e:
 			raise e
 
-		if self._db.get_row_count() == 0:
+		if count == 0:
 			raise dbapi.DbError("update entity %s id = %s not stored in database" %
 								(self.__class__, self.id))
 
-		if self._db.get_row_count() != 1:
+		if count != 1:
 			raise dbapi.DbError("update entity %s id = %s not a singular entity" %
 								(self.__class__, self.id))
 
+		self._dirty.clear()
+		self._db.add_event(self.event('update'))
 		return True
 
 	def delete(self):
 		"""
-		Delete this entity 
+		Delete this entity. The delete is executed when the transaction 
+		is committed
+		
+		Returns:
+		True
+		"""
+		self._db.identity_map.pop((self.__class__, self.id), None)
+		self._db.defer(self, 'delete')
+		return True
+
+	def do_delete(self):
+		"""
+		Executes the delete statement
 		
 		Returns:
 		True if the object has been deleted
@@ -224,21 +416,20 @@ class EntityBase(object):
 		DbError -- if the entity is not in database or there's more than
 		one entity with the same id or any other error happens while deleting
 		"""
-		sql = "delete from %s where %s = %s" % (
-		self.table, self.table_id, self.id)
 		try:
-			self._db.execute_sql(sql)
+			count = self._db.delete(self.table, self.table_id, self.id)
 		except dbapi.DbError as e:
 			raise e
 
-		if self._db.get_row_count() == 0:
+		if count == 0:
 			raise dbapi.DbError("delete entity %s id = %s not stored in database" %
-								(self.__class__, id))
+								(self.__class__, self.id))
 
-		if self._db.get_row_count() != 1:
+		if count != 1:
 			raise dbapi.DbError("delete entity %s id = %s not a singular entity" %
-								(self.__class__, id))
+								(self.__class__, self.id))
 
+		self._db.add_event(self.event('delete'))
 		return True
 
 	def list(self, order=None, sort=None, **kw):
@@ -253,39 +444,80 @@ class EntityBase(object):
 		Returns:
 		list -- A list containing the entities that match the specified criterions
 		"""
-		sql = "select * from %s" % self.table
-
-		orderby = ""
-		if not order is None:
-			if sort is None or sort.lower() != "asc":
-				sort = "desc"
-			orderby = "order by %s %s" % (order, sort)
-		if len(kw):
-			filter = []
-			for k in kw.keys():
-				if not (k in self.columns):
-					raise dbapi.DbError("unknown column: %s" % k)
-				filter.append("%s={%s}" % (k, k))  # column_name={column_name}
-			where = " where " + " and ".join(filter)
-			sql += where  # append where condition
-
-		sql += orderby  # append order by
-
-		try:
-			self._db.execute_sql(sql, kw)
-		except dbapi.DbError as e:
-			raise e
+		for k in kw.keys():
+			if not (k in self.columns):
+				raise dbapi.DbError("unknown column: %s" % k)
 
-		result = self._db.get_result()
-		# build list of entities from result
+		self._db.flush()  # pending writes must be visible
+		names, rows = self.read(kw, order=order, sort=sort)
+		if not rows:
+			return []
+		if not isinstance(rows[0], tuple):
+			return [self.build(row) for row in rows]
+
+		# build list of entities from the tuples, without calling __init__
+		cls = self.__class__
+		db = self._db
+		identity_map = db.identity_map
+		pos = names.index(self.table_id)
 		entities = []
-		for row in result:
+		for row in rows:
+			key = (cls, row[pos])
+			entity = identity_map.get(key)
+			if entity is None:  # not loaded yet in this transaction
+				entity = object.__new__(cls)
+				d = entity.__dict__
+				d['_dirty'] = set()
+				d['_db'] = db
+				d.update(zip(names, row))
+				d['id'] = row[pos]
+				identity_map[key] = entity
+			entities.append(entity)
+		return entities
+
+	def build(self, row):
+		"""
+		Creates the entity for a row read from database. If the entity has
+		already been loaded in this transaction, that instance is returned
+		
+		Arguments:
+		row(dict) -- column values, including the id column
+		
+		Returns:
+		EntityBase -- entity of the same class as this one
+		"""
+		identity_map = self._db.identity_map
+		key = (self.__class__, row[self.table_id])
+		entity = identity_map.get(key)
+		if entity is None:  # not loaded yet in this transaction
 			entity = self.__class__(self._db)
-			entity.set(**row)
+			entity.load(**row)
 			entity.id = row[self.table_id]
-			entities.append(entity)
+			identity_map[key] = entity
+		return entity
 
-		return entities
+	def event(self, op):
+		"""
+		Arguments:
+		op(str) -- 'insert', 'update' or 'delete'
+		
+		Returns:
+		invalidation.Event -- event describing the write of this entity.
+		Columns not loaded are sent as None, they are not read for this.
+		Binary values (digests) are sent in hexadecimal
+		"""
+		values = dict([(k, self.__dict__.get(k)) for k in self.event_columns])
+		for k, v in values.items():
+			if isinstance(v, bytes):
+				values[k] = v.hex()
+		return Event(self.__class__.__name__, self.id, op, values)
+
+	def values(self):
+		"""
+		Returns:
+		dict -- column:value pairs of this entity
+		"""
+		return dict([(k, getattr(self, k, None)) for k in self.columns])
 
 
 class User(EntityBase):
@@ -296,15 +528,25 @@ class User(EntityBase):
 	table = 'users'
 	table_id = 'user_id'
 	columns = ('user_id', 'email', 'password', 'status', 'role_id')
+	event_columns = ('email', 'role_id')
 
 
 class Activation(EntityBase):
+	"""
+	Pending activation of a user. activation_id is the digest of the
+	identifier sent to the user, see utils.token_digest
+	"""
 	table = 'activations'
 	table_id = 'user_id'
 	columns = ('user_id', 'activation_id', 'created')
+	event_columns = ('activation_id',)
 
 
 class Login(EntityBase):
+	"""
+	Last login attempt of a user, used to count the wrong attempts and to
+	block the user. Sessions are kept apart, see sessions module
+	"""
 	STATUS_REFUSED = 0
 	STATUS_ACCEPTED = 1
 
@@ -317,6 +559,7 @@ class Permission(EntityBase):
 	table = 'permissions'
 	table_id = 'permission_id'
 	columns = ('permission_id', 'role_id', 'object_id')
+	event_columns = ('role_id', 'object_id')
 
 
 class Role(EntityBase):
@@ -327,6 +570,35 @@ class Role(EntityBase):
 	table = 'roles'
 	table_id = 'role_id'
 	columns = ('role_id', 'parent_id')  # add name/description? actually we don't need it
+	event_columns = ('parent_id',)
+
+	def list_permissions(self):
+		"""
+		Reads the objects that this role and its parent roles can access to
+		
+		Returns:
+		list -- object identifiers (str)
+		
+		Raises:
+		dbapi.DbError -- if any error happens while reading from database
+		"""
+		rows = self._db.select_hierarchy(self.table, self.table_id, 'parent_id', self.id,
+										 Permission.table, ('object_id',))
+		return [row['object_id'] for row in rows]
+
+	def list_ancestors(self):
+		"""
+		Reads the identifiers of this role and of its parent roles
+
+		Returns:
+		list -- role identifiers (int)
+
+		Raises:
+		dbapi.DbError -- if any error happens while reading from database
+		"""
+		rows = self._db.select_hierarchy(self.table, self.table_id, 'parent_id', self.id,
+										 self.table, (self.table_id,))
+		return [row[self.table_id] for row in rows]
 
 
 if __name__ == "__main__":
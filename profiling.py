@@ -0,0 +1,258 @@
+"""
+profiling.py
+
+This module implements on-demand profiling of requests, to find out where
+the time goes when some requests are slow under real load. A Profiler runs
+cProfile on a sample of the requests (1 in N) and/or keeps the profiles of
+the requests slower than a threshold. Profiles are aggregated by request type
+and written to a directory as:
+
+pysaa-<pid>-<type>.pstats -- pstats file, readable by pstats, snakeviz...
+pysaa-<pid>-<type>.folded -- collapsed stacks, input of flamegraph.pl/speedscope
+pysaa-<pid>-memory.txt -- top allocations (tracemalloc), if memory tracing is on
+
+Profiling can be enabled and disabled at runtime, by calling enable/disable
+on the profiler of the server, or by sending a signal (toggle_on_signal)
+"""
+
+import atexit
+import cProfile
+import itertools
+import logging
+import os
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+
+# number of allocation sites written to the memory report
+MEMORY_TOP = 30
+
+# maximum depth of the collapsed stacks
+FOLDED_DEPTH = 64
+
+
+class Profiler(object):
+	"""
+	Profiles the processing of requests, when enabled. Can be shared by
+	several threads, each request is profiled in the thread that runs it
+	"""
+
+	def __init__(self, rate=0, slow=None, memory=False, directory=None, interval=10):
+		"""
+		Arguments:
+		rate(int) -- profile 1 in rate requests, 0 to disable sampling
+		slow(float) -- keep the profiles of the requests slower than this
+		(seconds), None to disable. Note that every request is profiled
+		while it's set
+		memory(bool) -- trace memory allocations with tracemalloc
+		directory(str) -- where the output is written
+		interval(float) -- minimum seconds between two writes of the output
+		"""
+		self.directory = directory or "."
+		self.interval = interval
+		self.rate = 0
+		self.slow = None
+		self.memory = False
+		self.active = False
+		self._counter = itertools.count()
+		self._stats = {}  # request type -> pstats.Stats
+		self._lock = threading.Lock()  # protects _stats
+		self._written = time.time()
+		if rate or slow is not None or memory:
+			self.enable(rate, slow, memory)
+
+	def enable(self, rate=0, slow=None, memory=False):
+		"""
+		Starts profiling the requests, replacing the previous configuration
+
+		Arguments:
+		rate(int) -- profile 1 in rate requests, 0 to disable sampling
+		slow(float) -- keep the profiles of the requests slower than this
+		memory(bool) -- trace memory allocations
+		"""
+		self.rate = rate
+		self.slow = slow
+		if memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+		elif not memory and self.memory:
+			tracemalloc.stop()
+		self.memory = memory
+		self.active = bool(rate or slow is not None)
+		if not self.active and not memory:
+			return
+		atexit.register(self.write)
+		logging.info("profiling enabled: rate %s, slow %s, memory %s" % (rate, slow, memory))
+
+	def disable(self):
+		"""
+		Stops profiling and writes the output collected so far
+		"""
+		self.active = False
+		self.write()
+		if self.memory:
+			tracemalloc.stop()
+			self.memory = False
+		atexit.unregister(self.write)
+		logging.info("profiling disabled")
+
+	def toggle(self, rate=0, slow=None, memory=False):
+		"""
+		Enables the profiler with this configuration if it's disabled, or
+		disables it otherwise
+		"""
+		if self.active or self.memory:
+			self.disable()
+		else:
+			self.enable(rate, slow, memory)
+
+	def call(self, name, func, *args):
+		"""
+		Calls a function, profiling it if the request is selected
+
+		Arguments:
+		name(str) -- request type, profiles are aggregated by name
+		func(function) -- processing of the request
+
+		Returns:
+		object -- value returned by func
+		"""
+		if not self.active:
+			return func(*args)
+		sampled = self.rate and next(self._counter) % self.rate == 0
+		if not sampled and self.slow is None:
+			return func(*args)
+
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:  # another profiler is running in this process
+			return func(*args)
+		start = time.perf_counter()
+		try:
+			return func(*args)
+		finally:
+			profile.disable()
+			elapsed = time.perf_counter() - start
+			slow = self.slow is not None and elapsed >= self.slow
+			if slow:
+				logging.warning("slow request %s: %.1f ms" % (name, elapsed * 1000))
+			if sampled or slow:
+				self.add(name, profile)
+
+	def add(self, name, profile):
+		"""
+		Aggregates a profile with the previous ones of the same request type
+		"""
+		profile.create_stats()
+		with self._lock:
+			if name in self._stats:
+				self._stats[name].add(profile)
+			else:
+				self._stats[name] = pstats.Stats(profile)
+		if time.time() - self._written >= self.interval:
+			self.write()
+
+	def write(self):
+		"""
+		Writes the aggregated profiles, and the memory report
+		"""
+		self._written = time.time()
+		with self._lock:
+			stats = list(self._stats.items())
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			prefix = os.path.join(self.directory, "pysaa-%d-" % os.getpid())
+			for name, st in stats:
+				with self._lock:
+					st.dump_stats(prefix + name + ".pstats")
+					lines = fold_stats(st.stats)
+				with open(prefix + name + ".folded", 'w') as f:
+					f.writelines("%s %d\n" % line for line in lines)
+			if self.memory and tracemalloc.is_tracing():
+				self.write_memory(prefix + "memory.txt")
+		except OSError as e:
+			logging.error("could not write profiles: %s" % e)
+
+	def write_memory(self, path):
+		"""
+		Writes the allocation sites using more memory
+		"""
+		# leave out the memory used by the profiler itself
+		snapshot = tracemalloc.take_snapshot().filter_traces(
+			[tracemalloc.Filter(False, module.__file__)
+			 for module in (tracemalloc, pstats, cProfile)] +
+			[tracemalloc.Filter(False, __file__)])
+		current, peak = tracemalloc.get_traced_memory()
+		with open(path, 'w') as f:
+			f.write("traced memory: current %d KiB, peak %d KiB\n" % (current // 1024, peak // 1024))
+			for stat in snapshot.statistics('lineno')[:MEMORY_TOP]:
+				f.write("%s\n" % stat)
+
+	def reset(self):
+		"""
+		Forgets the profiles collected so far
+		"""
+		with self._lock:
+			self._stats = {}
+
+
+def fold_stats(stats):
+	"""
+	Converts pstats data to collapsed stacks. cProfile only records
+	caller -> callee edges, so the time of a function called from several
+	places is split among the stacks in proportion to the calls of each edge
+
+	Arguments:
+	stats(dict) -- pstats.Stats.stats: function -> (cc, nc, tt, ct, callers)
+
+	Returns:
+	list -- (stack, microseconds) tuples, frames separated by ';'
+	"""
+	children = {}  # function -> [(callee, cumulative time of the edge)]
+	roots = []
+	for func, (cc, nc, tt, ct, callers) in stats.items():
+		for caller, edge in callers.items():
+			if caller in stats:
+				children.setdefault(caller, []).append((func, edge[3]))
+		if not any(caller in stats for caller in callers):
+			roots.append(func)
+
+	def label(func):
+		filename, line, name = func
+		return "%s:%d(%s)" % (os.path.basename(filename), line, name)
+
+	folded = {}
+
+	def visit(func, path, share, depth):
+		if share < 1e-6:  # less than 1 us, not visible in a flame graph
+			return
+		cc, nc, tt, ct, callers = stats[func]
+		ratio = share / ct if ct else 0
+		stack = path + (label(func),)
+		key = ";".join(stack)
+		folded[key] = folded.get(key, 0) + tt * ratio * 1e6
+		if depth >= FOLDED_DEPTH:
+			return
+		for callee, edge_ct in children.get(func, ()):
+			if label(callee) not in stack:  # don't follow recursion
+				visit(callee, stack, edge_ct * ratio, depth + 1)
+
+	for func in roots:
+		visit(func, (), stats[func][3], 0)
+	return [(stack, t) for stack, t in folded.items() if t >= 1]
+
+
+def toggle_on_signal(profiler, signum=None, rate=100, slow=0.1, memory=False):
+	"""
+	Installs a signal handler that enables or disables the profiler, e.g.
+	kill -USR2 <pid>. Must be called from the main thread
+
+	Arguments:
+	profiler(Profiler) -- profiler toggled
+	signum(int) -- signal number, SIGUSR2 by default
+	rate, slow, memory -- configuration used when the profiler is enabled
+	"""
+	signum = signum or signal.SIGUSR2
+	signal.signal(signum, lambda *args: profiler.toggle(rate, slow, memory))
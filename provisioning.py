@@ -0,0 +1,298 @@
+"""
+provisioning.py
+
+This module registers users in bulk, e.g. when an enterprise customer is
+onboarded. Users are read from a CSV file (header with the columns email
+and pwd, and optionally role_id) or a JSON lines file (one object per line,
+with the same keys), and registered in batches: each batch is a single
+transaction, activation ids are generated at once and the activation mails
+of the batch are sent in a single SMTP session, by a background thread
+
+Users already registered are skipped. If they are not active yet, they
+get a new activation mail: the database only has the digests of the
+activation ids, so a new id replaces the one sent before, keeping its
+creation time. Users whose activation has expired or is missing get a new
+activation, as if they registered again. Emails are compared without
+case. Users are inserted by multi-row statements, their ids are read back
+by email (see dbapi.Db.insert_values)
+
+The number of records done is written to a checkpoint file when each
+batch is committed, so that a provisioning interrupted (e.g. a crash) can
+be resumed: the records committed are skipped, and the batch in progress
+is processed again. The mails of the batches committed but not sent yet
+are lost (at most once delivery): run the provisioning of the file again
+without checkpoint, the users not activated get a new mail
+
+With multi-tenant servers, the users are registered in the database of
+the tenant given (settings.TENANT_DATABASE)
+
+usage: python -m pysaa.provisioning <file> [--batch n] [--checkpoint path]
+[--role role_id] [--no-mail] [--tenant key]
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from pysaa import dbapi, utils
+from pysaa.invalidation import Event
+from pysaa.model import User, Activation, Role
+
+
+def read_users(path, start=0):
+	"""
+	Reads the users of a CSV or JSON lines file (.jsonl, .json)
+
+	Arguments:
+	path(str) -- file path
+	start(int) -- number of records skipped at the beginning
+
+	Returns:
+	generator -- dictionaries with the keys email, pwd and role_id (optional)
+	"""
+	with open(path, newline='') as f:
+		if path.endswith(('.jsonl', '.json')):
+			records = (json.loads(line) for line in f if line.strip())
+		else:
+			records = csv.DictReader(f)
+		for i, record in enumerate(records):
+			if i >= start:
+				yield record
+
+
+class Provisioner(object):
+	"""
+	Registers users in batches, see the module documentation
+	"""
+
+	def __init__(self, batch_size=1000, role_id=None, mail=True, checkpoint=None,
+				 progress=None, factory=None):
+		"""
+		Arguments:
+		batch_size(int) -- users registered in each transaction
+		role_id(int) -- role of the users without role_id, ROLE_STANDARD by default
+		mail(bool) -- send the activation mails
+		checkpoint(str) -- path of the checkpoint file, None to disable it
+		progress(function) -- called after each batch with the statistics
+		(dict) and the seconds elapsed
+		factory(dbapi.DbFactory) -- factory of the database written (e.g.
+		of a tenant), DbFactory() by default
+		"""
+		self.batch_size = batch_size
+		self.factory = factory
+		self.role_id = role_id or Role.ROLE_STANDARD
+		self.mail = mail
+		self.checkpoint = checkpoint
+		self.progress = progress
+		self.t_activation = utils.Settings().T_ACTIVATION
+		self.stats = dict(done=0, registered=0, existing=0, reactivated=0, invalid=0, mailed=0)
+		self._mails = queue.Queue(maxsize=4)  # batches waiting to be mailed
+		self._error = None  # exception raised by the mail thread
+
+	def start_record(self):
+		"""
+		Returns:
+		int -- records done in a previous run, read from the checkpoint file
+		"""
+		if self.checkpoint is None or not os.path.exists(self.checkpoint):
+			return 0
+		with open(self.checkpoint) as f:
+			return json.load(f)['done']
+
+	def run(self, path):
+		"""
+		Registers the users of a file, resuming the previous run if there's
+		a checkpoint
+
+		Arguments:
+		path(str) -- CSV or JSON lines file
+
+		Returns:
+		dict -- statistics: records done (including the ones done by a
+		previous run), users registered, already registered, inactive
+		users given a new activation (expired or missing), invalid records
+		and mails sent
+
+		Raises:
+		dbapi.DbError -- if the users can't be written, the checkpoint
+		contains the last batch written
+		"""
+		start = time.time()
+		self.stats['done'] = self.start_record()
+		mailer = threading.Thread(target=self._send_mails, daemon=True,
+								  name="pysaa-provisioning-mail")
+		mailer.start()
+		db = (self.factory or dbapi.DbFactory()).get_db()
+		db.context = type(self).__name__
+		try:
+			batch = []
+			for record in read_users(path, self.stats['done']):
+				batch.append(record)
+				if len(batch) == self.batch_size:
+					self.provision(db, batch)
+					batch = []
+					if self.progress:
+						self.progress(dict(self.stats), time.time() - start)
+			if batch:
+				self.provision(db, batch)
+		finally:
+			self._mails.put(None)
+			mailer.join()
+			db.close_cursor()
+			db.close_connection()
+		if self._error is not None:
+			raise self._error
+		if self.progress:
+			self.progress(dict(self.stats), time.time() - start)
+		return self.stats
+
+	def provision(self, db, batch):
+		"""
+		Registers a batch of users in a single transaction, and queues their
+		activation mails
+
+		Arguments:
+		db(dbapi.Db) -- Db object
+		batch(list) -- records read from the file
+		"""
+		if self._error is not None:  # don't continue if mails can't be sent
+			raise self._error
+
+		users = {}  # lowercase email -> user row, first record of each email
+		for i, record in enumerate(batch):
+			email = (record.get('email') or '').strip()
+			password = record.get('pwd') or record.get('password')
+			if not '@' in email or not password:
+				self.stats['invalid'] += 1
+				logging.warning("invalid record %d: %s" % (self.stats['done'] + i, email))
+				continue
+			users.setdefault(email.lower(), dict(email=email, password=password,
+												 status=User.STATUS_INACTIVE,
+												 role_id=int(record.get('role_id') or self.role_id)))
+
+		mails = []
+		try:
+			existing = db.select_in(User.table, 'email', [row['email'] for row in users.values()],
+									('user_id', 'email', 'status'))
+			for row in existing:
+				# the database may compare emails without case
+				users.pop(row['email'].lower(), None)
+			self.stats['existing'] += len(existing)
+
+			# users registered before but not activated get a new activation
+			# id. It keeps the creation time while the activation hasn't
+			# expired, expired and missing activations start again, as when
+			# the users register again
+			now = int(time.time())
+			inactive = dict([(row['user_id'], row['email']) for row in existing
+							 if row['status'] == User.STATUS_INACTIVE])
+			created = dict([(act['user_id'], act['created'])
+							for act in db.select_in(Activation.table, 'user_id', list(inactive))])
+			missing = []
+			for uid, aid in zip(inactive, utils.random_strings(len(inactive), 64)):
+				digest = utils.token_digest(aid)
+				if not uid in created:
+					missing.append(dict(user_id=uid, activation_id=digest, created=now))
+					db.add_event(Event('Activation', uid, 'insert', dict(activation_id=digest.hex())))
+				else:
+					values = {'activation_id': digest}
+					if now - created[uid] >= self.t_activation:
+						values['created'] = now
+						self.stats['reactivated'] += 1
+					db.update(Activation.table, Activation.table_id, uid, values)
+					db.add_event(Event('Activation', uid, 'update', dict(activation_id=digest.hex())))
+				mails.append((inactive[uid], aid))
+			db.insert_many(Activation.table, Activation.table_id, missing)
+			self.stats['reactivated'] += len(missing)
+
+			rows = list(users.values())
+			# the ids generated are read back by email, two statements per chunk
+			ids = db.insert_many(User.table, User.table_id, rows, 'email')
+			aids = utils.random_strings(len(rows), 64)
+			acts = [dict(user_id=id, activation_id=utils.token_digest(aid), created=now)
+					for id, aid in zip(ids, aids)]
+			db.insert_many(Activation.table, Activation.table_id, acts)
+			for row, act, aid in zip(rows, acts, aids):
+				db.add_event(Event('User', act['user_id'], 'insert',
+								   dict(email=row['email'], role_id=row['role_id'])))
+				db.add_event(Event('Activation', act['user_id'], 'insert',
+								   dict(activation_id=act['activation_id'].hex())))
+				mails.append((row['email'], aid))
+			db.commit()
+		except Exception:
+			db.rollback()
+			raise
+
+		self.stats['registered'] += len(rows)
+		self.stats['done'] += len(batch)
+		self.write_checkpoint(self.stats['done'])
+		self._mails.put(mails)
+
+	def _send_mails(self):
+		"""
+		Sends the mails of each batch. Runs in a background thread, until
+		None is received
+		"""
+		while True:
+			mails = self._mails.get()
+			if mails is None:
+				return
+			if self._error is not None:
+				continue  # keep consuming, the main thread is stopping
+			try:
+				if self.mail and mails:
+					utils.send_mails(mails)
+					self.stats['mailed'] += len(mails)
+			except Exception as e:
+				logging.exception("could not send the activation mails: %s" % e)
+				self._error = e
+
+	def write_checkpoint(self, done):
+		"""
+		Writes the number of records done, replacing the file atomically
+		"""
+		if self.checkpoint is None:
+			return
+		tmp = self.checkpoint + ".tmp"
+		with open(tmp, 'w') as f:
+			json.dump({'done': done}, f)
+		os.replace(tmp, self.checkpoint)
+
+
+def print_progress(stats, elapsed):
+	print("%(done)d records: %(registered)d registered, %(existing)d already registered "
+		  "(%(reactivated)d reactivated), %(invalid)d invalid, %(mailed)d mails sent" % stats +
+		  ", %.0f users/s" % (stats['registered'] / elapsed if elapsed else 0), flush=True)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(filename='pysaa.log', level=logging.INFO)
+	parser = argparse.ArgumentParser(description="Registers users in bulk")
+	parser.add_argument('file', help="CSV or JSON lines file with the users")
+	parser.add_argument('--batch', type=int, default=1000, help="users per transaction")
+	parser.add_argument('--checkpoint', help="checkpoint file, default: <file>.checkpoint")
+	parser.add_argument('--role', type=int, help="role of the users without role_id")
+	parser.add_argument('--no-mail', action='store_true', help="don't send activation mails")
+	parser.add_argument('--tenant', help="tenant key (multi-tenant mode)")
+	args = parser.parse_args()
+	factory = None
+	if args.tenant is not None:
+		from pysaa.server import Tenants, template
+		if not Tenants.KEY.match(args.tenant):
+			print("invalid tenant key %s" % args.tenant)
+			sys.exit(1)
+		factory = dbapi.DbFactory.create(template(utils.Settings().TENANT_DATABASE, args.tenant),
+										 1, args.tenant)
+	provisioner = Provisioner(args.batch, args.role, not args.no_mail,
+							  args.checkpoint or args.file + ".checkpoint", print_progress, factory)
+	try:
+		provisioner.run(args.file)
+	except Exception as e:
+		print("provisioning stopped: %s, run again to resume" % e)
+		sys.exit(1)
@@ -11,19 +11,22 @@ CREATE TABLE IF NOT EXISTS `pysaadb`.`users` (
 	`password` CHAR(32) NOT NULL,
 	`status` SMALLINT(1) NOT NULL,
 	`role_id` SMALLINT(1)  NOT NULL,
-	PRIMARY KEY (`user_id`) )
+	PRIMARY KEY (`user_id`),
+	UNIQUE INDEX `users_email` (`email`) )
 		DEFAULT CHARACTER SET = utf8;
 						
 CREATE  TABLE IF NOT EXISTS `pysaadb`.`activations` (
 	`user_id` INT(10) NOT NULL,
-	`activation_id` CHAR(64) NOT NULL,
+	`activation_id` BINARY(32) NOT NULL,
 	`created` INT(11) NOT NULL,
-	PRIMARY KEY (`user_id`) )
+	PRIMARY KEY (`user_id`),
+	UNIQUE INDEX `activations_activation_id` (`activation_id`) )
 		DEFAULT CHARACTER SET = utf8;
 						
 CREATE  TABLE IF NOT EXISTS `pysaadb`.`logins` (
 	`user_id` INT(10) NOT NULL,
 	`session_id` CHAR(64)  NULL,
+	`status` SMALLINT(1) NOT NULL,
 	`attempts` TINYINT(2) NOT NULL,
 	`created` INT(11) NOT NULL,
 	PRIMARY KEY (`user_id`) )
@@ -33,7 +36,8 @@ CREATE  TABLE IF NOT EXISTS `pysaadb`.`permissions` (
 	`permission_id` INT(10) UNSIGNED NOT NULL,
 	`role_id` SMALLINT(1) UNSIGNED NOT NULL,
 	`object_id` VARCHAR(255) NOT NULL,
-	PRIMARY KEY (`permission_id`) )
+	PRIMARY KEY (`permission_id`),
+	INDEX `permissions_role_id` (`role_id`) )
 		DEFAULT CHARACTER SET = utf8;
 					
 CREATE  TABLE IF NOT EXISTS `pysaadb`.`roles` (
@@ -41,6 +45,16 @@ CREATE  TABLE IF NOT EXISTS `pysaadb`.`roles` (
 	`parent_id` SMALLINT(1) UNSIGNED  NULL ,
 	PRIMARY KEY (`role_id`) )
 		DEFAULT CHARACTER SET = utf8;
+CREATE  TABLE IF NOT EXISTS `pysaadb`.`sessions` (
+	`session_id` BINARY(32) NOT NULL,
+	`user_id` INT(10) NOT NULL,
+	`created` INT(11) NOT NULL,
+	`expires` INT(11) NOT NULL,
+	`next_id` VARBINARY(64) NULL,
+	PRIMARY KEY (`session_id`),
+	INDEX `sessions_user_id` (`user_id`),
+	INDEX `sessions_expires` (`expires`) )
+		DEFAULT CHARACTER SET = utf8;
 --foreign keys
 ALTER TABLE `pysaadb`.`activations` 
 	ADD FOREIGN KEY ( `user_id` ) 
@@ -56,4 +70,8 @@ ALTER TABLE `pysaadb`.`users`
 
 ALTER TABLE `pysaadb`.`roles`
 	ADD FOREIGN KEY ( `parent_id` )
-	REFERENCES `pyauthdb`.`roles` (`role_id`)
\ No newline at end of file
+	REFERENCES `pyauthdb`.`roles` (`role_id`)
+
+ALTER TABLE `pysaadb`.`sessions`
+	ADD FOREIGN KEY ( `user_id` )
+	REFERENCES `pyauthdb`.`users` (`user_id`)
@@ -0,0 +1,49 @@
+/**
+ * pysaa_sqlite.sql
+ * script used to create database schema needed by pysaa, SQLite version
+ * 
+ */
+CREATE TABLE IF NOT EXISTS `roles` (
+	`role_id` SMALLINT NOT NULL,
+	`parent_id` SMALLINT NULL REFERENCES `roles` (`role_id`),
+	PRIMARY KEY (`role_id`) );
+
+CREATE TABLE IF NOT EXISTS `users` (
+	`user_id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`email` VARCHAR(255) NOT NULL,
+	`password` CHAR(32) NOT NULL,
+	`status` SMALLINT NOT NULL,
+	`role_id` SMALLINT NOT NULL REFERENCES `roles` (`role_id`) );
+
+CREATE TABLE IF NOT EXISTS `activations` (
+	`user_id` INTEGER NOT NULL REFERENCES `users` (`user_id`),
+	`activation_id` BLOB NOT NULL,
+	`created` INT NOT NULL,
+	PRIMARY KEY (`user_id`) );
+
+CREATE TABLE IF NOT EXISTS `logins` (
+	`user_id` INTEGER NOT NULL REFERENCES `users` (`user_id`),
+	`session_id` CHAR(64) NULL,
+	`status` SMALLINT NOT NULL,
+	`attempts` TINYINT NOT NULL,
+	`created` INT NOT NULL,
+	PRIMARY KEY (`user_id`) );
+
+CREATE TABLE IF NOT EXISTS `sessions` (
+	`session_id` BLOB NOT NULL PRIMARY KEY,
+	`user_id` INTEGER NOT NULL REFERENCES `users` (`user_id`),
+	`created` INT NOT NULL,
+	`expires` INT NOT NULL,
+	`next_id` BLOB NULL );
+
+CREATE TABLE IF NOT EXISTS `permissions` (
+	`permission_id` INTEGER NOT NULL,
+	`role_id` SMALLINT NOT NULL REFERENCES `roles` (`role_id`),
+	`object_id` VARCHAR(255) NOT NULL,
+	PRIMARY KEY (`permission_id`) );
+
+CREATE UNIQUE INDEX IF NOT EXISTS `users_email` ON `users` (`email`);
+CREATE UNIQUE INDEX IF NOT EXISTS `activations_activation_id` ON `activations` (`activation_id`);
+CREATE INDEX IF NOT EXISTS `permissions_role_id` ON `permissions` (`role_id`);
+CREATE INDEX IF NOT EXISTS `sessions_user_id` ON `sessions` (`user_id`);
+CREATE INDEX IF NOT EXISTS `sessions_expires` ON `sessions` (`expires`);
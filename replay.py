@@ -0,0 +1,315 @@
+"""
+replay.py
+
+This module captures the requests handled by a server, and replays the
+captured traffic offline, to size the hardware and to test changes with
+real traffic shapes
+
+Capture: PySAAServer writes each request to a JSON lines file if
+settings.CAPTURE_FILE is set, or if its capture attribute is set to a
+Capture object. Each line contains the time the request was received, its
+parameters, the result, the error message and the processing time (ms).
+Emails, passwords, session and activation ids are replaced by keyed
+hashes: a value always gets the same hash in a capture, so the requests of
+each user and session can be followed, but the values can't be recovered
+without the key. The key is kept in a file next to the capture (<file>.key,
+readable by its owner only), so that the processes and restarts appending
+to a capture hash the values the same way. It's not needed to replay: keep
+it private, or delete it when the capture is done
+
+Replay: the captured requests are sent to the worker pool of a PySAAServer
+in this process, at the original pace, N times faster, or as fast as
+possible. The database is seeded first with the users, sessions and
+permissions the capture needs, so that the requests succeed or fail as
+they did originally (activations fail, their ids can't be recovered).
+Like the benchmarks, it runs on the in-memory storage engine, or on a
+SQLite database if PYSAA_BENCH_DB is set. Activation mails are not sent
+
+usage: python -m pysaa.replay <file> [--speed x] [--flat] [--workers n]
+"""
+
+import argparse
+import atexit
+import functools
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+# request parameters replaced by hashes in the capture
+SANITIZED = ('email', 'pwd', 'sid', 'aid')
+
+# domain of the emails of the users created by the replay
+REPLAY_DOMAIN = "replay.pysaa"
+
+
+def outcome(response):
+	"""
+	Arguments:
+	response -- response of the server, a dict, or the value returned by a
+	request that failed without one (e.g. False after a database error)
+
+	Returns:
+	tuple -- result (bool) and error message of the response
+	"""
+	if not isinstance(response, dict):
+		return False, "internal error"
+	return bool(response.get('result')), response.get('error')
+
+
+class Capture(object):
+	"""
+	Appends the requests handled by a server to a JSON lines file. Can be
+	shared by the worker threads
+	"""
+
+	def __init__(self, path):
+		"""
+		Arguments:
+		path(str) -- file path, appended if it exists
+		"""
+		self.path = path
+		self._key = self.load_key(path + ".key")
+		self._file = open(path, 'a', encoding='utf-8')
+		self._lock = threading.Lock()
+		atexit.register(self.close)
+
+	@staticmethod
+	def load_key(path):
+		"""
+		Returns:
+		bytes -- key of the hashes read from the file, created with a
+		random key if it doesn't exist
+		"""
+		if not os.path.exists(path):
+			# written aside and linked, processes starting at once get the same key
+			tmp = "%s.%d.tmp" % (path, os.getpid())
+			with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+				f.write(os.urandom(16))
+			try:
+				os.link(tmp, path)
+			except FileExistsError:
+				pass
+			finally:
+				os.remove(tmp)
+		with open(path, 'rb') as f:
+			key = f.read()
+		if len(key) != 16:
+			raise ValueError("invalid capture key file %s" % path)
+		return key
+
+	def hash(self, value):
+		"""
+		Returns:
+		str -- keyed hash of the value, empty values are kept (e.g. the sid
+		of anonymous requests)
+		"""
+		if not value:
+			return value
+		return hashlib.blake2b(str(value).encode('utf-8'), key=self._key,
+							   digest_size=12).hexdigest()
+
+	def write(self, received, request, response):
+		"""
+		Writes a request handled
+
+		Arguments:
+		received(float) -- timestamp of the reception of the request
+		request(dict) -- request parameters, copied before processing it
+		response -- response of the server, see outcome
+		"""
+		params = dict([(k, self.hash(v) if k in SANITIZED else v) for k, v in request.items()])
+		result, error = outcome(response)
+		line = json.dumps({'ts': round(received, 6), 'request': params,
+						   'result': result, 'error': error,
+						   'ms': round((time.time() - received) * 1000, 3)})
+		with self._lock:
+			if not self._file.closed:
+				self._file.write(line + "\n")
+
+	def close(self):
+		with self._lock:
+			if not self._file.closed:
+				self._file.close()
+
+
+def read_capture(path):
+	"""
+	Returns:
+	list -- records of a capture file, sorted by reception time
+	"""
+	with open(path, encoding='utf-8') as f:
+		records = [json.loads(line) for line in f if line.strip()]
+	records.sort(key=lambda record: record['ts'])
+	return records
+
+
+def seed(records):
+	"""
+	Creates an empty database with the data needed by the captured requests:
+	the objects granted in the capture, the users that logged in, and a
+	session for each valid session id found (all of them owned by the same
+	user)
+
+	Arguments:
+	records(list) -- records of the capture
+
+	Returns:
+	dict -- session id hash -> session identifier created
+	"""
+	from pysaa import bench, dbapi, utils
+	from pysaa.model import User, Role, Permission
+	from pysaa.server import DEFAULT_TENANT
+
+	if bench.BENCH_DB:
+		bench.create_sqlite_db(bench.BENCH_DB)
+	db = dbapi.DbFactory().get_db()
+	for rid, parent in ((Role.ROLE_ANONYMOUS, None), (Role.ROLE_STANDARD, Role.ROLE_ANONYMOUS),
+						(Role.ROLE_EXTENDED, Role.ROLE_STANDARD)):
+		role = Role(db)
+		role.set(role_id=rid, parent_id=parent)
+		role.save()
+
+	public, granted, logins, sids = set(), set(), {}, set()
+	for record in records:
+		request = record['request']
+		sid = request.get('sid')
+		if sid and not record.get('error'):  # valid session
+			sids.add(sid)
+		if request['type'] == 'authorize' and record['result']:
+			(granted if sid else public).add(request['oid'])
+		elif request['type'] == 'login' and record['result']:
+			logins[request['email']] = request['pwd']
+
+	for rid, objects in ((Role.ROLE_ANONYMOUS, public), (Role.ROLE_STANDARD, granted - public)):
+		for oid in sorted(objects):
+			permission = Permission(db)
+			permission.set(role_id=rid, object_id=oid)
+			permission.save()
+	for email, pwd in logins.items():
+		user = User(db)
+		user.set(email="%s@%s" % (email, REPLAY_DOMAIN), password=pwd,
+				 status=User.STATUS_ACTIVE, role_id=Role.ROLE_STANDARD)
+		user.save()
+	user = User(db)
+	user.set(email="sessions@" + REPLAY_DOMAIN, password="", status=User.STATUS_ACTIVE,
+			 role_id=Role.ROLE_STANDARD)
+	user.save()
+	ttl = utils.Settings().T_SESSION
+	sessions = dict([(sid, DEFAULT_TENANT.sessions.create(user.id, ttl, db)) for sid in sids])
+	db.commit()
+	db.close_cursor()
+	db.close_connection()
+	return sessions
+
+
+def replay(records, sessions, speed=1.0, workers=None):
+	"""
+	Sends the captured requests to a server
+
+	Arguments:
+	records(list) -- records of the capture
+	sessions(dict) -- session ids created by seed
+	speed(float) -- pace of the requests, relative to the original one.
+	0 sends them as fast as the worker pool accepts them
+	workers(int) -- size of the worker pool, settings.WORKERS by default
+
+	Returns:
+	dict -- statistics: requests sent, refused (queue full or overload), failed
+	(exception) and with a result different from the original one,
+	latencies by request type (seconds, from the submission to the
+	response), maximum delay behind the original pace, and duration
+	"""
+	from pysaa.server import PySAAServer, ServerBusyError
+
+	server = PySAAServer(workers=workers)
+	server.warmup()
+	stats = dict(sent=0, refused=0, failed=0, mismatches=0, lag=0.0, latencies={})
+	lock = threading.Lock()
+	pending = []
+
+	def done(record, submitted, future):
+		elapsed = time.perf_counter() - submitted
+		with lock:
+			if future.exception() is not None:
+				stats['failed'] += 1
+				return
+			response = future.result()
+			if isinstance(response, dict) and response.get('busy'):  # admission control
+				stats['refused'] += 1
+				return
+			stats['latencies'].setdefault(record['request']['type'], []).append(elapsed)
+			if outcome(response)[0] != record['result']:
+				stats['mismatches'] += 1
+
+	# as fast as possible: wait for a place in the queue instead of failing
+	timeout = None if speed else 60
+	start = time.perf_counter()
+	first = records[0]['ts'] if records else 0
+	for record in records:
+		if speed:
+			delay = (record['ts'] - first) / speed - (time.perf_counter() - start)
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				stats['lag'] = max(stats['lag'], -delay)
+		request = dict(record['request'])
+		if request.get('email'):
+			request['email'] = "%s@%s" % (request['email'], REPLAY_DOMAIN)
+		if request.get('sid'):
+			request['sid'] = sessions.get(request['sid'], request['sid'])
+		submitted = time.perf_counter()
+		try:
+			future = server.submit(request, timeout)
+		except ServerBusyError:
+			stats['refused'] += 1
+			continue
+		stats['sent'] += 1
+		future.add_done_callback(functools.partial(done, record, submitted))
+		pending.append(future)
+	for future in pending:
+		future.exception()  # wait for all the responses
+	stats['duration'] = time.perf_counter() - start
+	server.shutdown()
+	return stats
+
+
+def print_report(stats, records):
+	"""
+	Prints the throughput and the latency distribution of each request type
+	"""
+	duration = stats['duration']
+	original = records[-1]['ts'] - records[0]['ts'] if records else 0
+	print("%d requests in %.2f s (captured in %.2f s): %.0f requests/s" %
+		  (stats['sent'], duration, original, stats['sent'] / duration if duration else 0))
+	print("refused %d, failed %d, result different from the capture %d, max lag %.1f ms" %
+		  (stats['refused'], stats['failed'], stats['mismatches'], stats['lag'] * 1000))
+	print("%-10s %8s %9s %9s %9s %9s" % ("type", "requests", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+	for name, latencies in sorted(stats['latencies'].items()):
+		latencies.sort()
+		n = len(latencies)
+		print("%-10s %8d %9.2f %9.2f %9.2f %9.2f" %
+			  (name, n, latencies[n // 2] * 1000, latencies[int(n * 0.9)] * 1000,
+			   latencies[int(n * 0.99)] * 1000, latencies[-1] * 1000))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Replays captured PySAA traffic")
+	parser.add_argument('file', help="capture file (JSON lines)")
+	parser.add_argument('--speed', type=float, default=1.0,
+						help="pace relative to the capture, e.g. 10 for 10x faster")
+	parser.add_argument('--flat', action='store_true', help="send requests as fast as possible")
+	parser.add_argument('--workers', type=int, help="size of the worker pool")
+	args = parser.parse_args()
+
+	from pysaa import bench, utils  # configures the database, as the benchmarks
+	utils.send_mails = lambda activations: None  # activation mails are not sent
+
+	records = read_capture(args.file)
+	if not records:
+		print("no requests in %s" % args.file)
+		sys.exit(1)
+	sessions = seed(records)
+	print_report(replay(records, sessions, 0 if args.flat else args.speed, args.workers), records)
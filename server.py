@@ -9,12 +9,24 @@ It decides which request class must be created to accomplish
 the requested action, based on 'type' parameter
 """
 
+import functools
 import logging
+import re
+import threading
 import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import pysaa.utils as utils
-from pysaa.model import User, Activation, Login, Role, Permission
-from pysaa.dbapi import dbconn
+from pysaa.model import User, Activation, Login, Role
+from pysaa.dbapi import dbconn, DbFactory
+from pysaa.admission import AdmissionController
+from pysaa.profiling import Profiler
+from pysaa.replay import Capture
+from pysaa.sessions import get_store
+from pysaa.invalidation import get_bus
+from pysaa.writebehind import WriteBehindBuffer
 
 
 class PySAARequest(object):
@@ -30,6 +42,15 @@ class PySAARequest(object):
 		kw(dict) -- request data
 		"""
 		self.data = kw
+		self.tenant = DEFAULT_TENANT  # database and caches, set by the server
+
+	@property
+	def factory(self):
+		"""
+		Returns:
+		dbapi.DbFactory -- factory of the database of the tenant, used by dbconn
+		"""
+		return self.tenant.factory
 
 	def do_process(self, db):
 		"""
@@ -55,8 +76,13 @@ class PySAARequest(object):
 		Raises:
 		PySAAError -- if there are more than one registered users with this mail
 		"""
+		key = ('email', email)
+		if key in self.tenant.misses:  # email recently looked up and not found
+			return None
+
 		users_list = User(self.db).list(email=email)
 		if len(users_list) == 0:
+			self.tenant.misses.add(key)
 			return None
 		if len(users_list) > 1:
 			raise PySAAError("duplicate email %s, it must be unique " % email)
@@ -64,22 +90,60 @@ class PySAARequest(object):
 		return users_list[0]
 
 
-	def get_login_by_sid(self, sid):
+	def get_session(self, sid):
 		"""
-		Retrieves login data from the session identifier
+		Retrieves a session from the session store
 		
 		Arguments:
 		sid(str) -- session identifier 
 		
 		Returns: 
-		model.Login -- Login entity
-		None -- if no login have been found with this sid
+		dict -- the session, see sessions module
+		None -- if the session doesn't exist or has expired
 		"""
-		log_list = Login(self.db).list(session_id=sid)
-		if len(log_list) == 0:
+		# the caches keep the digests of the sids, as their invalidation events
+		key = ('sid', utils.token_digest(sid).hex())
+		if key in self.tenant.misses:  # unknown sid, don't hit the session store
 			return None
 
-		return log_list[0]
+		# concurrent requests with the same sid share the lookup
+		return self.tenant.flights.do(key, self.load_session, sid, key)
+
+	def load_session(self, sid, key):
+		"""
+		Arguments:
+		sid(str) -- session identifier
+		key(tuple) -- key of the sid in the negative cache
+
+		Returns:
+		dict -- the session
+		None -- if the session doesn't exist or has expired
+		"""
+		session = self.tenant.sessions.get(sid, self.db)
+		if session is None:
+			self.tenant.misses.add(key)
+		return session
+
+	def get_login(self, uid):
+		"""
+		Retrieves login data of a user, including the updates that have not
+		been written yet (write-behind mode)
+		
+		Arguments:
+		uid(int) -- user identifier
+		
+		Returns:
+		model.Login -- Login entity, empty if the user has no login data
+		"""
+		return self.overlay_login(Login(self.db, uid), uid)
+
+	def overlay_login(self, lo, uid=None):
+		"""
+		Applies on the login the values pending to be written, if any
+		"""
+		if self.tenant.login_buffer is not None:
+			self.tenant.login_buffer.overlay(lo, uid)
+		return lo
 
 
 class RegistrationRequest(PySAARequest):
@@ -87,8 +151,28 @@ class RegistrationRequest(PySAARequest):
 	Contains the logic for processing a request for setting a new user
 	"""
 
+	def do_process(self, db=None):
+		response = self.register()
+		if not response:  # database error
+			return response
+		# the activation mail is sent once the activation is committed, and
+		# outside the transaction
+		user, aid = self.activation
+		try:
+			utils.send_mail(user, aid)
+		except Exception:
+			# without activation, the user can register again
+			self.delete_activation(user.id)
+			raise
+		return response
+
 	@dbconn(in_trx=True)
-	def do_process(self, db):
+	def register(self, db):
+		"""
+		Creates the user, or updates it if its activation has expired, and
+		a new activation. The activation is kept in the activation attribute,
+		a (model.User, activation identifier) tuple
+		"""
 		email = self.data['email']
 		password = self.data['pwd']
 
@@ -106,13 +190,22 @@ class RegistrationRequest(PySAARequest):
 			user.password = password
 
 		user.save()
+		self.tenant.misses.discard(('email', email))
 		# create activation object
-		act = self.new_activation(user)
-		utils.send_mail(user, act)
+		self.activation = (user, self.new_activation(user))
 		self.data['result'] = True
 		del (self.data['pwd'])  # don't return password, not necessary
 		return self.data
 
+	@dbconn(in_trx=True)
+	def delete_activation(self, db, uid):
+		"""
+		Deletes the activation of a user, whose mail could not be sent
+		"""
+		act = Activation(self.db, uid)
+		if act:
+			act.delete()
+
 	def check_user(self, user):
 		"""
 		Checks whether the user is active or not
@@ -154,15 +247,18 @@ class RegistrationRequest(PySAARequest):
 		user (model.User) -- user being activated
 		
 		Returns:
-		model.Activation -- activation entity created
+		str -- activation identifier, sent to the user. The database only
+		stores its digest
 		"""
 		now = int(time.time())
 		# generate random activation key
 		hash_id = utils.random_string(64)
+		digest = utils.token_digest(hash_id)
 		act = Activation(self.db, user.id)
-		act.set(user_id=user.id, activation_id=hash_id, created=now)
+		act.set(user_id=user.id, activation_id=digest, created=now)
 		act.save()
-		return act
+		self.tenant.misses.discard(('aid', digest.hex()))
+		return hash_id
 
 
 class ActivationRequest(PySAARequest):
@@ -211,8 +307,15 @@ class ActivationRequest(PySAARequest):
 		model.Activation -- activation entity if it's found
 		None -- if no activation is found
 		"""
-		act_list = Activation(self.db).list(activation_id=aid)
+		# activations are stored and published by the digest of their id
+		digest = utils.token_digest(aid)
+		key = ('aid', digest.hex())
+		if key in self.tenant.misses:  # unknown activation id, don't hit the database
+			return None
+
+		act_list = Activation(self.db).list(activation_id=digest)
 		if len(act_list) == 0:
+			self.tenant.misses.add(key)
 			return None
 		return act_list[0]
 
@@ -238,7 +341,8 @@ class AuthenticationRequest(PySAARequest):
 
 		attempts = 0  # number of wrong attempts
 		last_ts = 0  # timestamp of the last login attempt
-		lo = Login(self.db, user.id)
+		blocked = False
+		lo = self.get_login(user.id)
 		# if lo.session_id:
 		# the user has still a valid session, but the sid is not sent
 		# maybe an error in front-end? 
@@ -256,9 +360,11 @@ class AuthenticationRequest(PySAARequest):
 		#else: check password
 		if user.password == password:
 			#authentication successful, register login
-			lo = self.save_login(user, Login.STATUS_ACCEPTED)
-			#return session identifier
-			self.data['sid'] = lo.session_id
+			self.save_login(user, Login.STATUS_ACCEPTED)
+			#create the session and return its identifier
+			sid = self.tenant.sessions.create(user.id, settings.T_SESSION, self.db)
+			self.tenant.misses.discard(('sid', utils.token_digest(sid).hex()))
+			self.data['sid'] = sid
 			self.data['result'] = True
 			del (self.data['pwd'])  #don't return password, not necessary
 			return self.data
@@ -276,9 +382,11 @@ class AuthenticationRequest(PySAARequest):
 				user.status = User.STATUS_BLOCKED
 				user.update()
 				attempts = 0  #reset counter
+				blocked = True
 
 		#anyway save login and return false
-		self.save_login(user, Login.STATUS_REFUSED, attempts)
+		#if the user has not been blocked, the write can be delayed
+		self.save_login(user, Login.STATUS_REFUSED, attempts, deferred=not blocked)
 		self.data['result'] = False
 		return self.data
 
@@ -301,7 +409,7 @@ class AuthenticationRequest(PySAARequest):
 		if user.status == User.STATUS_BLOCKED:
 			# if user is blocked, don't allow to continue during
 			# the blocking period
-			lo = Login(self.db, user.id)
+			lo = self.get_login(user.id)
 			if lo and (time.time() - lo.created) <= settings.T_BLOCKED:
 				raise AuthenticationError("user %s is temporally blocked, try later" % user.email)
 
@@ -310,7 +418,7 @@ class AuthenticationRequest(PySAARequest):
 			user.status = User.STATUS_ACTIVE
 			user.update()
 
-	def save_login(self, user, status, n=0):
+	def save_login(self, user, status, n=0, deferred=False):
 		"""
 		Creates Login entity and saves login data
 		
@@ -318,19 +426,25 @@ class AuthenticationRequest(PySAARequest):
 		user(model.User) -- User that attempts to log in
 		status(int) - login accepted(1) or refused(0)
 		n(int) - if no login is refused, number of wrong login attempts
+		deferred(bool) - if True and write-behind mode is enabled, login data
+		is written later by the write-behind buffer
 		
 		Returns:
 		model.Login -- the entity containing login data
 		"""
 		now = int(time.time())
-		sid = ""
-		if status == Login.STATUS_ACCEPTED:
-			# authentication successful, generate random session id
-			sid = utils.random_string(64)
-
 		lo = Login(self.db, user.id)
-		lo.set(user_id=user.id, session_id=sid, status=status, attempts=n, created=now)
-		lo.save()
+		# sessions are kept in the session store, session_id is not used
+		values = dict(user_id=user.id, session_id="", status=status, attempts=n, created=now)
+		lo.set(**values)
+		if self.tenant.login_buffer is None:
+			lo.upsert()
+		elif deferred:
+			self.tenant.login_buffer.put(user.id, **values)
+		else:
+			self.tenant.login_buffer.discard(user.id)
+			# the row may have been inserted by the buffer since lo was read
+			lo.upsert()
 		return lo
 
 
@@ -341,67 +455,104 @@ class AuthorizationRequest(PySAARequest):
 	User must have a valid session, identified by sid parameter
 	"""
 
+	def do_process(self):
+		if not self.data['sid']:
+			# anonymous requests are answered from memory, without a connection
+			result = self.tenant.public.get(self.data['oid'])
+			if result is not None:
+				self.data['result'] = result
+				return self.data
+		return self.authorize()
+
 	@dbconn(in_trx=False)
-	def do_process(self, db):
+	def authorize(self, db):
 		role = None
 		sid = self.data['sid']  # session identifier
 		oid = self.data['oid']  # object identifier
 
 		if sid:
-			# try to get login data
-			lo = self.get_login_by_sid(sid)
-			if lo is None:
+			# try to get the session, expired sessions are not found
+			session = self.get_session(sid)
+			if session is None:
 				# wrong hash_id received, expired or someone try to fake?
 				raise AuthenticationError("authentication expired")
 
-			self.check_session(lo)
+			self.check_session(session)
 			# if user authenticated, get user role
-			role = self.get_role_by_uid(lo.user_id)
+			role = self.get_role_by_uid(session['user_id'])
 		else:  # user no authenticated, default role
 			role = Role(self.db, Role.ROLE_ANONYMOUS)
 
+		# most requests repeat a few (role, object) pairs
+		result = self.tenant.decisions.get(role.id, oid)
+		if result is None:
+			result = self.check_permission(role, oid)
+		self.data['result'] = result
+		return self.data
+
+	def check_permission(self, role, oid):
+		"""
+		Decides if a role can access an object, and caches the decision
+
+		Arguments:
+		role(model.Role) -- Role entity
+		oid(str) -- object identifier
+
+		Returns:
+		bool -- True if the object is granted to the role or its parents
+		"""
+		generation = self.tenant.decisions.generation
+		ancestors = self.tenant.decisions.ancestors(role.id)
+		if ancestors is None:
+			ancestors = self.tenant.flights.do(('ancestors', role.id, generation), role.list_ancestors)
 		# get objects granted to this role and its parents
 		permissions = self.get_permissions_by_role(role)
-		# return true if object requested is in the list of granted objects
-		self.data['result'] = oid in permissions
-		return self.data
+		# true if object requested is in the list of granted objects
+		result = oid in permissions
+		self.tenant.decisions.put(role.id, oid, result, ancestors, generation)
+		return result
 
-	def check_session(self, lo):
+	def check_session(self, session):
 		"""
-		Checks if current session is valid. If it has expired, deletes it
-		from database. If not, timestamp is refreshed and new sid is generated
-		if the session is close to expire
+		Keeps the session alive. In sliding mode its expiration time is
+		extended, at most once every T_SESSION_TOUCH seconds. In rotate mode
+		a new session is created when the current one is about to expire,
+		and its identifier is returned in the response. The old sid remains
+		valid during T_SESSION_GRACE seconds, requests using it get the new
+		sid too. Expired sessions are discarded by the session store
 		
 		Arguments:
-		lo(model.Login) -- Login entity 
-		
-		Raises:
-		AuthenticationError -- if session is not valid or has expired
-		"""
-		if lo.status != Login.STATUS_ACCEPTED:
-			# if we got here, it should never happen that the login is not accepted
-			# anyway this will fix any unexpected behaviour
-			lo.delete()
-			raise AuthenticationError("not a valid session")
-
-		now = time.time()
-		if (now - lo.created) >= settings.T_SESSION:
-			# session expired, delete login data
-			lo.delete()
-			raise AuthenticationError("authentication expired")
-
-		# else: refresh login timestamp and create new session id if the
-		# current session is about to expire
-		if (now - lo.created) >= (settings.T_SESSION - settings.T_REFRESH):
-			now = int(time.time())
-			sid = utils.random_string(64)
-			lo.set(session_id=sid, created=now)
-			lo.save()
+		session(dict) -- the session, as returned by the session store
+		"""
+		now = int(time.time())
+		sid = session['session_id']
+		if session.get('next_id'):  # already renewed, in the grace period
+			self.data['sid'] = session['next_id']
+		elif settings.SESSION_REFRESH == 'sliding':
+			expires = now + settings.T_SESSION
+			# last extension was at session['expires'] - T_SESSION, the check
+			# of the touches cache stops the concurrent requests of this process
+			if (expires - session['expires'] >= settings.T_SESSION_TOUCH and
+					self.tenant.touches.claim(utils.token_digest(sid).hex())):
+				self.tenant.sessions.touch(sid, expires, self.db)
+		elif session['expires'] - now <= settings.T_REFRESH:
+			# concurrent requests with this sid share the new session
+			self.data['sid'] = self.tenant.flights.do(('renew', sid), self.renew_session, session)
+
+	def renew_session(self, session):
+		"""
+		Returns:
+		str -- identifier of the session that replaces this one
+		"""
+		sid = self.tenant.sessions.renew(session, settings.T_SESSION, settings.T_SESSION_GRACE, self.db)
+		self.tenant.misses.discard(('sid', utils.token_digest(sid).hex()))
+		return sid
 
 	def get_permissions_by_role(self, role):
 		"""
 		Get a list of the objects ids which a role can access to.
-		Get also the permissions of the parent's role 
+		Get also the permissions of the parent's role. Concurrent requests
+		for the same role share the result, which must not be modified
 		
 		Arguments:
 		role(model.Role) -- Role entity
@@ -409,14 +560,22 @@ class AuthorizationRequest(PySAARequest):
 		Returns:
 		list - a list with object identifiers (string)
 		"""
-		pe_list = Permission(self.db).list(role_id=role.id)
-		oid_list = [p.object_id for p in pe_list]
-		# get permissions also for the parents of this role
-		role = Role(self.db, role.parent_id)
-		if role.parent_id:
-			oid_list.extend(self.get_permissions_by_role(role))
+		# a query started before the last invalidation is not shared
+		return self.tenant.flights.do(('permissions', role.id, self.tenant.decisions.generation),
+						  self.load_permissions, role)
 
-		return oid_list
+	def load_permissions(self, role):
+		"""
+		Reads the objects ids which a role and its parents can access to,
+		the whole hierarchy is read at once
+		
+		Arguments:
+		role(model.Role) -- Role entity
+		
+		Returns:
+		list - a list with object identifiers (string)
+		"""
+		return role.list_permissions()
 
 	def get_role_by_uid(self, uid):
 		"""
@@ -428,8 +587,16 @@ class AuthorizationRequest(PySAARequest):
 		Returns:
 		model.Role -- Role entity 
 		"""
-		user = User(self.db, uid)
-		return Role(self.db, user.role_id)
+		# concurrent requests of the same user share the query
+		role_id = self.tenant.flights.do(('role', uid), self.load_role_id, uid)
+		return Role(self.db, role_id)
+
+	def load_role_id(self, uid):
+		"""
+		Returns:
+		int -- role identifier of the user
+		"""
+		return User(self.db, uid, columns=('role_id',)).role_id
 
 
 class LogoutRequest(PySAARequest):
@@ -440,12 +607,10 @@ class LogoutRequest(PySAARequest):
 
 	@dbconn(in_trx=True)
 	def do_process(self, db):
-		# try to get login data from the id
+		# delete the session, if the user is logged in
 		sid = self.data['sid']  # session identifier
-		lo = self.get_login_by_sid(sid)
-		# if user is logged in, delete login
-		if lo and lo.status == Login.STATUS_ACCEPTED:
-			lo.delete()
+		if (sid and not ('sid', utils.token_digest(sid).hex()) in self.tenant.misses and
+				self.tenant.sessions.remove(sid, self.db)):
 			self.data['result'] = True
 			return self.data
 
@@ -458,6 +623,328 @@ class DefaultRequest(PySAARequest):
 		raise PySAAError("Unrecognized Request type: %s" % self.data['type'])
 
 
+class PublicObjects(object):
+	"""
+	Objects granted to the anonymous role and its parents, kept in memory so
+	that the requests without session are answered without a database
+	connection. The set is loaded by PySAAServer.warmup, and reloaded in
+	background every T_PUBLIC_REFRESH seconds (the previous set is used
+	meanwhile) and when the permissions of these roles change (requests use
+	the database until the new set is loaded)
+	"""
+
+	factory = None  # dbapi.DbFactory of the tenant, DbFactory() if None
+
+	def __init__(self, interval):
+		"""
+		Arguments:
+		interval(int) -- seconds between two reloads, 0 disables the set
+		"""
+		self.interval = interval
+		self.objects = None  # frozenset of object ids, None if not loaded
+		self.ancestors = frozenset()  # anonymous role and its parents
+		self._loaded = 0
+		self._stale = False  # permissions changed since the last load
+		self._generation = 0  # changes received, a load started before is discarded
+		self._loading = False
+		self._lock = threading.Lock()
+
+	def get(self, oid):
+		"""
+		Returns:
+		bool -- True if the object is public
+		None -- if the set can't be used, the database must be read
+		"""
+		if self.interval <= 0:
+			return None
+		objects = self.objects
+		if objects is None or self._stale:
+			self.refresh()
+			return None
+		if time.time() - self._loaded >= self.interval:
+			self.refresh()
+		return oid in objects
+
+	def load(self):
+		"""
+		Reads the objects from database, in the current thread
+
+		Raises:
+		dbapi.DbError -- if any error happens while reading from database
+		"""
+		generation = self._generation
+		db = (self.factory or DbFactory()).get_db()
+		db.context = type(self).__name__
+		try:
+			role = Role(db, Role.ROLE_ANONYMOUS)
+			ancestors = frozenset(role.list_ancestors())
+			objects = frozenset(role.list_permissions())
+		finally:
+			db.close_cursor()
+			db.close_connection()
+		with self._lock:
+			self.ancestors = ancestors
+			self.objects = objects
+			self._loaded = time.time()
+			if generation == self._generation:
+				self._stale = False
+
+	def refresh(self):
+		"""
+		Reloads the objects in a background thread, unless it's being done
+		"""
+		with self._lock:
+			if self._loading:
+				return
+			self._loading = True
+
+		def run():
+			try:
+				self.load()
+				if self._stale:  # changed while loading
+					self.load()
+			except Exception as e:
+				logging.error("could not load the public objects: %s" % e)
+				self._loaded = time.time()  # tried again after the interval
+			finally:
+				self._loading = False
+
+		threading.Thread(target=run, daemon=True, name="pysaa-public-objects").start()
+
+	def invalidate(self, role_id=None):
+		"""
+		Called when the permissions or the parent of a role change
+
+		Arguments:
+		role_id(int) -- the role, None if not known
+		"""
+		if role_id is None or role_id in self.ancestors:
+			with self._lock:
+				self._generation += 1
+				self._stale = True
+			self.refresh()
+
+
+class Tenant(object):
+	"""
+	Database and caches of a tenant. Each tenant has its own users, roles
+	and permissions in its own database, with its own connection pool,
+	session store and caches, so the tenants don't see each other's data.
+	Invalidation events are published and received with the tenant key.
+	The default tenant (key None) uses settings.DATABASE, and is the only
+	one of single tenant servers
+	"""
+
+	def __init__(self, key=None, database=None, sessions=None, pool_size=None):
+		"""
+		Arguments:
+		key(str) -- tenant key, None for the default tenant
+		database(dict) -- database settings of the tenant, as settings.DATABASE
+		sessions(dict) -- session store settings, as settings.SESSION_STORE
+		pool_size(int) -- maximum number of idle connections kept
+		"""
+		self.key = key
+		self.active = 0  # requests being processed, see Tenants
+		self.evicted = False
+		self._factory = None if database is None else DbFactory.create(database, pool_size, key)
+		# negative cache, contains the emails, sids and activation ids that
+		# were not found in database (ids by their hexadecimal digests)
+		self.misses = utils.MissCache(settings.NEGATIVE_CACHE_SIZE, settings.T_NEGATIVE_CACHE)
+		# concurrent identical lookups share a single database query
+		self.flights = utils.SingleFlight()
+		# authorization decisions by (role, object), dropped when permissions change
+		self.decisions = utils.DecisionCache(settings.DECISION_CACHE_SIZE)
+		# objects that anonymous users can access to, answered without database
+		self.public = PublicObjects(settings.T_PUBLIC_REFRESH)
+		self.public.factory = self._factory
+		# sessions of the authenticated users
+		self.sessions = get_store(sessions or settings.SESSION_STORE)
+		self.sessions.factory = self._factory
+		self.sessions.tenant = key
+		# digests of the sessions extended recently (sliding mode), extended
+		# again after T_SESSION_TOUCH
+		self.touches = utils.MissCache(settings.NEGATIVE_CACHE_SIZE, settings.T_SESSION_TOUCH)
+		# write-behind buffer for login bookkeeping, None if the mode is disabled
+		self.login_buffer = None
+		if settings.WRITE_BEHIND:
+			self.login_buffer = WriteBehindBuffer(Login, settings.T_WRITE_BEHIND, self._factory)
+
+		bus = get_bus()
+		for entity in ('User', 'Activation', 'Session'):
+			bus.subscribe(entity, self.drop_misses, key)
+		for entity in ('Permission', 'Role'):
+			bus.subscribe(entity, self.drop_decisions, key)
+
+	@property
+	def factory(self):
+		"""
+		Returns:
+		dbapi.DbFactory -- factory of the database of the tenant
+		"""
+		return self._factory or DbFactory()
+
+	def drop_misses(self, event):
+		"""
+		Forgets the negative cache entries of an entity written in any node,
+		e.g. the email of a user registered
+		"""
+		if event.entity == 'User':
+			self.misses.discard(('email', event.values.get('email')))
+		elif event.entity == 'Activation':
+			self.misses.discard(('aid', event.values.get('activation_id')))
+		elif event.entity == 'Session':  # the id is the digest of the sid
+			self.misses.discard(('sid', event.id))
+			self.touches.discard(event.id)
+
+	def drop_decisions(self, event):
+		"""
+		Forgets the decisions and public objects that depend on a role whose
+		permissions or parent changed in any node
+		"""
+		if event.entity == 'Role':
+			self.decisions.invalidate_role(event.id, hierarchy=True)
+			self.public.invalidate(event.id)
+		elif event.op == 'update' or event.values.get('role_id') is None:
+			# the previous role of the permission is not known
+			self.decisions.clear()
+			self.public.invalidate()
+		else:
+			self.decisions.invalidate_role(event.values['role_id'])
+			self.public.invalidate(event.values['role_id'])
+
+	def warmup(self):
+		"""
+		Opens the pooled connections and loads the public objects
+		"""
+		self.factory.fill_pool()
+		if self.public.interval > 0:
+			self.public.load()
+
+	def close(self):
+		"""
+		Stops receiving events, writes the buffered logins and closes the
+		connections. The tenant must not be used anymore
+		"""
+		bus = get_bus()
+		for entity in ('User', 'Activation', 'Session'):
+			bus.unsubscribe(entity, self.drop_misses, self.key)
+		for entity in ('Permission', 'Role'):
+			bus.unsubscribe(entity, self.drop_decisions, self.key)
+		if self.login_buffer is not None:
+			self.login_buffer.stop()
+		if self._factory is not None:
+			self._factory.close()
+
+
+class Tenants(object):
+	"""
+	Tenants of a multi-tenant server, opened on their first request. The
+	settings of each tenant are made from templates, replacing '{tenant}'
+	in the strings with the tenant key, e.g. the path of its SQLite file.
+	At most size tenants are kept open: the least recently used ones are
+	closed, when their requests in progress end, so a process can serve
+	many more tenants than it can keep connections and caches for
+	"""
+
+	# tenant keys are used in file paths and database names
+	KEY = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+	def __init__(self, database, sessions, size, pool_size):
+		"""
+		Arguments:
+		database(dict) -- database settings template
+		sessions(dict) -- session store settings template
+		size(int) -- maximum number of tenants open
+		pool_size(int) -- maximum number of idle connections of each tenant
+		"""
+		self.database = database
+		self.sessions = sessions
+		self.size = size
+		self.pool_size = pool_size
+		self.opened = 0  # statistics
+		self.closed = 0
+		self._tenants = OrderedDict()  # key -> Tenant, least recently used first
+		self._lock = threading.Lock()
+
+	def acquire(self, key):
+		"""
+		Returns the tenant of a request, opened if needed. Each tenant
+		acquired must be released when the request ends
+
+		Arguments:
+		key(str) -- tenant key
+
+		Returns:
+		Tenant -- the tenant
+
+		Raises:
+		TenantError -- if the key is not valid
+		dbapi.DbError -- if the database of the tenant can't be used
+		"""
+		if not key:
+			raise TenantError("tenant required")
+		if not isinstance(key, str) or not self.KEY.match(key):
+			raise TenantError("tenant not valid: %r" % (key,))
+		evicted = []
+		with self._lock:
+			tenant = self._tenants.get(key)
+			if tenant is None:
+				tenant = Tenant(key, template(self.database, key), template(self.sessions, key),
+								self.pool_size)
+				self._tenants[key] = tenant
+				self.opened += 1
+				while len(self._tenants) > self.size:
+					old = self._tenants.popitem(last=False)[1]
+					old.evicted = True
+					if old.active == 0:
+						evicted.append(old)
+			else:
+				self._tenants.move_to_end(key)
+			tenant.active += 1
+		for old in evicted:
+			self.close(old)
+		return tenant
+
+	def release(self, tenant):
+		"""
+		Called when a request of the tenant ends, closes it if it was evicted
+		"""
+		with self._lock:
+			tenant.active -= 1
+			evicted = tenant.evicted and tenant.active == 0
+		if evicted:
+			self.close(tenant)
+
+	def close(self, tenant):
+		try:
+			tenant.close()
+		except Exception as e:
+			logging.exception("could not close tenant %s: %s" % (tenant.key, e))
+		self.closed += 1
+
+	def stats(self):
+		"""
+		Returns:
+		dict -- tenants open, opened and closed since the server started
+		"""
+		return dict(open=len(self._tenants), opened=self.opened, closed=self.closed)
+
+
+def template(config, key):
+	"""
+	Returns:
+	a copy of the settings (dict, list or str) with '{tenant}' replaced by
+	the tenant key in the strings
+	"""
+	if isinstance(config, dict):
+		return dict([(k, template(v, key)) for k, v in config.items()])
+	if isinstance(config, list):
+		return [template(v, key) for v in config]
+	if isinstance(config, str):
+		return config.replace('{tenant}', key)
+	return config
+
+
 class PySAAError(Exception):
 	"""
 	Generic Exception related to PySAA requests
@@ -481,6 +968,18 @@ class AuthenticationError(PySAAError):
 	Exceptions related to users authentication
 	"""
 
+
+class ServerBusyError(PySAAError):
+	"""
+	Exception raised when the server can't accept more requests
+	"""
+
+
+class TenantError(PySAAError):
+	"""
+	Exception raised if the tenant of a request is missing or not valid
+	"""
+
 # map from request type to AuthRequest subclasses
 REQUEST_CLASSES = {
 	'register': RegistrationRequest,
@@ -497,8 +996,136 @@ class PySAAServer(object):
 	This class provides a single interface to the API. Acts as a front
 	controller, since it decides which request class must be created to 
 	accomplish the requested action, based on 'type' parameter
+
+	Requests can be processed concurrently, from several threads or using
+	the worker pool of the server (submit). Each request uses its own
+	database connection
+
+	The processing of requests can be profiled, see the profiler attribute,
+	and recorded to be replayed later, see the capture attribute. Requests
+	can be refused under overload, see the admission attribute
+
+	If settings.TENANT_DATABASE is set, the server is multi-tenant: each
+	request has a 'tenant' parameter, and uses the database and the caches
+	of that tenant, see the tenants attribute
 	"""
 
+	def __init__(self, workers=None, max_queue=None):
+		"""
+		Arguments:
+		workers(int) -- size of the worker pool, settings.WORKERS by default
+		max_queue(int) -- maximum number of requests waiting for a worker,
+		settings.MAX_QUEUE by default
+		"""
+		self.workers = workers or settings.WORKERS
+		max_queue = settings.MAX_QUEUE if max_queue is None else max_queue
+		# requests being processed or waiting, bounded by workers + max_queue
+		self._slots = threading.BoundedSemaphore(self.workers + max_queue)
+		self._executor = None
+		self._lock = threading.Lock()
+		# enable/disable it at runtime to profile the requests
+		self.profiler = Profiler(settings.PROFILE_RATE, settings.PROFILE_SLOW,
+								 settings.PROFILE_MEMORY, settings.PROFILE_DIR)
+		# set it to a replay.Capture to record the requests handled
+		self.capture = Capture(settings.CAPTURE_FILE) if settings.CAPTURE_FILE else None
+		self.admission = AdmissionController(settings.ADMISSION_LIMITS, settings.ADMISSION_TARGET,
+											 settings.T_QUEUE_DEADLINE or None)
+		self._local = threading.local()  # queue time of the request being processed
+		self.tenants = None  # Tenants, None if the server is single tenant
+		if settings.TENANT_DATABASE:
+			self.tenants = Tenants(settings.TENANT_DATABASE, settings.SESSION_STORE,
+								   settings.MAX_TENANTS, settings.TENANT_POOL_SIZE)
+
+	def submit(self, request, timeout=None):
+		"""
+		Processes the request in the worker pool
+		
+		Arguments:
+		request(dict) -- request parameters, as in handle_request
+		timeout(float) -- seconds to wait if the queue is full, 
+		settings.T_QUEUE by default
+		
+		Returns:
+		Future -- resolved with the response
+		
+		Raises:
+		ServerBusyError -- if the queue is full
+		"""
+		return self.execute(functools.partial(self.handle_request, **request), timeout)
+
+	def execute(self, func, timeout=None):
+		"""
+		Runs a function in the worker pool. Front ends use it to run the
+		whole processing of a request (parsing, response encoding)
+		
+		Arguments:
+		func(function) -- function without arguments
+		timeout(float) -- seconds to wait if the queue is full
+		
+		Returns:
+		Future -- resolved with the value returned by func
+		
+		Raises:
+		ServerBusyError -- if the queue is full
+		"""
+		timeout = settings.T_QUEUE if timeout is None else timeout
+		if not self._slots.acquire(timeout=timeout):
+			raise ServerBusyError("server busy, try later")
+		enqueued = time.monotonic()
+
+		def run():
+			self._local.enqueued = enqueued  # checked by the admission control
+			try:
+				return func()
+			finally:
+				self._local.enqueued = None
+
+		try:
+			future = self.get_executor().submit(run)
+		except Exception:
+			self._slots.release()
+			raise
+		future.add_done_callback(lambda f: self._slots.release())
+		return future
+
+	def warmup(self):
+		"""
+		Prepares the server before receiving requests, so that the first
+		requests don't pay the startup costs: validates the settings, imports
+		the database module, opens the pooled connections, loads the public
+		objects and creates the worker pool. The tenants of a multi-tenant
+		server are opened by their first request
+		
+		Raises:
+		ValueError -- if the settings are not valid
+		dbapi.DbError -- if the database can't be reached
+		"""
+		settings.validate()
+		if self.tenants is None:
+			DEFAULT_TENANT.warmup()
+		self.get_executor()
+
+	def get_executor(self):
+		"""
+		Returns:
+		ThreadPoolExecutor -- the worker pool, created on first use
+		"""
+		if self._executor is None:
+			with self._lock:
+				if self._executor is None:
+					self._executor = ThreadPoolExecutor(max_workers=self.workers,
+														thread_name_prefix="pysaa-worker")
+		return self._executor
+
+	def shutdown(self, wait=True):
+		"""
+		Stops the worker pool, after finishing the requests submitted
+		"""
+		with self._lock:
+			if self._executor is not None:
+				self._executor.shutdown(wait=wait)
+				self._executor = None
+
 	def handle_request(self, **data):
 		"""
 		Handle the request and returns result
@@ -510,33 +1137,63 @@ class PySAAServer(object):
 			data['aid'] -- activation identifier
 			data['sid'] -- session identifier
 			data['oid'] -- object (resource being requested) identifier
+			data['tenant'] -- tenant key, only in multi-tenant servers
 		
 		Returns:
 		dict -- response contains the request parameters, and some more data that the 
 		front-end could need 
 			response['error'] -- error message, if there's any error processing the request
 			response['result'] -- contains the result of the request
+			response['busy'] -- True if the request was refused by the admission
+			control, the client should try later
 			response['email'] -- user email			
 			response['aid'] -- activation identifier
 			responde['sid'] -- session identifier
 		"""
+		type = data['type']
+		capture = self.capture
+		if capture is not None:
+			received = time.time()
+			captured = dict(data)  # processing modifies the parameters
+
+		reason = self.admission.admit(type, getattr(self._local, 'enqueued', None))
+		if reason is not None:
+			response = dict(data, result=False, busy=True,
+							error="server overloaded, try later: %s" % reason)
+			if capture is not None:
+				capture.write(received, captured, response)
+			return response
+
 		# get the class from the request type
-		request_class = REQUEST_CLASSES.get(data['type'], REQUEST_CLASSES['default'])
+		request_class = REQUEST_CLASSES.get(type, REQUEST_CLASSES['default'])
 		# create instance
 		request = request_class(**data)
+		tenant = None
 		# process the request and return the result
 		try:
-			response = request.do_process()
+			if self.tenants is not None:
+				tenant = request.tenant = self.tenants.acquire(data.get('tenant'))
+			response = self.profiler.call(type, request.do_process)
 		except PySAAError as e:
 			# if any error, set result to False and set error info
+			response = request.data
 			response['error'] = str(e)
 			response['result'] = False
+		finally:
+			self.admission.release(type, getattr(request, 'db_time', None))
+			if tenant is not None:
+				self.tenants.release(tenant)
 
+		if capture is not None:
+			capture.write(received, captured, response)
 		return response
 
 
 settings = utils.Settings()
 
+# database and caches of single tenant servers, see Tenant
+DEFAULT_TENANT = Tenant()
+
 if __name__ == "__main__":
 
 	request_1 = {'type': 'register', 'email': 'mail1@test.de', 'pwd': 'xxxxxx'}
@@ -0,0 +1,371 @@
+"""
+sessions.py
+
+This module implements the session stores. Sessions are kept apart from
+the login bookkeeping (logins table), keyed by session identifier, so each
+request reads its session with a primary key lookup, and a user can have
+several sessions at the same time. Sessions expire by themselves: stores
+don't return expired sessions, and remove them periodically
+
+Sessions created, renewed and deleted are published to the invalidation
+bus as events of the entity 'Session', with the user_id value. The id of
+the events is the hexadecimal digest of the session identifier, the
+identifiers are not sent to the other nodes
+
+Each session is a dictionary with the keys session_id, user_id, created
+and expires (timestamps, in seconds), and next_id: identifier of the new
+session that replaces this one when it's renewed, None if not renewed
+
+Stores don't keep the session identifiers: sessions are keyed by the
+SHA-256 digest of their identifier (utils.token_digest), and next_id is
+kept encrypted with the identifier of the session renewed (utils.seal_token),
+so the stored sessions can't be used by someone reading the database. The
+base class translates identifiers to keys, subclasses only see the keys
+
+MemorySessionStore -- sessions kept in memory, lost when the process ends
+SQLiteSessionStore -- sessions kept in a local SQLite file
+DbSessionStore -- sessions kept in the sessions table of the PySAA database
+"""
+
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+from pysaa import dbapi, utils
+from pysaa.invalidation import Event, get_bus
+
+# seconds between two removals of the expired sessions
+PURGE_INTERVAL = 60
+
+
+def get_store(config):
+	"""
+	Creates the session store configured
+
+	Arguments:
+	config(dict) -- 'class': name of the store class, 'config': arguments
+	of the class
+
+	Returns:
+	SessionStore -- the new store
+	"""
+	cls = getattr(sys.modules[__name__], config['class'], None)
+	if cls is None:
+		raise ValueError("unknown session store %s" % config['class'])
+	return cls(**config.get('config', {}))
+
+
+class SessionStore(object):
+	"""
+	Base class of the session stores. Subclasses implement read, insert,
+	update, delete and delete_expired, on sessions keyed by the digest of
+	their identifier. All the methods accept the Db object
+	of the request, used by the stores kept in the PySAA database to join
+	its transaction; the other stores ignore it
+	"""
+
+	factory = None  # dbapi.DbFactory of the tenant, DbFactory() if None
+	tenant = None  # tenant key of the events published
+
+	def __init__(self):
+		self._purged = time.time()
+
+	def create(self, user_id, ttl, db=None):
+		"""
+		Creates a new session
+
+		Arguments:
+		user_id(int) -- user that owns the session
+		ttl(int) -- session lifetime, in seconds
+		db(dbapi.Db) -- Db object of the request
+
+		Returns:
+		str -- session identifier
+		"""
+		now = int(time.time())
+		if now - self._purged >= PURGE_INTERVAL:
+			self._purged = now
+			self.purge(db)
+		sid = utils.random_string(64)
+		self.insert(dict(session_id=utils.token_digest(sid), user_id=user_id, created=now,
+						 expires=now + ttl, next_id=None), db)
+		self.publish(Event('Session', utils.token_digest(sid).hex(), 'insert',
+						   {'user_id': user_id}), db)
+		return sid
+
+	def renew(self, session, ttl, grace, db=None):
+		"""
+		Replaces a session with a new one. The old session is kept alive
+		during a grace period, in which it points to the new one, so the
+		requests sent with the old sid don't fail
+
+		Arguments:
+		session(dict) -- session being replaced
+		ttl(int) -- lifetime of the new session, in seconds
+		grace(int) -- seconds the old session stays valid
+
+		Returns:
+		str -- identifier of the new session
+		"""
+		sid = self.create(session['user_id'], ttl, db)
+		expires = min(session['expires'], int(time.time()) + grace)
+		# only the requests with the old sid can read the new one
+		next_id = utils.seal_token(sid, session['session_id'])
+		self.update(utils.token_digest(session['session_id']),
+					{'expires': expires, 'next_id': next_id}, db)
+		self.publish(Event('Session', utils.token_digest(session['session_id']).hex(), 'update',
+						   {'user_id': session['user_id']}), db)
+		return sid
+
+	def remove(self, sid, db=None):
+		"""
+		Deletes a session (logout)
+		
+		Returns:
+		bool -- True if the session existed
+		"""
+		key = utils.token_digest(sid)
+		if not self.delete(key, db):
+			return False
+		self.publish(Event('Session', key.hex(), 'delete', {'user_id': None}), db)
+		return True
+
+	def publish(self, event, db=None):
+		"""
+		Publishes an invalidation event. The store writes immediately, so it
+		doesn't wait for the transaction of the request
+		"""
+		get_bus().publish([event], self.tenant)
+
+	def get(self, sid, db=None):
+		"""
+		Returns:
+		dict -- the session
+		None -- if the session doesn't exist or has expired
+		"""
+		key = utils.token_digest(sid)
+		session = self.read(key, db)
+		if session is None:
+			return None
+		if session['expires'] <= time.time():
+			self.delete(key, db)
+			return None
+		next_id = session['next_id']
+		session['session_id'] = sid
+		session['next_id'] = utils.open_token(next_id, sid) if next_id else None
+		return session
+
+	def touch(self, sid, expires, db=None):
+		"""
+		Sets the expiration time of a session
+
+		Arguments:
+		sid(str) -- session identifier
+		expires(int) -- new expiration timestamp
+		"""
+		self.update(utils.token_digest(sid), {'expires': expires}, db)
+
+	def purge(self, db=None):
+		"""
+		Removes the expired sessions
+		"""
+		try:
+			n = self.delete_expired(int(time.time()), db)
+		except Exception as e:  # not critical, tried again later
+			logging.error("could not remove expired sessions: %s" % e)
+			return
+		if n:
+			logging.debug("%d expired sessions removed" % n)
+
+	def read(self, key, db=None):
+		"""
+		Arguments:
+		key(bytes) -- digest of the session identifier
+
+		Returns:
+		dict -- the session, even if it has expired. None if not found
+		"""
+		raise NotImplementedError()
+
+	def insert(self, session, db=None):
+		"""
+		Stores a new session
+		"""
+		raise NotImplementedError()
+
+	def update(self, key, values, db=None):
+		"""
+		Arguments:
+		key(bytes) -- digest of the session identifier
+		values(dict) -- column:value pairs being updated
+		"""
+		raise NotImplementedError()
+
+	def delete(self, key, db=None):
+		"""
+		Arguments:
+		key(bytes) -- digest of the session identifier
+
+		Returns:
+		bool -- True if the session existed
+		"""
+		raise NotImplementedError()
+
+	def delete_expired(self, now, db=None):
+		"""
+		Returns:
+		int -- number of sessions removed
+		"""
+		raise NotImplementedError()
+
+
+class MemorySessionStore(SessionStore):
+	"""
+	Sessions kept in a dictionary. Only for single process deployments
+	"""
+
+	def __init__(self):
+		super().__init__()
+		self._sessions = {}  # key -> session
+		self._lock = threading.Lock()
+
+	def read(self, key, db=None):
+		session = self._sessions.get(key)
+		return dict(session) if session is not None else None
+
+	def insert(self, session, db=None):
+		with self._lock:
+			self._sessions[session['session_id']] = dict(session)
+
+	def update(self, key, values, db=None):
+		with self._lock:
+			session = self._sessions.get(key)
+			if session is not None:
+				# copy, readers may be using the current one
+				self._sessions[key] = dict(session, **values)
+
+	def delete(self, key, db=None):
+		with self._lock:
+			return self._sessions.pop(key, None) is not None
+
+	def delete_expired(self, now, db=None):
+		with self._lock:
+			expired = [key for key, s in self._sessions.items() if s['expires'] <= now]
+			for key in expired:
+				del self._sessions[key]
+		return len(expired)
+
+
+class SQLiteSessionStore(SessionStore):
+	"""
+	Sessions kept in a SQLite file, apart from the PySAA database. Each
+	thread uses its own connection, in autocommit mode
+	"""
+
+	def __init__(self, database):
+		"""
+		Arguments:
+		database(str) -- path of the SQLite file, created if needed
+		"""
+		super().__init__()
+		self._database = database
+		self._local = threading.local()
+		conn = self.connection()
+		conn.execute("create table if not exists sessions (session_id blob primary key, "
+					 "user_id integer not null, created integer not null, "
+					 "expires integer not null, next_id blob) without rowid")
+		conn.execute("create index if not exists sessions_expires on sessions (expires)")
+
+	def connection(self):
+		"""
+		Returns:
+		sqlite3.Connection -- connection of the current thread
+		"""
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			conn = sqlite3.connect(self._database, isolation_level=None)
+			conn.execute("pragma journal_mode=wal")
+			conn.execute("pragma synchronous=normal")
+			conn.row_factory = sqlite3.Row
+			self._local.conn = conn
+		return conn
+
+	def read(self, key, db=None):
+		row = self.connection().execute(
+			"select * from sessions where session_id=?", (key,)).fetchone()
+		return dict(row) if row is not None else None
+
+	def insert(self, session, db=None):
+		self.connection().execute(
+			"insert into sessions (session_id, user_id, created, expires, next_id) "
+			"values (:session_id, :user_id, :created, :expires, :next_id)", session)
+
+	def update(self, key, values, db=None):
+		cols = ", ".join(["%s=:%s" % (k, k) for k in values])
+		self.connection().execute(
+			"update sessions set %s where session_id=:_id" % cols, dict(values, _id=key))
+
+	def delete(self, key, db=None):
+		return self.connection().execute(
+			"delete from sessions where session_id=?", (key,)).rowcount > 0
+
+	def delete_expired(self, now, db=None):
+		return self.connection().execute(
+			"delete from sessions where expires<=?", (now,)).rowcount
+
+
+class DbSessionStore(SessionStore):
+	"""
+	Sessions kept in the sessions table of the PySAA database, through the
+	storage engine. Writes are part of the transaction of the request if
+	its Db object is given, otherwise they are committed immediately
+	"""
+
+	table = 'sessions'
+	table_id = 'session_id'
+
+	def publish(self, event, db=None):
+		"""
+		Writes are part of the transaction of the request, the event is
+		published when it's committed
+		"""
+		if db is not None:
+			db.add_event(event)
+		else:
+			get_bus().publish([event], self.tenant)
+
+	def call(self, db, method, *args):
+		"""
+		Calls a storage engine method, with a new Db object if db is None
+		"""
+		if db is not None:
+			return getattr(db, method)(*args)
+		db = (self.factory or dbapi.DbFactory()).get_db()
+		try:
+			ret = getattr(db, method)(*args)
+			db.commit()
+			return ret
+		except Exception:
+			db.rollback()
+			raise
+		finally:
+			db.close_cursor()
+			db.close_connection()
+
+	def read(self, key, db=None):
+		rows = self.call(db, 'select', self.table, {self.table_id: key})
+		return dict(rows[0]) if rows else None
+
+	def insert(self, session, db=None):
+		self.call(db, 'insert', self.table, self.table_id, session)
+
+	def update(self, key, values, db=None):
+		self.call(db, 'update', self.table, self.table_id, key, values)
+
+	def delete(self, key, db=None):
+		return self.call(db, 'delete', self.table, self.table_id, key) > 0
+
+	def delete_expired(self, now, db=None):
+		return self.call(db, 'delete_older', self.table, 'expires', now)
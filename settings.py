@@ -19,11 +19,101 @@ T_BLOCKED = 60 * 15  # 15 minutes
 #session identifier maximum lifetime
 T_SESSION = 60 * 60 * 2  #2h
 
-#if remaining session lifetime is lower than this value
+#how sessions are kept alive:
+#'sliding' -- the expiration time is extended on use, the sid doesn't change
+#'rotate' -- a new sid is generated when the session is about to expire
+SESSION_REFRESH = 'sliding'
+
+#rotate mode: if remaining session lifetime is lower than this value
 #then a new session id is generated
 T_REFRESH = 60 * 5  #5 minutes
 
+#rotate mode: the old session id is still valid during this time after
+#the rotation, so that concurrent requests don't fail
+T_SESSION_GRACE = 30  # seconds
+
+#sliding mode: minimum time between two extensions of a session, the
+#expiration time is written at most once in this interval
+T_SESSION_TOUCH = 60  # seconds
+
+#maximum number of unknown sids, emails and activation ids remembered
+#lookups for these keys are answered without querying the database
+NEGATIVE_CACHE_SIZE = 100000
+
+#lifetime of the entries in the negative cache
+T_NEGATIVE_CACHE = 30  # seconds
+
+#maximum number of authorization decisions (role, object) remembered, 0
+#disables the cache. Decisions are dropped when the permissions change
+DECISION_CACHE_SIZE = 4096
+
+#the objects granted to anonymous users are kept in memory and reloaded
+#with this interval, 0 disables it (anonymous requests read the database)
+T_PUBLIC_REFRESH = 60  # seconds
+
+#write-behind mode: refused logins and session timestamp refreshes are
+#buffered in memory and written by a background thread
+WRITE_BEHIND = False
+
+#time between two writes of the write-behind buffer
+T_WRITE_BEHIND = 1  # seconds
+
+#number of worker threads used by PySAAServer.submit
+WORKERS = 8
+
+#maximum number of requests waiting for a worker thread
+MAX_QUEUE = 64
+
+#time a request waits for a place in the queue before being refused
+T_QUEUE = 0  # seconds
+
+#admission control (admission module), off by default: maximum number of
+#requests of each type processed at the same time, types not listed are
+#not limited, so that authorize requests are not delayed by registrations
+#or logins, e.g. {'register': 2, 'activate': 2, 'login': 4, 'logout': 4}
+ADMISSION_LIMITS = {}
+#while the average database time is above the target, the limits are
+#reduced (None: fixed limits)
+ADMISSION_TARGET = 0.05  # seconds
+#requests that waited in the queue longer than this are refused (0: no
+#limit), e.g. 0.5
+T_QUEUE_DEADLINE = 0  # seconds
+
+#profiling of requests (profiling module), can be changed at runtime
+#using PySAAServer.profiler. Profile 1 in PROFILE_RATE requests (0: off)
+PROFILE_RATE = 0
+
+#keep the profiles of requests slower than this, None: off
+#note that all the requests are profiled while it's set
+PROFILE_SLOW = None  # seconds
+
+#trace memory allocations with tracemalloc
+PROFILE_MEMORY = False
+
+#directory where the profiles are written
+PROFILE_DIR = "profiles"
+
+#append the requests handled to this JSON lines file, to replay them later
+#with the replay module (emails, passwords and ids are hashed), None: off
+CAPTURE_FILE = None
+
+#session store (sessions module), available classes:
+#DbSessionStore -- sessions table of the database configured in DATABASE
+#SQLiteSessionStore -- local SQLite file, config: {'database': path}
+#MemorySessionStore -- in memory, only for single process deployments
+SESSION_STORE = {'class': 'DbSessionStore', 'config': {}}
+
+#transport of the cache invalidation events (invalidation module),
+#needed if several processes or hosts serve requests. Available classes:
+#LocalTransport -- single process
+#UnixSocketTransport -- processes of one host, config: {'directory': path}
+#UdpMulticastTransport -- config: {'group', 'port', 'interface', 'ttl'}
+INVALIDATION = {'class': 'LocalTransport', 'config': {}}
+
 #database connection settings
+#available classes: MySqlDb, SQLiteDb, MemoryDb (in-memory tables, for tests),
+#SQLiteWalDb (SQLite in production: WAL mode, single writer thread with
+#group commit), config: {'database': path, 'pragmas': {name: value}}
 DATABASE = {'class': 'MySqlDb',  #db adapter class
             'config': {  #MySQL specific paramters
                          'host': 'localhost',  #host
@@ -34,6 +124,48 @@ DATABASE = {'class': 'MySqlDb',  #db adapter class
             }
 }
 
+#maximum number of idle database connections kept open for reuse
+DB_POOL_SIZE = 8
+
+#multi-tenant mode: each tenant has its own database, whose settings are
+#made from this template replacing '{tenant}' with the tenant key of the
+#request (parameter 'tenant'), e.g. {'class': 'SQLiteWalDb', 'config':
+#{'database': '/var/lib/pysaa/{tenant}.db'}}. SESSION_STORE is a template
+#too. None: single tenant, DATABASE is used
+TENANT_DATABASE = None
+
+#maximum number of tenants open, the least recently used are closed
+MAX_TENANTS = 100
+
+#maximum number of idle database connections of each tenant
+TENANT_POOL_SIZE = 2
+
+#sql statements slower than this are written to the slow query log
+#(logger "pysaa.slow_queries"), with redacted arguments. None: off
+SLOW_QUERY = None  # seconds
+
+#write the query plan (EXPLAIN) of the slow statements
+SLOW_QUERY_EXPLAIN = False
+
+#full scans of these tables found in the query plans are reported as warnings
+SLOW_QUERY_TABLES = ('users', 'logins', 'activations')
+
+#read the role hierarchy and its permissions with a single recursive query
+#(WITH RECURSIVE). If False, or if the database doesn't support it, one
+#query per level of the hierarchy is needed
+RECURSIVE_QUERIES = True
+
+#address of the HTTP front end (httpserver module)
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = 8080
+
+#address of the binary protocol server (binproto module)
+#(host, port) tuple for TCP, or a path for a Unix socket
+BINARY_ADDRESS = ("127.0.0.1", 8081)
+
+#number of persistent connections opened by each binary protocol client
+BINARY_POOL_SIZE = 4
+
 #front-end url that receives user requests
 BASE_URL = "http://www.mydomain.de"
 
@@ -2,17 +2,32 @@
 utils.py
 
 This module contains common functionalities that are used by other classes:
-Settings class and the methods random_string and send_mail
+Settings, MissCache, DecisionCache and SingleFlight classes and the methods
+random_string, random_strings, send_mail and send_mails
 """
+import hashlib
+import os
 import random
-import smtplib
 import string
+import threading
+import time
 
-from email.mime.text import MIMEText
+from collections import OrderedDict
+from concurrent.futures import Future
 
 
 CHARS = string.ascii_letters + string.digits
 
+# settings that must be defined, checked by Settings.validate
+REQUIRED_SETTINGS = ('T_ACTIVATION', 'MAX_ATTEMPTS', 'T_LOGIN', 'T_BLOCKED', 'T_SESSION',
+					 'T_REFRESH', 'T_NEGATIVE_CACHE', 'NEGATIVE_CACHE_SIZE', 'WRITE_BEHIND',
+					 'T_WRITE_BEHIND', 'WORKERS', 'MAX_QUEUE', 'T_QUEUE', 'DATABASE',
+					 'DB_POOL_SIZE', 'SESSION_STORE', 'SESSION_REFRESH', 'T_SESSION_GRACE',
+					 'T_SESSION_TOUCH', 'INVALIDATION', 'DECISION_CACHE_SIZE',
+					 'T_PUBLIC_REFRESH', 'CAPTURE_FILE', 'ADMISSION_LIMITS',
+					 'ADMISSION_TARGET', 'T_QUEUE_DEADLINE', 'TENANT_DATABASE', 'MAX_TENANTS',
+					 'TENANT_POOL_SIZE')
+
 
 class Settings(object):
 	"""
@@ -21,11 +36,15 @@ class Settings(object):
 	"""
 
 	_instance = None  # instance of this class
+	_lock = threading.Lock()  # the instance is created only once
 
 	def __new__(cls):
 		if Settings._instance is None:
-			Settings._instance = object.__new__(cls)  # create new instance
-			Settings._instance.import_settings()  # import the settings
+			with Settings._lock:
+				if Settings._instance is None:
+					instance = object.__new__(cls)  # create new instance
+					instance.import_settings()  # import the settings
+					Settings._instance = instance
 
 		return Settings._instance
 
@@ -47,6 +66,326 @@ class Settings(object):
 				value = getattr(mysettings, setting)
 				setattr(self, setting, value)
 
+	def validate(self):
+		"""
+		Checks that the settings needed by PySAA are defined and valid, so
+		that configuration errors are found at startup and not while
+		processing requests
+		
+		Raises:
+		ValueError -- if any setting is missing or not valid
+		"""
+		for setting in REQUIRED_SETTINGS:
+			if not hasattr(self, setting):
+				raise ValueError("setting %s not defined" % setting)
+			value = getattr(self, setting)
+			if setting.startswith('T_') or setting in ('MAX_ATTEMPTS', 'WORKERS', 'MAX_TENANTS',
+														'TENANT_POOL_SIZE'):
+				if not isinstance(value, (int, float)) or value < 0:
+					raise ValueError("setting %s must be a positive number" % setting)
+
+		if not 'class' in self.DATABASE or not 'config' in self.DATABASE:
+			raise ValueError("setting DATABASE must contain 'class' and 'config'")
+
+		if self.TENANT_DATABASE:
+			if not 'class' in self.TENANT_DATABASE or not 'config' in self.TENANT_DATABASE:
+				raise ValueError("setting TENANT_DATABASE must contain 'class' and 'config'")
+			if not '{tenant}' in repr(self.TENANT_DATABASE['config']):
+				raise ValueError("setting TENANT_DATABASE must contain '{tenant}', "
+								 "the tenants would share the database")
+			if self.MAX_TENANTS < 1:
+				raise ValueError("setting MAX_TENANTS must be at least 1")
+			# a file shared by the tenants would mix their sessions
+			config = self.SESSION_STORE.get('config', {})
+			if 'database' in config and not '{tenant}' in config['database']:
+				raise ValueError("the session store database of each tenant must "
+								 "contain '{tenant}'")
+
+
+class MissCache(object):
+	"""
+	Bounded cache of keys known to be absent from database (negative cache).
+	Entries expire after a short time-to-live, so a key that is inserted
+	by another process is not hidden for long. When the cache is full,
+	the oldest entries are evicted first
+	"""
+
+	def __init__(self, size, ttl):
+		"""
+		Arguments:
+		size(int) -- maximum number of keys stored
+		ttl(int) -- lifetime of each entry, in seconds
+		"""
+		self._size = size
+		self._ttl = ttl
+		self._keys = OrderedDict()  # key -> expiration timestamp
+		self._lock = threading.Lock()
+
+	def __contains__(self, key):
+		"""
+		Returns:
+		bool -- True if key has been recorded as missing and has not expired
+		"""
+		with self._lock:
+			expires = self._keys.get(key)
+			if expires is None:
+				return False
+			if expires < time.time():
+				del self._keys[key]
+				return False
+			return True
+
+	def add(self, key):
+		"""
+		Records a key as missing
+		"""
+		if self._size <= 0:
+			return
+		with self._lock:
+			self._keys.pop(key, None)
+			self._keys[key] = time.time() + self._ttl
+			while len(self._keys) > self._size:
+				self._keys.popitem(last=False)  # evict oldest entry
+
+	def claim(self, key):
+		"""
+		Records a key, unless it's already recorded. The check and the
+		insertion are atomic, so the cache can be used to let only one
+		caller do something with a key during the time-to-live
+		
+		Returns:
+		bool -- True if the key was not recorded (or had expired)
+		"""
+		if self._size <= 0:
+			return True
+		with self._lock:
+			now = time.time()
+			expires = self._keys.get(key)
+			if expires is not None and expires >= now:
+				return False
+			self._keys.pop(key, None)
+			self._keys[key] = now + self._ttl
+			while len(self._keys) > self._size:
+				self._keys.popitem(last=False)
+			return True
+
+	def discard(self, key):
+		"""
+		Forgets a key, must be called when the key is stored in database
+		"""
+		with self._lock:
+			self._keys.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._keys.clear()
+
+
+class DecisionCache(object):
+	"""
+	Fixed-size cache of authorization decisions, keyed by (role id, object
+	id). Evicts with the CLOCK algorithm: each slot has a reference bit, set
+	on every hit, and the hand clears the bits until it finds a slot not
+	used since its last pass. Hits only read dictionaries and set a byte,
+	without locking or allocating; the counters are approximate when
+	several threads hit at the same time
+
+	The ancestors of each role are kept along with its decisions, so the
+	decisions depending on a role can be dropped when the permissions of
+	that role change. The generation counter increases on each
+	invalidation, decisions computed before an invalidation are not stored
+	"""
+
+	def __init__(self, size):
+		"""
+		Arguments:
+		size(int) -- maximum number of decisions stored, 0 disables the cache
+		"""
+		self._size = size
+		self._index = {}  # role id -> {object id: slot}
+		self._ancestors = {}  # role id -> frozenset of role ids, itself included
+		self._keys = [None] * size  # slot -> (role id, object id)
+		self._values = [False] * size  # slot -> decision
+		self._refs = bytearray(size)  # slot -> reference bit
+		self._free = list(range(size - 1, -1, -1))
+		self._hand = 0
+		self._lock = threading.Lock()
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def get(self, role_id, oid):
+		"""
+		Returns:
+		bool -- decision cached for the role and object
+		None -- if not cached
+		"""
+		slot = self._index.get(role_id, _EMPTY).get(oid)
+		if slot is not None:
+			decision = self._values[slot]
+			# the slot may have been reused by another thread meanwhile
+			key = self._keys[slot]
+			if key is not None and key[1] == oid and key[0] == role_id:
+				self._refs[slot] = 1
+				self.hits += 1
+				return decision
+		self.misses += 1
+		return None
+
+	def ancestors(self, role_id):
+		"""
+		Returns:
+		frozenset -- ancestors of the role given to put, itself included.
+		None if not known
+		"""
+		return self._ancestors.get(role_id)
+
+	def put(self, role_id, oid, decision, ancestors, generation):
+		"""
+		Stores a decision
+
+		Arguments:
+		role_id(int) -- role identifier
+		oid(str) -- object identifier
+		decision(bool) -- True if the role can access the object
+		ancestors(iterable) -- identifiers of the role and of its ancestors
+		generation(int) -- value of the generation attribute read before
+		computing the decision
+		"""
+		if self._size <= 0:
+			return
+		with self._lock:
+			if generation != self.generation:  # invalidated meanwhile
+				return
+			if role_id not in self._ancestors:
+				self._ancestors[role_id] = frozenset(ancestors)
+			slot = self._index.get(role_id, _EMPTY).get(oid)
+			if slot is None:
+				# evicts before reading the slots of the role, the eviction
+				# may remove them
+				slot = self._free.pop() if self._free else self._evict()
+				# get reads the value and then the key: the value is written
+				# first and the slot is published last, so a reader never
+				# pairs the decision of another key with this one
+				self._values[slot] = decision
+				self._keys[slot] = (role_id, oid)
+				self._index.setdefault(role_id, {})[oid] = slot
+			else:
+				self._values[slot] = decision
+			self._refs[slot] = 0
+
+	def _evict(self):
+		"""
+		Moves the hand to the first slot not referenced and frees it, must
+		be called holding the lock
+
+		Returns:
+		int -- the slot freed
+		"""
+		refs = self._refs
+		while refs[self._hand]:
+			refs[self._hand] = 0
+			self._hand = (self._hand + 1) % self._size
+		slot = self._hand
+		self._hand = (slot + 1) % self._size
+		role_id, oid = self._keys[slot]
+		self._keys[slot] = None  # readers holding the slot don't match it anymore
+		slots = self._index[role_id]
+		del slots[oid]
+		if not slots:
+			del self._index[role_id]
+		self.evictions += 1
+		return slot
+
+	def invalidate_role(self, role_id, hierarchy=False):
+		"""
+		Drops the decisions of a role and of the roles that inherit from it
+
+		Arguments:
+		role_id(int) -- role whose permissions changed
+		hierarchy(bool) -- True if the parent of the role changed, the
+		ancestors of the roles affected are dropped too
+		"""
+		with self._lock:
+			self.generation += 1
+			self.invalidations += 1
+			for rid in [rid for rid, ids in self._ancestors.items() if role_id in ids]:
+				for slot in self._index.pop(rid, _EMPTY).values():
+					self._keys[slot] = None
+					self._refs[slot] = 0
+					self._free.append(slot)
+				if hierarchy:
+					del self._ancestors[rid]
+
+	def clear(self):
+		with self._lock:
+			self.generation += 1
+			self.invalidations += 1
+			self._index = {}
+			self._ancestors = {}
+			self._keys = [None] * self._size
+			self._refs = bytearray(self._size)
+			self._free = list(range(self._size - 1, -1, -1))
+
+	def stats(self):
+		"""
+		Returns:
+		dict -- hits, misses, evictions, invalidations, entries and hit rate
+		"""
+		lookups = self.hits + self.misses
+		return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+					invalidations=self.invalidations, entries=self._size - len(self._free),
+					hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+# shared default of the dictionary lookups, never modified
+_EMPTY = {}
+
+
+class SingleFlight(object):
+	"""
+	Coalesces concurrent calls with the same key: the first caller runs the
+	function, and the callers arriving while it's running wait and get the
+	same result (or exception). Results are not cached after the call ends
+	"""
+
+	def __init__(self):
+		self._calls = {}  # key -> Future of the call in flight
+		self._lock = threading.Lock()
+
+	def do(self, key, func, *args):
+		"""
+		Arguments:
+		key -- identifies the call, must be hashable
+		func(function) -- function being called
+		args -- arguments passed to func
+		
+		Returns:
+		the value returned by func
+		"""
+		with self._lock:
+			future = self._calls.get(key)
+			leader = future is None
+			if leader:
+				future = self._calls[key] = Future()
+
+		if not leader:  # wait for the call in flight
+			return future.result()
+
+		try:
+			result = func(*args)
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		else:
+			future.set_result(result)
+		finally:
+			with self._lock:
+				del self._calls[key]
+		return result
+
 
 def random_string(length):
 	"""
@@ -66,31 +405,121 @@ def random_string(length):
 	return ''.join([CHARS[randrange(n) - offset] for _ in range(length)])
 
 
-def send_mail(user, activation):
+def random_strings(n, length):
+	"""
+	Creates n random strings at once, much faster than calling
+	random_string n times. Characters are chosen from CHARS variable
+	
+	Arguments:
+	n(int) -- number of strings
+	length(int) -- length of each string
+	
+	Returns:
+	list -- the random strings generated
+	"""
+	# bytes >= 248 are discarded, so that each char has the same probability
+	limit = len(CHARS) * (256 // len(CHARS))
+	table = bytes([ord(CHARS[b % len(CHARS)]) if b < limit else 0 for b in range(256)])
+	discarded = bytes(range(limit, 256))
+	chars = b''
+	while len(chars) < n * length:
+		# uses the operative system random number generator
+		chars += os.urandom(n * length * 2).translate(None, discarded)
+	chars = chars.translate(table).decode('ascii')
+	return [chars[i * length:(i + 1) * length] for i in range(n)]
+
+
+def token_digest(token):
+	"""
+	Tokens sent to the users (activation and session ids) are not stored,
+	their SHA-256 digests are: fixed width keys, half the size of the
+	tokens, that can't be used if the database is leaked
+	
+	Arguments:
+	token(str) -- the token
+	
+	Returns:
+	bytes -- 32 bytes digest, the value stored in database
+	"""
+	return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+def seal_token(token, key):
+	"""
+	Encrypts a token with another token, e.g. the sid of a renewed session
+	with the old sid: the database stores the result, which can only be
+	opened by someone who knows the old sid, not by reading the database
+	(it only contains the digest of the old sid)
+	
+	Arguments:
+	token(str) -- the token encrypted, ASCII, 64 characters at most
+	key(str) -- the token used as key
+	
+	Returns:
+	bytes -- the token encrypted, same length
+	"""
+	# one-time pad: the key is random, and it's used for a single token
+	pad = hashlib.sha512(b"pysaa-seal:" + key.encode('utf-8')).digest()
+	return bytes([c ^ p for c, p in zip(token.encode('ascii'), pad)])
+
+
+def open_token(sealed, key):
+	"""
+	Decrypts a token encrypted by seal_token
+	
+	Arguments:
+	sealed(bytes) -- the token encrypted
+	key(str) -- the token used as key
+	
+	Returns:
+	str -- the token
+	"""
+	pad = hashlib.sha512(b"pysaa-seal:" + key.encode('utf-8')).digest()
+	return bytes([c ^ p for c, p in zip(sealed, pad)]).decode('ascii')
+
+
+def send_mail(user, aid):
 	"""
 	Generates activation link and send it to the user using smtplib
 	SMTP server settings are taken from settings object 
 	
 	Arguments:
 	user(model.User) -- user entity
-	activation(model.Activation) -- activation entity
+	aid(str) -- activation identifier, the database only has its digest
 	"""
+	send_mails([(user.email, aid)])
+
+
+def send_mails(activations):
+	"""
+	Sends activation links to many users, in a single SMTP session
+	
+	Arguments:
+	activations(list) -- (email, activation id) tuples
+	"""
+	# imported here, mail modules are slow to import and rarely used
+	import smtplib
+	from email.mime.text import MIMEText
+
 	settings = Settings()
-	# generate the link
-	link = settings.BASE_URL + "/activate?aid=" + activation.activation_id
-	#build a simple text message containing the link
-	msg = MIMEText(link)
-	msg['Subject'] = 'activation of your account'
-	msg['From'] = settings.MAIL_FROM
-	msg['To'] = user.email
 	#connect to mail server
 	server = smtplib.SMTP(settings.SMTP_SERVER)
-	#login, if necessary
-	server.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
-	#send the email
-	server.sendmail(settings.MAIL_FROM, user.email, msg.as_string())
-	#disconnect from smtp server
-	server.quit()
+	try:
+		#login, if necessary
+		server.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
+		for email, aid in activations:
+			# generate the link
+			link = settings.BASE_URL + "/activate?aid=" + aid
+			#build a simple text message containing the link
+			msg = MIMEText(link)
+			msg['Subject'] = 'activation of your account'
+			msg['From'] = settings.MAIL_FROM
+			msg['To'] = email
+			#send the email
+			server.sendmail(settings.MAIL_FROM, email, msg.as_string())
+	finally:
+		#disconnect from smtp server
+		server.quit()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+"""
+writebehind.py
+
+This module implements write-behind buffering of entity updates. Updates
+that are not critical (e.g. login attempt counters) are kept in memory,
+merged by entity id, and written to database in batches by a background
+thread, so they don't add latency to the requests
+"""
+
+import atexit
+import logging
+import threading
+
+from pysaa import dbapi
+
+
+class WriteBehindBuffer(object):
+	"""
+	Buffer of pending updates for one entity class. Each entity id has at
+	most one pending update, containing the latest value of each column
+	"""
+
+	def __init__(self, entity_class, interval, factory=None):
+		"""
+		Arguments:
+		entity_class(class) -- model entity class buffered
+		interval(float) -- seconds between two flushes
+		factory(dbapi.DbFactory) -- factory of the database written,
+		DbFactory() by default
+		"""
+		self._entity_class = entity_class
+		self._interval = interval
+		self._factory = factory
+		self._pending = {}  # id -> column values
+		self._flushing = {}  # values being written by the current flush
+		self._lock = threading.Lock()  # protects _pending and _flushing
+		self._flush_lock = threading.Lock()  # held while writing to database
+		self._stop = threading.Event()
+		self._thread = None
+
+	def put(self, id, **values):
+		"""
+		Buffers an update. Values are merged with the pending ones, if any
+
+		Arguments:
+		id -- entity identifier
+		values -- column:value pairs being written
+		"""
+		with self._lock:
+			self._pending.setdefault(id, {}).update(values)
+		if self._thread is None:
+			self.start()
+
+	def get(self, id):
+		"""
+		Returns:
+		dict -- column values pending to be written for this id, or None
+		"""
+		with self._lock:
+			values = self._pending.get(id) or self._flushing.get(id)
+			return dict(values) if values else None
+
+	def overlay(self, entity, id=None):
+		"""
+		Applies the pending values on an entity read from database, so that
+		the caller sees the latest state. The values are not marked as
+		modified: the buffer writes them, the entity must not write them again
+
+		Arguments:
+		entity(model.EntityBase) -- entity loaded from database
+		id -- entity identifier, needed if the entity was not found
+		"""
+		values = self.get(entity.id if id is None else id)
+		if values:
+			entity.__dict__.update(values)
+		return entity
+
+	def discard(self, id):
+		"""
+		Forgets the pending update for this id. Must be called before an
+		entity is written synchronously, so the buffered (older) values don't
+		overwrite it. Waits for the flush in progress, if any
+		"""
+		with self._flush_lock:
+			with self._lock:
+				self._pending.pop(id, None)
+
+	def flush(self):
+		"""
+		Writes all the pending updates in a single transaction
+		"""
+		with self._flush_lock:
+			with self._lock:
+				self._flushing, self._pending = self._pending, {}
+			if len(self._flushing) == 0:
+				return
+
+			cls = self._entity_class
+			db = (self._factory or dbapi.DbFactory()).get_db()
+			db.context = type(self).__name__
+			try:
+				for id, values in self._flushing.items():
+					# update the row, or insert it if it doesn't exist yet
+					if db.update(cls.table, cls.table_id, id, values) == 0:
+						row = dict(values)
+						row[cls.table_id] = id
+						db.insert(cls.table, cls.table_id, row)
+				db.commit()
+			except Exception as e:
+				logging.exception("write-behind flush failed: %s" % e)
+				db.rollback()
+				with self._lock:
+					# put back values not replaced by newer updates
+					for id, values in self._flushing.items():
+						values.update(self._pending.get(id, {}))
+						self._pending[id] = values
+			finally:
+				with self._lock:
+					self._flushing = {}
+				db.close_cursor()
+				db.close_connection()
+
+	def start(self):
+		"""
+		Starts the background thread that flushes the buffer periodically
+		"""
+		with self._lock:
+			if self._thread is not None:
+				return
+			self._thread = threading.Thread(target=self._run, daemon=True,
+											name="pysaa-write-behind")
+		self._thread.start()
+		atexit.register(self.stop)
+
+	def stop(self):
+		"""
+		Stops the background thread and writes the pending updates
+		"""
+		atexit.unregister(self.stop)  # the buffer can be released (closed tenant)
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+		self.flush()
+
+	def _run(self):
+		while not self._stop.wait(self._interval):
+			self.flush()